@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+'''
+Benchmark the non-Office stages of shape.py on the TopoJSON files in maps/.
+
+Each case renders a map with shape.main() into a RecordingBackend. This backend
+does not draw anything: it just counts the calls made to it. The cases are:
+
+- every TopoJSON file in maps/, unfiltered
+- every map in a shape.py YAML config, with its filters
+
+For each case, this reports:
+
+- the median time over --repeat runs, and the median time of each stage (see timing.py).
+  These warm runs load the TopoJSON from its binary sidecar (see topology.load)
+- the median time of --repeat cold runs, which parse the TopoJSON itself
+- throughput, in points drawn per second
+- peak memory allocated by Python and NumPy, measured with tracemalloc in a separate cold run
+- the number of calls made to the backend
+
+--save stores the results as a baseline. Later runs are compared against it, and
+the script exits with status 1 if a case is slower, uses more memory, or makes
+different calls than the baseline.
+
+    python benchmark.py --save              # Store a baseline in benchmark.json
+    python benchmark.py                     # ... then compare against it
+    python benchmark.py -k S01              # Only run cases with S01 in the name
+'''
+from __future__ import print_function, unicode_literals, division
+
+import io
+import os
+import sys
+import copy
+import shutil
+import glob
+import json
+import yaml
+import timeit
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+from collections import Counter, OrderedDict
+import shape
+import timing
+import topology
+
+folder = os.path.dirname(os.path.abspath(__file__))
+REPEAT = 3              # Number of timed runs per case
+THRESHOLD = 0.1         # Report changes larger than 10% of the baseline as regressions
+MIN_SECONDS = 0.01      # ... but ignore time changes smaller than this, which are noise
+
+
+class RecordingBackend(object):
+    '''
+    A shape.py backend that records the number of calls to each method, without
+    drawing anything. Use it to measure the work outside Excel.
+    '''
+    def __init__(self, visible=False):
+        self.calls = Counter()
+
+    def open(self, template):
+        self.calls['open'] += 1
+
+    def freeform(self, rings, color, name):
+        self.calls['freeform'] += 1
+        return name
+
+    def labels(self, labels):
+        self.calls['labels'] += 1
+
+    def cells(self, row, col, values):
+        self.calls['cells'] += 1
+
+    def color(self, row, col, color):
+        self.calls['color'] += 1
+
+    def table(self, name, top, left, bottom, right, style):
+        self.calls['table'] += 1
+
+    def screenshot(self, img_file, box):
+        self.calls['screenshot'] += 1
+
+    def fill(self, color):
+        self.calls['fill'] += 1
+
+    def vba(self, source):
+        self.calls['vba'] += 1
+
+    def save(self, filename, sheet_name):
+        self.calls['save'] += 1
+
+    def quit(self):
+        pass
+
+
+def map_cases(path):
+    '''Return [(name, options)] to render each TopoJSON file in the path folder'''
+    cases = []
+    for topo in sorted(glob.glob(os.path.join(path, '*.json'))):
+        options = shape.parser.parse_args([])
+        options.topo = topo
+        cases.append((os.path.basename(topo), options))
+    return cases
+
+
+def yaml_cases(path, topo=None, rename=None):
+    '''
+    Return [(name, options)] to render each map in a shape.py YAML config, the
+    way shape.batch() does. If the config's TopoJSON file does not exist, use
+    topo instead, with columns renamed via rename = {config column: topo column}
+    (see match_filters). Maps whose filters match nothing in topo are skipped.
+    '''
+    with io.open(path, encoding='utf-8') as handle:
+        config = yaml.safe_load(handle)
+    common = config.get('common', {})
+    values, cases = {}, []
+    for index, row in enumerate(config.get('maps', [])):
+        options = shape.parser.parse_args([])
+        for props in [common, row]:
+            for key, val in props.items():
+                if isinstance(val, dict):
+                    original = dict(getattr(options, key, {}) or {})
+                    original.update(val)
+                    val = original
+                setattr(options, key, val)
+        name = os.path.basename(options.out or '%s:%d' % (path, index))
+        if not os.path.exists(options.topo):
+            if topo is None:
+                continue
+            options.topo = topo
+            options.key, options.col = [
+                ','.join((rename or {}).get(col, col) for col in cols.split(','))
+                for cols in (options.key, options.col)]
+            options.filters = match_filters(options.filters, topo, rename or {}, values)
+            if options.filters is None:
+                print('Skipping %s: its filters match nothing in %s' % (name, topo))
+                continue
+        cases.append((name, options))
+    return cases
+
+
+def match_filters(filters, topo, rename, values):
+    '''
+    Return shape.py filters for the topo TopoJSON file, renaming columns via
+    rename. Values match topo's values ignoring case. Return None if a filter
+    matches nothing. values caches {column: {value in upper case: value}}.
+    '''
+    result = []
+    for col, vals in shape.parse_filters(filters).items():
+        col = rename.get(col, col)
+        if col not in values:
+            data = topology.load_properties(topo)
+            strings = data.strings(col) if col in data.columns else []
+            values[col] = {val.upper(): val for val in strings}
+        vals = sorted(values[col][val.upper()] for val in vals if val.upper() in values[col])
+        if not vals:
+            return None
+        result.append('%s=%s' % (col, '|'.join(vals)))
+    return ','.join(result)
+
+
+@contextlib.contextmanager
+def quiet():
+    '''Hide what shape.main() prints, and its progress bars'''
+    with io.open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            yield
+
+
+def render(options, target, cold=False):
+    '''
+    Render a copy of options into target with a RecordingBackend. Return the
+    backend. If cold, delete the TopoJSON's sidecar first, so it is parsed again.
+    '''
+    options = copy.copy(options)
+    options.out = os.path.join(target, os.path.basename(options.out or options.topo))
+    backend = RecordingBackend()
+    # Load the TopoJSON each time, like a new shape.py process would
+    topology._cache.clear()
+    if cold:
+        shape.delete(options.topo + topology.BINARY_EXT)
+    with quiet():
+        shape.main(backend, options)
+    return backend
+
+
+def run(options, target, repeat=REPEAT):
+    '''Return the benchmark results of rendering options repeat times, cold and warm'''
+    # Render a copy of the TopoJSON in target, whose sidecar can be deleted for cold runs
+    options = copy.copy(options)
+    topo = os.path.join(target, os.path.basename(options.topo))
+    shutil.copy2(options.topo, topo)
+    options.out, options.topo = options.out or options.topo, topo
+    cold = []
+    for index in range(repeat):
+        start = timeit.default_timer()
+        render(options, target, cold=True)
+        cold.append(timeit.default_timer() - start)
+
+    seconds, stages = [], {}
+    for index in range(repeat):
+        with timing.collect() as stats:
+            start = timeit.default_timer()
+            backend = render(options, target)
+            seconds.append(timeit.default_timer() - start)
+        report = stats.report()
+        for path, calls, elapsed in report['spans']:
+            stages.setdefault(path, []).append(elapsed)
+
+    # Measure memory separately, since tracemalloc slows down the code it traces
+    tracemalloc.start()
+    try:
+        render(options, target, cold=True)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    total = float(np.median(seconds))
+    counters = report['counters']
+    return OrderedDict([
+        ('seconds', round(total, 6)),
+        ('cold_seconds', round(float(np.median(cold)), 6)),
+        ('points_per_second', round(counters.get('points', 0) / total) if total else 0),
+        ('peak_mb', round(peak / 2 ** 20, 3)),
+        ('stages', OrderedDict((path, round(float(np.median(vals)), 6))
+                               for path, vals in stages.items())),
+        ('counters', counters),
+        ('calls', OrderedDict(sorted(backend.calls.items()))),
+    ])
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    '''Print how results changed from the baseline. Return the number of regressions'''
+    regressions = 0
+    print('\n%-36s %9s %9s %9s' % ('Change from baseline', 'time', 'cold', 'memory'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print('%-36s %9s' % (name, 'new'))
+            continue
+        time = result['seconds'] / base['seconds'] - 1 if base['seconds'] else 0
+        base_cold = base.get('cold_seconds', 0)
+        cold = result['cold_seconds'] / base_cold - 1 if base_cold else 0
+        memory = result['peak_mb'] / base['peak_mb'] - 1 if base['peak_mb'] else 0
+        problems = []
+        if time > threshold and result['seconds'] - base['seconds'] > MIN_SECONDS:
+            problems.append('slower')
+        if cold > threshold and result['cold_seconds'] - base_cold > MIN_SECONDS:
+            problems.append('slower cold')
+        if memory > threshold:
+            problems.append('more memory')
+        if result['calls'] != base['calls']:
+            problems.append('calls changed')
+        regressions += 1 if problems else 0
+        print(('%-36s %+8.0f%% %+8.0f%% %+8.0f%%  %s' % (
+            name, time * 100, cold * 100, memory * 100, ', '.join(problems))).rstrip())
+    return regressions
+
+
+def main(args):
+    cases = []
+    if args.maps:
+        cases += map_cases(args.maps)
+    if args.yaml:
+        rename = shape.parse_filters(args.rename)
+        cases += yaml_cases(args.yaml, args.topo, {
+            key: val.pop() for key, val in rename.items()})
+    cases = [(name, options) for name, options in cases if args.k in name]
+
+    results = OrderedDict()
+    stages = Counter()
+    target = tempfile.mkdtemp()
+    print('%-36s %9s %9s %12s %9s %7s %7s' % ('Case', 'seconds', 'cold', 'points/sec',
+                                              'peak MB', 'shapes', 'calls'))
+    try:
+        for name, options in cases:
+            result = results[name] = run(options, target, args.repeat)
+            stages.update(result['stages'])
+            print('%-36s %9.3f %9.3f %12.0f %9.1f %7d %7d' % (
+                name, result['seconds'], result['cold_seconds'], result['points_per_second'],
+                result['peak_mb'],
+                result['counters'].get('shapes', 0), sum(result['calls'].values())))
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+
+    total = sum(result['seconds'] for result in results.values())
+    print('\n%-36s %9.3f' % ('Total (%d cases)' % len(results), total))
+    for path, seconds in stages.most_common():
+        print('  %-34s %9.3f %8.1f%%' % (path, seconds, seconds / total * 100 if total else 0))
+
+    if args.save:
+        with io.open(args.baseline, 'w', encoding='utf-8') as handle:
+            handle.write(json.dumps(results, indent=2))
+        print('Saved baseline as', args.baseline)
+    elif os.path.exists(args.baseline):
+        with io.open(args.baseline, encoding='utf-8') as handle:
+            regressions = compare(results, json.load(handle), args.threshold)
+        if regressions:
+            print('%d cases regressed more than %.0f%%' % (regressions, args.threshold * 100))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-m', '--maps', help='Folder of TopoJSON files to benchmark',
+                        default=os.path.join(folder, 'maps'))
+    parser.add_argument('-y', '--yaml', help='shape.py YAML config whose maps to benchmark',
+                        default=os.path.join(folder, 'shopify-districts.yaml'))
+    parser.add_argument('-t', '--topo', help='TopoJSON file to use if the YAML one is missing',
+                        default=os.path.join(folder, 'maps', 'IND_adm2.json'))
+    parser.add_argument('--rename', help='Columns to rename for --topo (col=COL,...)',
+                        default='STATE_NAME=NAME_1,DISTRICT=NAME_2')
+    parser.add_argument('-k', help='Only run cases whose name contains this', default='')
+    parser.add_argument('-r', '--repeat', help='Number of timed runs per case',
+                        type=int, default=REPEAT)
+    parser.add_argument('-b', '--baseline', help='Baseline results file',
+                        default=os.path.join(folder, 'benchmark.json'))
+    parser.add_argument('--save', help='Save results as the baseline', action='store_true')
+    parser.add_argument('--threshold', help='Fraction by which time or memory may grow',
+                        type=float, default=THRESHOLD)
+    sys.exit(main(parser.parse_args()))
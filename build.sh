@@ -1,10 +1,6 @@
 # Convert shape files into other formats
 
 SOURCE=/d/site/gramener.com/viz/maps/data/
-TOPOJSON=D:/node_modules/topojson/bin/topojson
-
-# Huge SHP files require more memory from node.js
-# OPTIONS=--max_old_space_size=900
 
 # The below paths are no longer used.
 # OGR2OGR=/c/Program\ Files\ \(x86\)/Quantum\ GIS\ Lisboa/bin/ogr2ogr.exe
@@ -15,10 +11,9 @@ TOPOJSON=D:/node_modules/topojson/bin/topojson
 function topojson_pc {
     for shape in `find $SOURCE -name '*_PC.shp'`
     do
-        SRC=`cygpath -aw $shape`
         OUT="maps/`basename $shape`"
         OUT="${OUT%.*}".json
-        node $OPTIONS $TOPOJSON \
+        python shp2topo.py \
             -p ST_CODE \
             -p PC_NO \
             -p ST_NAME \
@@ -28,7 +23,7 @@ function topojson_pc {
             --simplify-proportion 0.15 \
             --quantization 10000 \
             --out $OUT \
-            $SRC
+            $shape
     done
 }
 
@@ -36,10 +31,9 @@ function topojson_pc {
 function topojson_ac {
     for shape in `find $SOURCE -name '*_AC.shp'`
     do
-        SRC=`cygpath -aw $shape`
         OUT="maps/`basename $shape`"
         OUT="${OUT%.*}".json
-        node $OPTIONS $TOPOJSON \
+        python shp2topo.py \
             -p ST_CODE \
             -p PC_NO \
             -p AC_NO \
@@ -49,7 +43,7 @@ function topojson_ac {
             --simplify-proportion 0.15 \
             --quantization 10000 \
             --out $OUT \
-            $SRC
+            $shape
     done
 }
 
@@ -57,15 +51,13 @@ function topojson_ac {
 function topojson_adm {
     for shape in `find $SOURCE -name 'IND_adm*.shp'`
     do
-        SRC=`cygpath -aw $shape`
         OUT="maps/`basename $shape`"
         OUT="${OUT%.*}".json
-        node $OPTIONS $TOPOJSON \
-            -p \
+        python shp2topo.py \
             --simplify-proportion 0.15 \
             --quantization 10000 \
             --out $OUT \
-            $SRC
+            $shape
     done
 }
 
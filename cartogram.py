@@ -0,0 +1,156 @@
+'''
+Distorts TopoJSON arcs into a continuous area cartogram.
+
+This is a NumPy port of cartogram.js, which implements Dougenik, Chrisman &
+Niemeyer (1985), An Algorithm to Construct Continuous Area Cartograms:
+http://chrisman.scg.ulaval.ca/G360/dougenik.pdf
+
+Each iteration computes every feature's area and centroid, then moves every
+point by the sum of the forces from all features. A feature's force fades to
+0 between ``cutoff / 2`` and ``cutoff`` radii from its centroid, and farther
+points are ignored, which makes large maps tractable.
+'''
+from __future__ import unicode_literals
+
+import math
+import numpy as np
+import topology
+
+ITERATIONS = 8          # Maximum number of iterations, as in cartogram.js
+CUTOFF = 10             # Ignore features farther than this many radii. None uses all
+CHUNK = 4096            # Number of points to compute forces for at a time
+
+
+def cartogram(coords, offsets, topo, geoms, values, iterations=ITERATIONS, cutoff=CUTOFF,
+              target=1.0):
+    '''
+    Return a copy of the projected arc co-ordinates ``coords`` (with arc
+    ``offsets``, see topology.decode_arcs) of a Topology, distorted so that the
+    area of each geometry index in ``geoms`` is proportional to its entry in
+    ``values``.
+
+    Only the points of arcs used by geoms move. Stops after ``iterations``, or
+    when the mean ratio of actual to desired area reaches ``target``.
+    '''
+    coords = np.array(coords, dtype=float)
+    points, ring_offsets, ring_geom, _ = topology.rings(topo, geoms, offsets)
+    values = np.nan_to_num(np.asarray(values, dtype=float))
+    values[values < 0] = 0
+    total_value = values.sum()
+    # Geometries without rings (e.g. lines) have no area, and exert no force
+    has_area = np.bincount(ring_geom, minlength=len(geoms)) > 0
+    if not len(points) or total_value <= 0:
+        return coords
+    moving = np.unique(points)
+
+    for iteration in range(iterations):
+        area, centroid = areas(coords, points, ring_offsets, ring_geom, len(geoms))
+        total_area = area.sum()
+        tiny = total_area * 1e-12
+        desired = total_area * values / total_value
+        radius = np.sqrt(area / math.pi)
+        mass = np.where(has_area, np.sqrt(desired / math.pi) - radius, 0)
+        size_error = (np.maximum(area, desired) + tiny) / (np.minimum(area, desired) + tiny)
+        size_error = size_error[has_area].mean()
+        force_reduction = 1 / (1 + size_error)
+        reach = None if cutoff is None else cutoff * radius
+        coords[moving] += force_reduction * forces(coords[moving], centroid, radius, mass, reach)
+        if size_error <= target:
+            break
+    return coords
+
+
+def areas(coords, points, ring_offsets, ring_geom, count):
+    '''
+    Return the (unsigned) area and the centroid of each of ``count`` geometries,
+    given rings as point indices (see topology.rings).
+    '''
+    xy = coords[points]
+    ring = np.repeat(np.arange(len(ring_offsets) - 1), np.diff(ring_offsets))
+    # Index of the next point in each ring, wrapping around at the end
+    following = np.arange(len(points)) + 1
+    following[ring_offsets[1:] - 1] = ring_offsets[:-1]
+    nxt = xy[following]
+    cross = xy[:, 0] * nxt[:, 1] - nxt[:, 0] * xy[:, 1]
+    # Sum over rings of each geometry. Holes wind the other way, so their area subtracts
+    geom = ring_geom[ring]
+    area2 = np.bincount(geom, cross, minlength=count)
+    cx = np.bincount(geom, (xy[:, 0] + nxt[:, 0]) * cross, minlength=count)
+    cy = np.bincount(geom, (xy[:, 1] + nxt[:, 1]) * cross, minlength=count)
+    # Geometries with no area use the mean of their points as the centroid
+    size = np.bincount(geom, minlength=count)
+    mean = np.column_stack([
+        np.bincount(geom, xy[:, 0], minlength=count),
+        np.bincount(geom, xy[:, 1], minlength=count)]) / np.maximum(size, 1)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroid = np.column_stack([cx, cy]) / (3 * area2[:, None])
+    centroid = np.where((area2 != 0)[:, None], centroid, mean)
+    return np.abs(area2) / 2, centroid
+
+
+def forces(points, centroid, radius, mass, reach=None):
+    '''
+    Return the displacement of each point due to every feature's force. Feature
+    ``j`` pushes points away from ``centroid[j]`` (or pulls, if ``mass[j]`` is
+    negative). If ``reach`` is given, feature j's force fades smoothly from
+    reach[j] / 2 to 0 at reach[j], and it ignores points beyond.
+    '''
+    delta = np.zeros_like(points)
+    # Pairs at 0 distance, or with features of no size, exert no force
+    limit = np.where(radius > 0, np.inf if reach is None else reach, 0) ** 2
+    for start in range(0, len(points), CHUNK):
+        chunk = points[start:start + CHUNK]
+        pi, fj = pairs(chunk, centroid, reach)
+        # Drop pairs out of reach before looking up anything else
+        dx = chunk[:, 0][pi] - centroid[:, 0][fj]
+        dy = chunk[:, 1][pi] - centroid[:, 1][fj]
+        dist = dx * dx + dy * dy
+        valid = np.flatnonzero((dist > 0) & (dist < limit[fj]))
+        dx, dy, dist, pi, fj = dx[valid], dy[valid], np.sqrt(dist[valid]), pi[valid], fj[valid]
+        r, m = radius[fj], mass[fj]
+        ratio = dist / r
+        force = np.where(ratio > 1, m / ratio, m * ratio ** 2 * (4 - 3 * ratio))
+        if reach is not None:
+            # Smoothstep down to 0 at reach, so the force does not jump at the cutoff
+            fade = np.clip(2 * dist / reach[fj] - 1, 0, 1)
+            force *= 1 - fade * fade * (3 - 2 * fade)
+        force /= dist
+        delta[start:start + len(chunk), 0] = np.bincount(pi, dx * force, minlength=len(chunk))
+        delta[start:start + len(chunk), 1] = np.bincount(pi, dy * force, minlength=len(chunk))
+    return delta
+
+
+def pairs(points, centroid, reach=None):
+    '''
+    Return (point, feature) index arrays of candidate pairs. Without reach, all
+    pairs. Else, only features whose centroid lies in a grid cell next to the
+    point. Features are binned by reach into powers of sqrt(2), each with its own
+    grid whose cell size is the largest reach in the bin. So a small feature is
+    not paired with every point a large feature reaches.
+    '''
+    if reach is None:
+        pi = np.repeat(np.arange(len(points)), len(centroid))
+        return pi, np.tile(np.arange(len(centroid)), len(points))
+    features = np.flatnonzero(reach > 0)
+    level = np.floor(2 * np.log2(reach[features])).astype(np.intp)
+    result_p, result_f = [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=np.intp)]
+    for value in np.unique(level).tolist():
+        members = features[level == value]
+        cell = reach[members].max()
+        fcell = np.floor(centroid[members] / cell).astype(np.int64)
+        pcell = np.floor(points / cell).astype(np.int64)
+        low = np.minimum(fcell.min(axis=0), pcell.min(axis=0)) - 1
+        size = np.maximum(fcell.max(axis=0), pcell.max(axis=0)) - low + 2
+        fkey = (fcell[:, 0] - low[0]) * size[1] + (fcell[:, 1] - low[1])
+        order = np.argsort(fkey, kind='stable')
+        fkey = fkey[order]
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                key = (pcell[:, 0] + dx - low[0]) * size[1] + (pcell[:, 1] + dy - low[1])
+                lo = np.searchsorted(fkey, key, 'left')
+                count = np.searchsorted(fkey, key, 'right') - lo
+                first = np.cumsum(count) - count
+                index = np.repeat(lo - first, count) + np.arange(count.sum())
+                result_p.append(np.repeat(np.arange(len(points)), count))
+                result_f.append(members[order[index]])
+    return np.concatenate(result_p), np.concatenate(result_f)
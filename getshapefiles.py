@@ -1,23 +1,29 @@
 import os
+import time
 import glob
 import logging
 import requests
 import lxml.html
-import subprocess
-from six.moves.urllib.request import urlretrieve
+import multiprocessing
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
 from zipfile import ZipFile, BadZipfile
 import shape
-import shlex
+import shp2topo
 import argparse
 
 
-class JSONFileObject(object):
-    encoding = 'utf-8'
-    file = []
-    key = []
+GADM_PAGE_URL = 'http://www.gadm.org/country'
+GADM_SHP_URL = 'http://biogeo.ucdavis.edu/data/gadm2.8/shp/'
+JOBS = 8                # Number of files to download at a time
+RETRIES = 5             # Number of times to retry a failed download
+BACKOFF = 1             # Seconds to wait before the first retry. This doubles every retry
+TIMEOUT = 60            # Seconds to wait for the server to respond
+CHUNK_SIZE = 1 << 16    # Bytes to write at a time
 
 
-def gadm_download_files(target, limit=None):
+def gadm_download_files(target, limit=None, jobs=JOBS, page_url=GADM_PAGE_URL,
+                        shp_url=GADM_SHP_URL):
     '''
     Download the shape files from gadm into target folder with the following
     structure:
@@ -25,34 +31,108 @@ def gadm_download_files(target, limit=None):
     - `/target/zipfiles` stores the downloaded ZIP files
     - `/target/AFG_adm_shp/` stores the topojson files for AFG_ADM.shp
     - `/target/...` etc
+
+    Downloads ``jobs`` files at a time, and yields the path of each valid ZIP
+    file as soon as it is downloaded. Files that fail to download are logged
+    and skipped.
     '''
-    gadm_page_url = 'http://www.gadm.org/country'
     zip_dir = os.path.join(target, 'gadmzips/zipfiles')
     if not os.path.exists(zip_dir):
         os.makedirs(zip_dir)
 
-    response = requests.get(gadm_page_url)
+    session = http_session(jobs)
+    response = session.get(page_url, timeout=TIMEOUT)
     tree = lxml.html.fromstring(response.content)
     country_codes = tree.xpath('//select[@name="cnt"]/option')
     if limit is not None:
         country_codes = country_codes[:limit]
 
+    todo = []
     for country_code in country_codes:
         option_value = country_code.get('value')
         if option_value is None:
             logging.warn('Skipping %s', lxml.html.tostring(country_code))
             continue
-        raw_file_name = option_value.split('_')[0] + '_adm_shp'
-        zip_name = raw_file_name + '.zip'
-        zip_path = os.path.join(zip_dir, zip_name)
-        if not os.path.exists(zip_path):
-            logging.info('%s: downloading', zip_name)
-            urlretrieve(
-                'http://biogeo.ucdavis.edu/data/gadm2.8/shp/' +
-                zip_name, zip_path)
-        else:
-            logging.info('%s: downloaded', zip_name)
-        yield zip_path
+        zip_name = option_value.split('_')[0] + '_adm_shp.zip'
+        todo.append((session, shp_url + zip_name, os.path.join(zip_dir, zip_name)))
+
+    pool = ThreadPool(max(min(jobs, len(todo)), 1))
+    try:
+        # Yield each file as it completes, so a slow download does not hold up the rest
+        for zip_path in pool.imap_unordered(fetch, todo):
+            if zip_path is not None:
+                yield zip_path
+    finally:
+        pool.terminate()
+
+
+def http_session(jobs=JOBS):
+    '''Return a requests session that keeps up to ``jobs`` connections per host open'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch(args):
+    '''Download (session, url, path) unless path is a valid ZIP file. Returns path or None'''
+    session, url, path = args
+    name = os.path.basename(path)
+    if os.path.exists(path):
+        if valid_zip(path):
+            logging.info('%s: downloaded', name)
+            return path
+        # Resume a file left truncated by older versions
+        os.rename(path, path + '.part')
+    logging.info('%s: downloading', name)
+    try:
+        return download(session, url, path)
+    except IOError as e:
+        logging.error('%s: %s', name, e)
+
+
+def download(session, url, path, retries=RETRIES, backoff=BACKOFF):
+    '''
+    Download url into path via a .part file. A partial download is resumed with
+    an HTTP Range request. The file is moved to path only if it is a valid ZIP.
+    Failures are retried ``retries`` times, waiting ``backoff`` seconds, then
+    twice as long each time.
+    '''
+    part = path + '.part'
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        size = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': 'bytes=%d-' % size} if size else {}
+        try:
+            with closing(session.get(url, headers=headers, stream=True,
+                                     timeout=TIMEOUT)) as response:
+                # 416 means there is nothing after the part we have. Else append the
+                # rest, or restart if the server ignored the Range
+                if response.status_code != 416:
+                    response.raise_for_status()
+                    with open(part, 'ab' if response.status_code == 206 else 'wb') as handle:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            handle.write(chunk)
+        except (requests.RequestException, IOError) as e:
+            logging.warning('%s: attempt %d failed: %s', url, attempt + 1, e)
+            continue
+        if valid_zip(part):
+            os.replace(part, path)
+            return path
+        logging.warning('%s: attempt %d failed: invalid ZIP file', url, attempt + 1)
+        os.unlink(part)
+    raise IOError('Could not download %s' % url)
+
+
+def valid_zip(path):
+    '''Return True if path is a ZIP file whose members all match their CRC'''
+    try:
+        with ZipFile(path) as handle:
+            return handle.testzip() is None
+    except (BadZipfile, IOError):
+        return False
 
 
 def unzip_gadm_file(zip_path):
@@ -70,38 +150,48 @@ def unzip_gadm_file(zip_path):
         try:
             ZipFile(zip_path).extractall(shapefile_dir)
         except BadZipfile as e:
-            logging.info('%s : %s', shapefile_dir, e._str_())
+            logging.info('%s : %s', shapefile_dir, e)
     return shapefile_dir
 
 
 def create_topojson(shp_dir, json_obj):
     '''
-    Generate topojson files using shape files.
-    It passes the topojson files to external file named 'shape.py'
-    to generate excel-maps using these files.
+    Generate topojson files from the shape files in shp_dir with shp2topo.
+    Then render each into an Excel map with shape.main(), using this process's
+    backend (see shape.init_worker).
     '''
     for shapefile_path in glob.glob(os.path.join(shp_dir, '*.shp')):
         subdir, shapefile_name = os.path.split(os.path.abspath(shapefile_path))
         json_file = os.path.basename(shapefile_name) + '.json'
         excel_file_name = json_file.split('.')[0] + '.xlsm'
-        if not os.path.exists(os.path.join(subdir, json_file)):
+        json_path = os.path.join(subdir, json_file)
+        if not os.path.exists(json_path):
             logging.info('%s: creating', json_file)
-            cmd = 'topojson ' + shapefile_name + ' -o ' + json_file
-            process = subprocess.Popen(
-                shlex.split(cmd),
-                cwd=subdir, shell=True)
-            process.wait()
+            shp2topo.convert(shapefile_path, json_path)
         else:
             logging.info('%s: exists', json_file)
         if not os.path.exists(os.path.join(subdir, excel_file_name)):
             logging.info('%s: creating', excel_file_name)
-            json_obj.file = [os.path.join(subdir, json_file)]
+            json_obj.topo = json_path
+            json_obj.out = os.path.join(subdir, json_file.split('.')[0])
             # creating maps on excel sheet
-            shape.main(json_obj)
+            shape.main(shape.worker['backend'], json_obj)
         else:
             logging.info('%s: exists', excel_file_name)
 
 
+def convert_gadm_file(zip_path):
+    '''Unzip a GADM ZIP file, then convert and render its shape files'''
+    create_topojson(unzip_gadm_file(zip_path), shape.parser.parse_args([]))
+    return zip_path
+
+
+def convert_folder(shp_dir):
+    '''Convert and render the shape files in shp_dir'''
+    create_topojson(shp_dir, shape.parser.parse_args([]))
+    return shp_dir
+
+
 if __name__ == '__main__':
     # setting up logging level
     logging.basicConfig(level=logging.INFO)
@@ -118,20 +208,44 @@ if __name__ == '__main__':
         '--directory',
         help='directory path inside where zipfiles should be downloaded',
         default=os.getcwd())
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='number of files to download at a time',
+        type=int,
+        default=JOBS)
+    parser.add_argument(
+        '-p',
+        '--processes',
+        help='number of countries or folders to convert and render at a time',
+        type=int,
+        default=multiprocessing.cpu_count())
+    parser.add_argument(
+        '-b',
+        '--backend',
+        help='shape.py backend to render maps with (excel|xlsx)',
+        choices=sorted(shape.backends),
+        default='excel')
 
     args = parser.parse_args()
 
-    # Object for shape module working
-    json_obj = JSONFileObject()
-
+    # Each process unzips, converts and renders a country (or folder) at a time, with its
+    # own backend. The pool takes the next country as soon as it is downloaded, so
+    # downloads, conversions and rendering overlap
+    pool = multiprocessing.Pool(args.processes, initializer=shape.init_worker,
+                                initargs=(args.backend, False))
     if args.source == 'gadm':
         logging.info('%s: creating directory structure', args.directory)
-        for zip_path in gadm_download_files(target=os.path.abspath(args.directory),
-                                            limit=None):
-            shapefile_dir = unzip_gadm_file(zip_path)
-            create_topojson(shapefile_dir, json_obj)
+        done = pool.imap_unordered(convert_gadm_file, gadm_download_files(
+            target=os.path.abspath(args.directory), limit=None, jobs=args.jobs))
     elif args.source == 'datameet':
         # datameet, we have already downloaded
         target = os.path.abspath('datameet/maps')
-        for dpath, dname, fname in os.walk(target):
-            create_topojson(dpath, json_obj)
+        done = pool.imap_unordered(
+            convert_folder, [dpath for dpath, dname, fname in os.walk(target)])
+    else:
+        done = []
+    for path in done:
+        logging.info('%s: done', path)
+    pool.close()
+    pool.join()
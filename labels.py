@@ -0,0 +1,156 @@
+'''
+Places map labels inside their features, without overlapping each other.
+
+Each feature's label goes at its area-weighted centroid if that lies inside the
+feature. Otherwise (e.g. for concave or multi-part features) it goes at the
+feature's pole of inaccessibility: the interior point farthest from its edges,
+found by the polylabel algorithm (https://github.com/mapbox/polylabel).
+
+Labels are then placed largest feature first. A label that overlaps one already
+placed is nudged around its anchor (staying inside its feature), and dropped if
+it still does not fit.
+Placed labels are kept in a grid of label-sized cells, so each check only
+looks at neighbouring cells.
+'''
+from __future__ import division, unicode_literals
+
+import numpy as np
+import topology
+from cartogram import areas
+
+PRECISION = 1           # Find poles of inaccessibility to within this distance
+CHUNK = 1 << 20         # Maximum number of (point, edge) pairs to compute at a time
+# Positions to try for a label, in label widths and heights from its anchor
+NUDGES = ((0, 0), (0, -1), (0, 1), (-0.5, 0), (0.5, 0))
+
+
+def place(coords, offsets, topo, geoms, width, height, precision=PRECISION, nudges=NUDGES):
+    '''
+    Return (positions, placed) for labels of the geometry indices geoms of a
+    Topology, given arc co-ordinates coords (with arc offsets): the centre of
+    each width x height label, and whether it was placed. A label may only be
+    nudged to positions that are still inside its feature.
+    '''
+    points, ring_offsets, ring_geom, _ = topology.rings(topo, geoms, offsets)
+    area, centroid = areas(coords, points, ring_offsets, ring_geom, len(geoms))
+    edges, edge_geom = ring_edges(coords[points], ring_offsets, ring_geom)
+    # Anchor at the centroid if it is inside the feature. Else, at the pole of inaccessibility
+    anchor = centroid.copy()
+    inside = parity(anchor, edges, edge_geom, len(geoms))
+    order = np.argsort(edge_geom, kind='stable')
+    starts = np.searchsorted(edge_geom[order], np.arange(len(geoms) + 1))
+    for index in np.flatnonzero(~inside & (area > 0)):
+        anchor[index] = polylabel(edges[order[starts[index]:starts[index + 1]]], precision)
+    # Features without area are not labelled
+    anchor[area <= 0] = np.nan
+
+    candidates = anchor[:, None, :] + np.array(nudges) * (width, height)
+    valid = np.column_stack([np.ones(len(geoms), dtype=bool)] + [
+        parity(candidates[:, index], edges, edge_geom, len(geoms))
+        for index in range(1, len(nudges))])
+    return declutter(candidates, valid, width, height, area)
+
+
+def parity(points, edges, edge_geom, count):
+    '''Return whether each of count points lies inside the edges of its geometry'''
+    hits = crosses(points[edge_geom], edges)
+    return np.bincount(edge_geom, hits, minlength=count) % 2 == 1
+
+
+def ring_edges(xy, ring_offsets, ring_geom):
+    '''
+    Return the edges (x0, y0, x1, y1) of rings given as consecutive points xy,
+    and the geometry of each edge
+    '''
+    following = np.arange(len(xy)) + 1
+    following[ring_offsets[1:] - 1] = ring_offsets[:-1]
+    ring = np.repeat(np.arange(len(ring_offsets) - 1), np.diff(ring_offsets))
+    return np.hstack([xy, xy[following]]), ring_geom[ring]
+
+
+def crosses(points, edges):
+    '''
+    Return whether a ray from each point to the right crosses the matching edge.
+    A point is inside a polygon if it crosses an odd number of its edges.
+    '''
+    x, y = points[..., 0], points[..., 1]
+    x0, y0, x1, y1 = edges[..., 0], edges[..., 1], edges[..., 2], edges[..., 3]
+    straddle = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cross = x0 + (y - y0) / (y1 - y0) * (x1 - x0)
+    return straddle & (x < cross)
+
+
+def distance(points, edges):
+    '''
+    Return the signed distance from each point to the polygon with these edges:
+    positive inside, negative outside
+    '''
+    result = np.empty(len(points))
+    step = max(CHUNK // max(len(edges), 1), 1)
+    for start in range(0, len(points), step):
+        pts = points[start:start + step, None, :]
+        inside = crosses(pts, edges[None]).sum(axis=1) % 2 == 1
+        seg = edges[None, :, 2:] - edges[None, :, :2]
+        length = (seg ** 2).sum(axis=2)
+        t = ((pts - edges[None, :, :2]) * seg).sum(axis=2) / np.where(length > 0, length, 1)
+        near = edges[None, :, :2] + np.clip(t, 0, 1)[:, :, None] * seg
+        dist = np.sqrt(((pts - near) ** 2).sum(axis=2).min(axis=1))
+        result[start:start + step] = np.where(inside, dist, -dist)
+    return result
+
+
+def polylabel(edges, precision=PRECISION):
+    '''
+    Return the pole of inaccessibility of the polygon with these edges: the
+    interior point farthest from any edge, to within precision. Like polylabel,
+    but it refines all promising cells of a size together.
+    '''
+    low = edges[:, :2].min(axis=0)
+    high = edges[:, :2].max(axis=0)
+    size = (high - low).min()
+    if size <= 0:
+        return low
+    # Start from the bounding box centre. Cells are squares of half-size h
+    h = size / 2
+    nx, ny = np.ceil((high - low) / size).astype(int)
+    cells = low + size * (np.stack(np.mgrid[0:nx, 0:ny], axis=-1).reshape(-1, 2) + 0.5)
+    best = (low + high) / 2
+    best_dist = distance(best[None], edges)[0]
+    while len(cells):
+        dist = distance(cells, edges)
+        top = dist.argmax()
+        if dist[top] > best_dist:
+            best, best_dist = cells[top], dist[top]
+        # Split cells that may hold a point farther than the best, into 4
+        cells = cells[dist + h * np.sqrt(2) > best_dist + precision]
+        if h <= precision / 2:
+            break
+        h /= 2
+        cells = (cells[:, None, :] + h * np.array([[-1, -1], [-1, 1], [1, -1], [1, 1]]))
+        cells = cells.reshape(-1, 2)
+    return best
+
+
+def declutter(candidates, valid, width, height, priority):
+    '''
+    Return (positions, placed) for width x height labels, given an (n, k, 2)
+    array of candidate centres for each label and which of them are valid.
+    Labels are placed in descending priority, at their first valid candidate
+    that does not overlap a label placed earlier.
+    '''
+    positions = np.full((len(candidates), 2), np.nan)
+    placed = np.zeros(len(candidates), dtype=bool)
+    valid = valid & ~np.isnan(candidates).any(axis=2)
+    grid = {}
+    for index in np.argsort(-np.asarray(priority), kind='stable').tolist():
+        for x, y in candidates[index][valid[index]].tolist():
+            i, j = int(np.floor(x / width)), int(np.floor(y / height))
+            if not any(abs(x - ox) < width and abs(y - oy) < height
+                       for di in (-1, 0, 1) for dj in (-1, 0, 1)
+                       for ox, oy in grid.get((i + di, j + dj), ())):
+                grid.setdefault((i, j), []).append((x, y))
+                positions[index] = x, y
+                placed[index] = True
+                break
+    return positions, placed
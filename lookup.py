@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+'''
+Finds the feature of a TopoJSON file that each (longitude, latitude) point lies in.
+
+For example, to assign stores or customers to districts before filling a map's
+Value column. Points and arcs are projected with shape.projection, as on the map.
+
+The map is cut into horizontal bands. Each band holds the edges of every ring that
+span its y-range. A point is inside a feature if a ray from it to the right crosses
+an odd number of the feature's edges. All those edges lie in the point's band, so
+each point is tested against just one band, in chunks of points at a time.
+
+    python lookup.py -t maps/IND_adm2.json -k NAME_1,NAME_2 stores.csv out.csv
+'''
+from __future__ import print_function, unicode_literals, division
+
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+import shape
+import labels
+import topology
+
+BAND_EDGES = 32         # Average number of edges per band
+CHUNK = 1 << 20         # Maximum number of (point, edge) pairs to test at a time
+CHUNK_ROWS = 100000     # Number of CSV rows to read at a time
+
+
+class Lookup(object):
+    '''
+    Index of the selected features of a TopoJSON file, to find which feature
+    points lie in. ``ids`` has the ID of each feature, as shape.add_cols sets
+    it from the key columns.
+    '''
+    def __init__(self, path, key='', filters='', encoding='utf-8', band_edges=BAND_EDGES):
+        topo = shape.load_topojson(path, encoding)
+        shape.apply_filters(topo, filters)
+        shape.add_cols(topo, [], key)
+        self.ids = topo.strings('ID')
+
+        coords, offsets = shape.project(topo)
+        points, ring_offsets, ring_geom, _ = topology.rings(topo, topo.selected, offsets)
+        edges, edge_geom = labels.ring_edges(coords[points], ring_offsets, ring_geom)
+        # Horizontal edges are never crossed by a horizontal ray
+        keep = edges[:, 1] != edges[:, 3]
+        edges, edge_geom = edges[keep], edge_geom[keep]
+
+        # Band i spans y from low + i * height to low + (i + 1) * height
+        low = np.minimum(edges[:, 1], edges[:, 3])
+        high = np.maximum(edges[:, 1], edges[:, 3])
+        self.bands = max(len(edges) // band_edges, 1)
+        self.low = low.min() if len(edges) else 0.0
+        self.height = ((high.max() - self.low) / self.bands if len(edges) else 0.0) or 1.0
+        # Add each edge to every band its y-range overlaps
+        first, last = self.band(low), self.band(high)
+        band, owner = topology.ranges(first, last + 1)
+        order = np.argsort(band, kind='stable')
+        self.offsets = np.searchsorted(band[order], np.arange(self.bands + 1))
+        self.edges, self.edge_geom = edges[owner[order]], edge_geom[owner[order]]
+
+    def band(self, y):
+        '''Return the band index of each y, clipped to the bands'''
+        return np.clip(np.floor((y - self.low) / self.height), 0, self.bands - 1).astype(np.intp)
+
+    def find(self, lon, lat):
+        '''
+        Return the index (into ids) of the feature each (lon, lat) point lies in,
+        or -1 if none. If features overlap, the first one is returned.
+        '''
+        x, y = shape.projection(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        xy = np.column_stack([np.ravel(x), np.ravel(y)])
+        result = np.full(len(xy), -1, dtype=np.intp)
+        y, top = xy[:, 1], self.low + self.height * self.bands
+        # Skip points outside the map (or NaN), then group points by band
+        valid = np.flatnonzero((y >= self.low) & (y <= top))
+        band = self.band(y[valid])
+        order = np.argsort(band, kind='stable')
+        valid = valid[order]
+        starts = np.searchsorted(band[order], np.arange(self.bands + 1))
+        for index in np.flatnonzero(np.diff(starts)).tolist():
+            edges = self.edges[self.offsets[index]:self.offsets[index + 1]]
+            geoms = self.edge_geom[self.offsets[index]:self.offsets[index + 1]]
+            step = max(CHUNK // max(len(edges), 1), 1)
+            for start in range(starts[index], starts[index + 1], step):
+                rows = valid[start:min(start + step, starts[index + 1])]
+                hit, edge = np.nonzero(labels.crosses(xy[rows, None, :], edges[None]))
+                # Points are inside features whose edges they cross an odd number of times
+                keys, counts = np.unique(hit * len(self.ids) + geoms[edge], return_counts=True)
+                keys = keys[counts % 2 == 1][::-1]
+                # Keys are sorted. Assign in reverse, so the first feature wins
+                result[rows[keys // len(self.ids)]] = keys % len(self.ids)
+        return result
+
+    def lookup(self, lon, lat, default=''):
+        '''Return the ID of the feature each (lon, lat) point lies in, or default'''
+        ids = np.array(self.ids + [default], dtype=object)
+        return ids[self.find(lon, lat)].tolist()
+
+
+def lookup_csv(index, source, target, lon='lon', lat='lat', col='ID', chunk_rows=CHUNK_ROWS):
+    '''
+    Copy a CSV file from source to target (paths or file objects), adding a col
+    column with the ID of the feature each row's lon, lat columns lie in. Reads
+    chunk_rows rows at a time, and leaves other values as they are.
+    '''
+    reader = pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunk_rows)
+    count = found = 0
+    for number, data in enumerate(reader):
+        ids = index.find(pd.to_numeric(data[lon], errors='coerce').values,
+                         pd.to_numeric(data[lat], errors='coerce').values)
+        data[col] = np.array(index.ids + [''], dtype=object)[ids]
+        data.to_csv(target, mode='a' if number else 'w', header=not number, index=False)
+        count, found = count + len(data), found + int((ids >= 0).sum())
+    return count, found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('source', help='CSV file with longitude and latitude columns')
+    parser.add_argument('target', help='CSV file to save, with an ID column. "-" to print',
+                        nargs='?', default='-')
+    parser.add_argument('-t', '--topo', help='TopoJSON file', required=True)
+    parser.add_argument('-k', '--key', help='Columns to use as keys (comma-separated)', default='')
+    parser.add_argument('-f', '--filters', help='Filters (col=VAL,col=VAL,...)', default='')
+    parser.add_argument('-e', '--enc', help='Topojson encoding', default='utf-8')
+    parser.add_argument('--lon', help='Longitude column', default='lon')
+    parser.add_argument('--lat', help='Latitude column', default='lat')
+    parser.add_argument('--col', help='Column to save the ID in', default='ID')
+    args = parser.parse_args()
+
+    index = Lookup(args.topo, args.key, args.filters, args.enc)
+    target = sys.stdout if args.target == '-' else args.target
+    count, found = lookup_csv(index, args.source, target, args.lon, args.lat, args.col)
+    print('Found %d of %d points' % (found, count), file=sys.stderr)
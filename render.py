@@ -0,0 +1,213 @@
+'''
+Renders map shapes and labels as PNG or SVG images, without Office.
+
+Backends add each freeform shape to a Picture as they draw it. The PNG is
+rasterised with a vectorised even-odd scanline fill, anti-aliased by
+supersampling, and encoded with zlib. Labels use a small built-in bitmap font.
+'''
+from __future__ import division, unicode_literals
+
+import zlib
+import struct
+import unicodedata
+import numpy as np
+from xml.sax.saxutils import escape, quoteattr
+import topology
+
+SCALE = 4 / 3           # Pixels per point, at 96 DPI
+SUPERSAMPLE = 4         # Sub-pixels per pixel (each way) for anti-aliasing
+STROKE = 0.25           # Outline width in points
+STROKE_COLOR = 0xFFFFFF
+TEXT_COLOR = 0
+BACKGROUND = 0xFFFFFF
+FONT_SIZE = 11          # Label font size in points (SVG)
+GLYPH = 1.5             # Size of a bitmap font dot in points (PNG)
+
+# 3x5 bitmap font. Each glyph is 5 rows, top to bottom. Each row is an octal
+# digit whose bits 4, 2, 1 are the left, middle and right dots.
+FONT = {
+    '0': '75557', '1': '26227', '2': '71747', '3': '71317', '4': '55711', '5': '74717',
+    '6': '74757', '7': '71111', '8': '75757', '9': '75717', 'A': '25755', 'B': '65656',
+    'C': '34443', 'D': '65556', 'E': '74647', 'F': '74644', 'G': '34553', 'H': '55755',
+    'I': '72227', 'J': '11152', 'K': '55655', 'L': '44447', 'M': '57755', 'N': '65555',
+    'O': '25552', 'P': '65644', 'Q': '25563', 'R': '65655', 'S': '34216', 'T': '72222',
+    'U': '55557', 'V': '55552', 'W': '55775', 'X': '55255', 'Y': '55222', 'Z': '71247',
+    ' ': '00000', '-': '00700', '.': '00002', ',': '00024', ':': '02020', "'": '22000',
+    '"': '55000', '(': '12221', ')': '42224', '/': '11244', '&': '25253', '_': '00007',
+    '+': '02720', '=': '07070', '?': '71202', '!': '22202', '#': '57575', '%': '51245',
+}
+
+
+def rgb(color):
+    '''Convert an Excel BGR color number (see shape.rgb) into an (r, g, b) tuple'''
+    return color & 0xFF, (color >> 8) & 0xFF, (color >> 16) & 0xFF
+
+
+class Picture(object):
+    '''
+    Collects filled shapes and text labels, in points, and saves them as an image.
+    Shapes are painted in the order they are added, like Excel's z-order.
+    '''
+    def __init__(self):
+        self.shapes = []
+        self.texts = []
+
+    def polygon(self, rings, color):
+        '''Add a shape made of rings (lists of (x, y) points), filled even-odd'''
+        self.shapes.append(([np.asarray(ring, dtype=float) for ring in rings], color))
+
+    def text(self, x, y, text):
+        '''Add a text label centred on (x, y)'''
+        self.texts.append((x, y, '%s' % text))
+
+    def save(self, path, left, top, width, height):
+        '''
+        Save the part of the picture from (left, top) of size (width, height) as
+        a .svg file, or else a PNG
+        '''
+        if path.lower().endswith('.svg'):
+            data = self.svg(left, top, width, height).encode('utf-8')
+        else:
+            data = self.png(left, top, width, height)
+        with open(path, 'wb') as handle:
+            handle.write(data)
+
+    def svg(self, left, top, width, height):
+        '''Return the picture as an SVG document'''
+        paths = []
+        for rings, color in self.shapes:
+            path = ' '.join(
+                'M' + ' '.join('%.2f,%.2f' % (x, y) for x, y in ring.tolist()) + 'Z'
+                for ring in rings if len(ring))
+            paths.append('<path d="%s" fill="#%02x%02x%02x"/>' % ((path, ) + rgb(color)))
+        texts = ['<text x="%.2f" y="%.2f">%s</text>' % (x, y, escape(text))
+                 for x, y, text in self.texts]
+        background, outline, ink = ['#%02x%02x%02x' % rgb(color)
+                                    for color in (BACKGROUND, STROKE_COLOR, TEXT_COLOR)]
+        return ''.join([
+            '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+            'viewBox="%.2f %.2f %.2f %.2f">' % (
+                round(width * SCALE), round(height * SCALE), left, top, width, height),
+            '<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="%s"/>' % (
+                left, top, width, height, background),
+            '<g fill-rule="evenodd" stroke="%s" stroke-width="%s" stroke-linejoin="round">' % (
+                outline, STROKE),
+        ] + paths + [
+            '</g><g text-anchor="middle" dominant-baseline="central" font-family=%s '
+            'font-size="%s" fill="%s">' % (quoteattr('Calibri, sans-serif'), FONT_SIZE, ink),
+        ] + texts + ['</g></svg>'])
+
+    def png(self, left, top, width, height):
+        '''Return the picture as PNG bytes'''
+        return encode_png(self.pixels(left, top, width, height))
+
+    def pixels(self, left, top, width, height):
+        '''Return the picture as an (h, w, 3) RGB array'''
+        w, h = int(round(width * SCALE)), int(round(height * SCALE))
+        scale = SCALE * SUPERSAMPLE
+        # Paint the index of each shape's color into a supersampled canvas
+        canvas = np.zeros((h * SUPERSAMPLE, w * SUPERSAMPLE), dtype=np.uint16)
+        palette = [BACKGROUND, STROKE_COLOR]
+        radius = int(STROKE * scale / 2)
+        for rings, color in self.shapes:
+            rings = [(ring - (left, top)) * scale for ring in rings if len(ring) > 1]
+            if not rings:
+                continue
+            palette.append(color)
+            edges = np.concatenate([np.hstack([ring, np.roll(ring, -1, axis=0)])
+                                    for ring in rings])
+            fill(canvas, edges, len(palette) - 1)
+            stroke(canvas, edges, 1, radius)
+        colors = np.array([rgb(color) for color in palette], dtype=np.uint8)
+        image = colors[canvas].reshape(h, SUPERSAMPLE, w, SUPERSAMPLE, 3).mean(axis=(1, 3))
+        image = np.round(image).astype(np.uint8)
+        for x, y, text in self.texts:
+            write(image, (x - left) * SCALE, (y - top) * SCALE, text, rgb(TEXT_COLOR))
+        return image
+
+
+def fill(canvas, edges, value):
+    '''
+    Set canvas pixels whose centres lie inside the polygon with edges
+    (x0, y0, x1, y1), by the even-odd rule, to value
+    '''
+    height, width = canvas.shape
+    x0, y0, x1, y1 = edges.T
+    # Each edge crosses the rows whose centre (row + 0.5) lies in [top, bottom)
+    first = np.clip(np.ceil(np.minimum(y0, y1) - 0.5), 0, height).astype(np.intp)
+    last = np.clip(np.ceil(np.maximum(y0, y1) - 0.5), 0, height).astype(np.intp)
+    rows, edge = topology.ranges(first, last)
+    if not len(rows):
+        return
+    x = x0[edge] + (rows + 0.5 - y0[edge]) / (y1[edge] - y0[edge]) * (x1[edge] - x0[edge])
+    # Sort crossings along each row. Inside spans run from odd to even crossings
+    order = np.lexsort((x, rows))
+    rows, x = rows[order][0::2], x[order]
+    start = np.clip(np.ceil(x[0::2] - 0.5), 0, width).astype(np.intp)
+    end = np.clip(np.ceil(x[1::2] - 0.5), 0, width).astype(np.intp)
+    # Mark span starts and ends, only over the rows and columns the polygon covers
+    top, bottom = rows.min(), rows.max() + 1
+    lo, hi = start.min(), end.max() + 1
+    marks = np.zeros((bottom - top, hi - lo + 1), dtype=np.int32)
+    np.add.at(marks, (rows - top, start - lo), 1)
+    np.add.at(marks, (rows - top, end - lo), -1)
+    inside = np.cumsum(marks, axis=1)[:, :hi - lo] > 0
+    canvas[top:bottom, lo:hi][inside[:, :min(hi, width) - lo]] = value
+
+
+def stroke(canvas, edges, value, radius=0):
+    '''Set canvas pixels along edges (x0, y0, x1, y1) to value, with a square brush'''
+    height, width = canvas.shape
+    x0, y0, x1, y1 = edges.T
+    # Sample each edge at least every half pixel
+    count = np.ceil(np.hypot(x1 - x0, y1 - y0) * 2).astype(np.intp) + 1
+    step, edge = topology.ranges(np.zeros_like(count), count)
+    t = step / np.maximum(count[edge] - 1, 1)
+    xs = np.floor(x0[edge] + t * (x1[edge] - x0[edge])).astype(np.intp)
+    ys = np.floor(y0[edge] + t * (y1[edge] - y0[edge])).astype(np.intp)
+    for dx in range(-radius, radius + 1):
+        for dy in range(-radius, radius + 1):
+            x, y = xs + dx, ys + dy
+            ok = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            canvas[y[ok], x[ok]] = value
+
+
+def write(image, x, y, text, color):
+    '''
+    Draw text centred on pixel (x, y) with the bitmap font. Accents are dropped
+    (e.g. É is drawn as E). Other characters without a glyph are drawn as ?
+    '''
+    height, width = image.shape[:2]
+    dot = max(int(round(GLYPH * SCALE)), 1)
+    # Split accented letters into a letter and combining marks, and drop the marks
+    text = ''.join(char for char in unicodedata.normalize('NFKD', text.upper())
+                   if not unicodedata.combining(char))
+    left = int(round(x - (len(text) * 4 - 1) * dot / 2))
+    top = int(round(y - 5 * dot / 2))
+    for index, char in enumerate(text):
+        glyph = FONT.get(char, FONT['?'])
+        for row, bits in enumerate(glyph):
+            for col in range(3):
+                if int(bits) & (4 >> col):
+                    gx, gy = left + (index * 4 + col) * dot, top + row * dot
+                    image[max(gy, 0):max(min(gy + dot, height), 0),
+                          max(gx, 0):max(min(gx + dot, width), 0)] = color
+
+
+def encode_png(pixels):
+    '''Encode an (h, w, 3) uint8 RGB array as PNG bytes'''
+    height, width = pixels.shape[:2]
+    # Each row starts with filter type 0 (none)
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(kind, data):
+        return b''.join([struct.pack('>I', len(data)), kind, data,
+                         struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF)])
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+        chunk(b'IEND', b''),
+    ])
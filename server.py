@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+'''
+Renders maps on request over HTTP, caching the results.
+
+    python server.py --port 8888
+    curl 'http://localhost:8888/map.png?topo=S01_AC.json&filters=AC_NAME=Adilabad'
+
+``/map.png``, ``/map.svg`` and ``/map.xlsm`` take the TopoJSON file ``topo``
+(relative to --maps) and shape.py's ``filters``, ``key``, ``col``,
+``cartogram`` and ``simplify`` options. ``/maps`` lists the TopoJSON files.
+
+Maps are rendered by shape.main() in a pool of worker processes, each with its
+own backend. A render creates all 3 formats, and is stored in the --cache folder
+under its build hash (see shape.build_hash). So a map is rendered again only if
+its options, TopoJSON, template or VBA code change. Identical requests that
+arrive while a map is rendering wait for the same render. Once the cache grows
+beyond --cache-size MB, the least recently used maps are deleted.
+'''
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+import json
+import math
+import shutil
+import asyncio
+import logging
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import tornado.web
+import tornado.ioloop
+import shape
+import topology
+
+folder = os.path.dirname(os.path.abspath(__file__))
+MIME = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'xlsm': 'application/vnd.ms-excel.sheet.macroEnabled.12',
+}
+
+
+class Cache(object):
+    '''
+    Folders of rendered maps under path, named by their build hash. Keeps the
+    total under size bytes by deleting the least recently used folders.
+    '''
+    def __init__(self, path, size):
+        self.path, self.size = path, size
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # Delete renders left incomplete by a crash
+        for key in os.listdir(path):
+            if key.endswith('.tmp'):
+                shutil.rmtree(os.path.join(path, key), ignore_errors=True)
+        # {key: bytes}, least recently used first. Folder mtimes persist the order
+        entries = [(os.path.getmtime(os.path.join(path, key)), key) for key in os.listdir(path)
+                   if os.path.isdir(os.path.join(path, key))]
+        self.entries = OrderedDict((key, folder_size(os.path.join(path, key)))
+                                   for mtime, key in sorted(entries))
+
+    def folder(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        '''Return the folder of key if cached, marking it as used. Else None'''
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        os.utime(self.folder(key), None)
+        return self.folder(key)
+
+    def add(self, key):
+        '''Add the folder of key, which now exists. Then evict old entries'''
+        self.entries[key] = folder_size(self.folder(key))
+        self.entries.move_to_end(key)
+        total = sum(self.entries.values())
+        # Keep the newest entry, even if it is larger than the cache
+        while total > self.size and len(self.entries) > 1:
+            old, size = self.entries.popitem(last=False)
+            shutil.rmtree(self.folder(old), ignore_errors=True)
+            total -= size
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def count_selected(path, filters):
+    '''Return the number of features in the TopoJSON file at path that match filters'''
+    data = topology.load_properties(path)
+    shape.apply_filters(data, filters)
+    return len(data.selected)
+
+
+def render(arg, target):
+    '''
+    Render a map in a worker process (see shape.init_worker) into the target
+    folder as map.png, map.svg and map.xlsm. The folder appears only when complete.
+    '''
+    # Another server may have rendered it already
+    if os.path.isdir(target):
+        return target
+    temp = '%s.%d.tmp' % (target, os.getpid())
+    shutil.rmtree(temp, ignore_errors=True)
+    os.makedirs(temp)
+    try:
+        arg.out = os.path.join(temp, 'map')
+        shape.render_map(arg)
+        os.replace(temp, target)
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+    return target
+
+
+class Renderer(object):
+    '''Renders maps via a process pool, sharing renders in progress and a Cache'''
+    def __init__(self, maps, cache, backend='xlsx', jobs=1):
+        self.maps, self.cache, self.backend = os.path.realpath(maps), cache, backend
+        self.pool = ProcessPoolExecutor(jobs, initializer=shape.init_worker,
+                                        initargs=(backend, False))
+        self.files = {}         # File hash cache for shape.build_hash
+        self.pending = {}       # {build hash: future of the render in progress}
+
+    async def options(self, topo, filters='', key='', col='', cartogram=None, simplify=1):
+        '''Return shape.main() options for a TopoJSON file under maps'''
+        path = os.path.realpath(os.path.join(self.maps, topo))
+        if not path.startswith(self.maps + os.sep) or not os.path.isfile(path):
+            raise tornado.web.HTTPError(404, 'No TopoJSON %s', topo)
+        # A map needs at least one feature to draw. Large maps take a while to load, so
+        # count them in a thread, keeping the event loop free for other requests
+        count = await tornado.ioloop.IOLoop.current().run_in_executor(
+            None, count_selected, path, filters)
+        if not count:
+            raise tornado.web.HTTPError(400, 'Filters %s match nothing in %s', filters, topo)
+        arg = shape.parser.parse_args([])
+        arg.topo, arg.filters, arg.key, arg.col = path, filters, key, col
+        arg.cartogram, arg.simplify, arg.backend = cartogram or None, simplify, self.backend
+        return arg
+
+    async def render(self, arg):
+        '''Return the folder holding the rendered map for arg. Renders it if required'''
+        key = shape.build_hash(arg, self.backend, self.files)
+        target = self.cache.get(key)
+        if target is not None:
+            return target
+        if key not in self.pending:
+            self.pending[key] = tornado.ioloop.IOLoop.current().run_in_executor(
+                self.pool, render, arg, self.cache.folder(key))
+            self.pending[key].add_done_callback(lambda future: self.done(key, future))
+        return await asyncio.shield(self.pending[key])
+
+    def done(self, key, future):
+        del self.pending[key]
+        if not future.cancelled() and future.exception() is None:
+            self.cache.add(key)
+
+
+class MapHandler(tornado.web.RequestHandler):
+    def initialize(self, renderer):
+        self.renderer = renderer
+
+    async def get(self, ext):
+        try:
+            simplify = float(self.get_argument('simplify', '1'))
+        except ValueError:
+            simplify = float('nan')
+        if not math.isfinite(simplify) or simplify < 0:
+            raise tornado.web.HTTPError(400, 'simplify must be a number >= 0')
+        arg = await self.renderer.options(
+            self.get_argument('topo'), filters=self.get_argument('filters', ''),
+            key=self.get_argument('key', ''), col=self.get_argument('col', ''),
+            cartogram=self.get_argument('cartogram', None), simplify=simplify)
+        target = await self.renderer.render(arg)
+        with io.open(os.path.join(target, 'map.' + ext), 'rb') as handle:
+            content = handle.read()
+        self.set_header('Content-Type', MIME[ext])
+        if ext == 'xlsm':
+            name = os.path.splitext(os.path.basename(arg.topo))[0]
+            self.set_header('Content-Disposition', 'attachment; filename="%s.xlsm"' % name)
+        self.write(content)
+
+
+class MapsHandler(tornado.web.RequestHandler):
+    def initialize(self, renderer):
+        self.renderer = renderer
+
+    def get(self):
+        maps = self.renderer.maps
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(sorted(
+            os.path.relpath(os.path.join(root, name), maps).replace(os.sep, '/')
+            for root, dirs, names in os.walk(maps) for name in names
+            if name.lower().endswith(('.json', '.topo')) and not name.endswith('.json.topo'))))
+
+
+def application(renderer):
+    return tornado.web.Application([
+        (r'/map\.(png|svg|xlsm)', MapHandler, {'renderer': renderer}),
+        (r'/maps', MapsHandler, {'renderer': renderer}),
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-p', '--port', help='Port to listen on', type=int, default=8888)
+    parser.add_argument('-m', '--maps', help='Folder of TopoJSON files to serve',
+                        default=os.path.join(folder, 'maps'))
+    parser.add_argument('-c', '--cache', help='Folder to cache rendered maps in',
+                        default=os.path.join(folder, 'cache'))
+    parser.add_argument('--cache-size', help='Maximum cache size in MB', type=float,
+                        default=1024)
+    parser.add_argument('-b', '--backend', help='xlsx (default) or excel',
+                        choices=sorted(shape.backends), default='xlsx')
+    parser.add_argument('-j', '--jobs', help='Number of maps to render in parallel',
+                        type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    cache = Cache(args.cache, args.cache_size * 2 ** 20)
+    renderer = Renderer(args.maps, cache, args.backend, args.jobs)
+    application(renderer).listen(args.port)
+    logging.info('Serving maps from %s on port %d', args.maps, args.port)
+    tornado.ioloop.IOLoop.current().start()
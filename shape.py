@@ -7,13 +7,26 @@ from __future__ import print_function, unicode_literals
 import io
 import os
 import re
-import math
+import csv
 import json
+import math
+import hashlib
 import yaml
+import pstats
+import cProfile
 import argparse
+import multiprocessing
+import multiprocessing.util
+import numpy as np
 import pandas as pd
 import tornado.template
-import win32com.client
+import xlsx
+import render
+import labels
+import topology
+import simplify
+import cartogram
+import timing
 from tqdm import tqdm
 from six import StringIO, string_types
 from collections import Counter, OrderedDict
@@ -21,6 +34,7 @@ from collections import Counter, OrderedDict
 # Define MS Office and Excel constants to make the code VB-like
 msoEditingAuto = 0
 msoSegmentLine = 0
+msoMergeCombine = 2
 msoFalse = 0
 msoTrue = -1
 ppLayoutBlank = 0xc
@@ -37,11 +51,13 @@ xlYes = 1
 
 # Chart size and position
 WIDTH, HEIGHT = 400, 400
+PIXEL = 0.75                                # Points per pixel, at 96 DPI
 LEFT, TOP = 400, 50
 SIZE = {'width': 0, 'height': 0}            # Store the computed size of the last map
 
 folder = os.path.dirname(os.path.abspath(__file__))
 template_file = os.path.join(folder, 'template.xlsm')
+vbscript_file = os.path.join(folder, 'shape.bas')
 
 
 def rgb(r=0, g=0, b=0, r_factor=1, g_factor=256, b_factor=65536):
@@ -56,44 +72,40 @@ map_colors = [
     rgb(g=255),
 ]
 
-# Keep count of how many times each shape key has been used
-count = Counter()
-
 
 def delete(path):
     if os.path.exists(path):
         os.unlink(path)
 
 
+# Albers projection constants for India. These are computed once, not per point.
+# Albers: http://mathworld.wolfram.com/AlbersEqual-AreaConicProjection.html
+deg2rad = math.pi / 180
+# Origin of Cartesian coordinates
+india_lat, india_lon = 24, 80
+phi0, lambda0 = india_lat * deg2rad, india_lon * deg2rad
+# Standard parallels
+india_lat_min, india_lat_max = 8, 37
+phi1, phi2 = india_lat_min * deg2rad, india_lat_max * deg2rad
+albers_n = .5 * (math.sin(phi1) + math.sin(phi2))
+albers_c = math.cos(phi1) ** 2 + 2 * albers_n * math.sin(phi1)
+albers_rho0 = ((albers_c - 2 * albers_n * math.sin(phi0)) / albers_n) ** .5
+
+
 def projection(lon, lat):
     '''
-    Albers: http://mathworld.wolfram.com/AlbersEqual-AreaConicProjection.html
+    Albers projection of lon, lat (in degrees) into x, y.
+    lon and lat may be numbers or NumPy arrays of the same shape.
     '''
-    pi_in_degrees = 180
-    deg2rad = math.pi / pi_in_degrees
-
-    lon, lat = lon * deg2rad, lat * deg2rad
-    # Origin of Cartesian coordinates
-    india_lat, india_lon = 24, 80
-    phi0, lambda0 = india_lat * deg2rad, india_lon * deg2rad
-    # Standard parallels
-    india_lat_min, india_lat_max = 8, 37
-    phi1, phi2 = india_lat_min * deg2rad, india_lat_max * deg2rad
-
-    n = .5 * (math.sin(phi1) + math.sin(phi2))
-    theta = n * (lon - lambda0)
-    c = math.cos(phi1) ** 2 + 2 * n * math.sin(phi1)
-    rho = ((c - 2 * n * math.sin(lat)) / n) ** .5
-    rho0 = ((c - 2 * n * math.sin(phi0)) / n) ** .5
-    x, y = rho * math.sin(theta), rho0 - rho * math.cos(theta)
+    theta = albers_n * (np.multiply(lon, deg2rad) - lambda0)
+    rho = np.sqrt((albers_c - 2 * albers_n * np.sin(np.multiply(lat, deg2rad))) / albers_n)
+    x, y = rho * np.sin(theta), albers_rho0 - rho * np.cos(theta)
     return x, -y
 
 
 def load_topojson(path, encoding='utf-8'):
     '''Loads a topojson file specified in the command line'''
-    with io.open(path, encoding=encoding) as handle:
-        data = json.load(handle, object_hook=OrderedDict)
-    return data
+    return topology.load(path, encoding)
 
 
 def parse_filters(filters):
@@ -113,94 +125,63 @@ def apply_filters(data, filters):
     '''
     Removes geometries not matching the command line filters.
     '''
-    filters = parse_filters(filters)
-
-    def cond(properties):
-        '''Return True if properties meet condition'''
-        for key, val in filters.items():
-            if str(properties.get(key, '')) not in val:     # noqa: E911
-                return False
-        return True
-
-    # Remove properties that do not match the filter
-    used_arcs = set()
-    for shape in data['objects'].values():
-        shape['geometries'] = [
-            geom for geom in shape['geometries']
-            if cond(geom.get('properties', {}))
-        ]
-        # Identify used arcs
-        for geom in shape['geometries']:
-            for arcgroup in geom.get('arcs', []):
-                # TODO: factor in holes
-                if isinstance(arcgroup[0], list):
-                    arcgroup = arcgroup[0]
-                used_arcs |= set(arcgroup)
-
-    data['used_arcs'] = used_arcs
-
-
-def add_cols(data, cols):
-    unid_val = [0]
-    keys = [k for k in args.key.split(',') if k]
-
-    def key(properties):
-        return ':'.join(str(properties.get(k, '')) for k in keys)   # noqa: E911
-
-    def unid():
-        unid_val[0] += 1
-        return 'M%d' % unid_val[0]
+    topology.select(data, parse_filters(filters))
+
+
+def add_cols(data, cols, keys=''):
+    '''
+    Restrict properties to cols (all if empty), and add an ID column with the
+    keys columns joined by ":", or M1, M2, ... if there are no keys
+    '''
+    keys = [k for k in keys.split(',') if k]
+    if len(keys):
+        ids = [':'.join(parts) for parts in zip(*(data.strings(key) for key in keys))]
+    else:
+        ids = ['M%d' % (index + 1) for index in range(len(data))]
 
     # Restrict to pre-defined columns, and add an ID column
     cols = set(col for col in cols if col)
-    for shape in data['objects'].values():
-        for geom in shape['geometries']:
-            properties = geom.get('properties', {})
-            if len(cols):
-                result = {key: properties[key] for key in properties if key in cols}
-            else:
-                result = properties
-            result['ID'] = key(properties) if len(keys) else unid()
-            geom['properties'] = result
+    if len(cols):
+        data.columns = OrderedDict(
+            (key, col) for key, col in data.columns.items() if key in cols)
+    data.set_column('ID', ids)
 
 
-def centroid(points):
-    x, y = 0.0, 0.0
-    for point in points:
-        x, y = x + point[0], y + point[1]
-    return x / len(points), y / len(points)
+def project(topo):
+    '''
+    Return the projected arcs of a topo as ``(coords, offsets)``. If a cartogram
+    has distorted them, these are under ``projected``. Do not modify coords.
+    '''
+    if topo.projected is not None:
+        return topo.projected
+    return np.column_stack(projection(topo.points[:, 0], topo.points[:, 1])), topo.offsets
 
 
-def draw(sheet, topo, row):
+def distort(data, col):
     '''
-    Draw into a sheet
-    the topo (JSON) object
+    Distort the projected arcs so that each geometry's area is proportional to
+    its col property (a missing or non-numeric value counts as 0)
     '''
-    # Convert arcs into absolute positions
-    sx, sy = topo['transform']['scale']
-    tx, ty = topo['transform']['translate']
-
-    coords = []
-    for arc in topo['arcs']:
-        # Convert into absolute integer coordinates
-        x, y = arc[0]
-        points = [(x, y)]
-        for relative in arc[1:]:
-            x, y = x + relative[0], y + relative[1]
-            points.append((x, y))
-
-        # Convert into lat-long, then project it
-        coords.append([
-            projection(px * sx + tx, py * sy + ty)
-            for px, py in points
-        ])
+    values = data.columns[col].get(data.selected) if col in data.columns else [None] * len(data)
+    values = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').fillna(0).values
+    coords, offsets = project(data)
+    data.projected = cartogram.cartogram(coords, offsets, data, data.selected, values), offsets
+
+
+def draw(backend, topo, row, tolerance=1):
+    '''
+    Draw into a backend's sheet
+    the topo (Topology) object,
+    simplifying arcs so that nodes are about tolerance pixels apart (0 to skip)
+    '''
+    # Convert arcs into absolute positions, then project them
+    with timing.span('project'):
+        coords, offsets = project(topo)
 
     # Get bounds used the used arcs, ignoring arcs unused by filters
-    used_arcs = topo['used_arcs']
-    vx = [px for arc, pointlist in enumerate(coords) for px, py in pointlist if arc in used_arcs]
-    vy = [py for arc, pointlist in enumerate(coords) for px, py in pointlist if arc in used_arcs]
-    minx, miny = min(vx), min(vy)
-    maxx, maxy = max(vx), max(vy)
+    used_coords = coords[topology.point_mask(offsets, topo.used_arcs)]
+    minx, miny = used_coords.min(axis=0)
+    maxx, maxy = used_coords.max(axis=0)
     dx, dy = maxx - minx, maxy - miny
 
     # We want the map centered in a WIDTH x HEIGHT bounding box from TOP, LEFT
@@ -208,65 +189,114 @@ def draw(sheet, topo, row):
     x0, y0 = LEFT, TOP
     SIZE['width'], SIZE['height'] = scale * dx, scale * dy
 
-    for i, points in enumerate(coords):
-        coords[i] = [(x0 + (px - minx) * scale, y0 + (py - miny) * scale)
-                     for px, py in points]
-    geoms = sum((shape['geometries'] for shape in topo['objects'].values()), [])
-    map_color_index = 0
-
-    label_info = []
-    for geom in tqdm(geoms):
-        properties = geom['properties']
-        name = properties['ID']
-        names = []
-        geom_points = []
-
-        if 'arcs' not in geom:
+    coords = coords - (minx, miny)
+    coords *= scale
+    coords += (x0, y0)
+
+    # Simplify the used arcs at this scale. Arcs are shared, so neighbours stay gap-free
+    if tolerance:
+        with timing.span('simplify'):
+            coords, offsets, removed = simplify.simplify(
+                coords, offsets, tolerance * PIXEL, topo.used_arcs)
+        timing.count('points_removed', int(removed))
+
+    # Colour features so that neighbours (which share an arc) differ
+    with timing.span('colors'):
+        colors = topo.adjacency.colors(topo, topo.selected, len(map_colors)).tolist()
+
+    # Get every ring (outer boundaries, holes and islands) of every geometry at once
+    with timing.span('rings'):
+        points, ring_offsets, ring_geom, ring_hole = topology.rings(
+            topo, topo.selected, offsets)
+        xy = coords[points].tolist()
+        ring_offsets = ring_offsets.tolist()
+        geom_rings = np.searchsorted(ring_geom, np.arange(len(topo) + 1)).tolist()
+
+    drawn = []
+    for index, properties in enumerate(tqdm(topo.rows(), total=len(topo))):
+        # Geometries without rings (e.g. lines) are not drawn
+        first, last = geom_rings[index], geom_rings[index + 1]
+        if first == last:
             continue
 
-        # Convert arcs of a geometry into array of points
-        for i, arcgroup in enumerate(geom['arcs']):
-            # Consolidate shapes into a point list. TODO: factor in holes
-            points = []
-            if isinstance(arcgroup[0], list):
-                arcgroup = arcgroup[0]
-
-            for arc in arcgroup:
-                # arc is an index into point coords. +ve values go clockwise.
-                # Else, it's two's complement (~) goes anti- clockwise.
-                points += coords[arc] if arc >= 0 else coords[~arc][::-1]
-            geom_points += points
-
-            # Draw the points
-            shape = sheet.Shapes.BuildFreeform(msoEditingAuto, *points[0])
-            for point in points[1:]:
-                shape.AddNodes(msoSegmentLine, msoEditingAuto, *point)
-            shape = shape.ConvertToShape()
-            shape.Line.Weight = 0.25
-            shape.Line.ForeColor.ObjectThemeColor = msoThemeColorBackground1
-            shape.Fill.ForeColor.RGB = map_colors[map_color_index]
-            map_color_index = (map_color_index + 1) % len(map_colors)
+        # Draw all rings as one shape. Holes are filled even-odd, so they stay empty
+        rings = [xy[ring_offsets[i]:ring_offsets[i + 1]] for i in range(first, last)]
+        with timing.span('freeform'):
+            shapename = backend.freeform(rings, map_colors[colors[index]], properties['ID'])
+        timing.count('shapes')
+        timing.count('rings', last - first)
+        timing.count('points', ring_offsets[last] - ring_offsets[first])
+        yield properties, shapename
+        drawn.append(topo.selected[index])
 
-            shapename = shape.Name = 'ID_{:d}'.format(count['ID'])
-            names.append(shapename)
-            count['ID'] += 1
+    # Label features inside their shape, largest first, dropping labels that would overlap
+    with timing.span('labels'):
+        centres, placed = labels.place(coords, offsets, topo, drawn, 72, 20)
+        backend.labels([
+            (x - 36, y - 10, 72, 20, 'E%d' % (row + index))
+            for index, (x, y) in enumerate(centres.tolist()) if placed[index]])
+    timing.count('labels', int(placed.sum()))
 
-        # Group shapes if it has more than 1 arc
-        if len(geom['arcs']) > 1:
-            shape = sheet.Shapes.Range(names).Group()
 
-        shapename = shape.Name = name
-        yield properties, shapename
-        label_info.append({
-            'centroid': centroid(geom_points),
-            'name': name,
-        })
-
-    for index, info in enumerate(tqdm(label_info)):
-        x, y = info['centroid']
-        sheet.Shapes.AddLabel(msoTextOrientationHorizontal, x - 36, y - 10, 72, 20).Select()
-        xl.Selection.Formula = "=E%d" % (row + index)
-        text = xl.Selection.ShapeRange.TextFrame2
+class ExcelBackend(object):
+    '''
+    Draws maps by automating Microsoft Excel via COM. This needs Windows and
+    Excel, and runs one Excel instance at a time.
+    '''
+    def __init__(self, visible=False):
+        import win32com.client
+        self.xl = win32com.client.Dispatch('Excel.Application')
+        self.xl.Visible = msoTrue if visible else msoFalse
+
+    def open(self, template):
+        # Open the template file if it exists. Else create a new one
+        if os.path.exists(template):
+            self.workbook = self.xl.Workbooks.Open(template)
+        else:
+            self.workbook = self.xl.Workbooks.Add()
+        self.sheet = self.workbook.Sheets[0]
+        # Keep the shapes, labels and cell values for screenshots
+        self.picture = render.Picture()
+        self.label_boxes = []
+        self.values = {}
+
+    def freeform(self, rings, color, name):
+        # Freeforms have a single path. Tracing every ring in one path would stroke the
+        # lines between rings. So build one freeform per ring, and combine them into one
+        # shape. Combining leaves areas covered an even number of times (holes) empty
+        names = []
+        for ring in rings:
+            shape = self.sheet.Shapes.BuildFreeform(msoEditingAuto, *ring[0])
+            for point in ring[1:]:
+                shape.AddNodes(msoSegmentLine, msoEditingAuto, *point)
+            shape = shape.ConvertToShape()
+            names.append(shape.Name)
+        if len(names) > 1:
+            # The combined shape is added after all others
+            self.sheet.Shapes.Range(names).MergeShapes(msoMergeCombine)
+            shape = self.sheet.Shapes(self.sheet.Shapes.Count)
+        shape.Line.Weight = 0.25
+        shape.Line.ForeColor.ObjectThemeColor = msoThemeColorBackground1
+        shape.Fill.ForeColor.RGB = color
+        shape.Name = name
+        timing.count('com_calls', sum(len(ring) + 2 for ring in rings) + 6)
+        self.picture.polygon(rings, color)
+        return name
+
+    def labels(self, labels):
+        # Add labels showing cells. labels is a list of (left, top, width, height, cell)
+        names = []
+        self.label_boxes.extend(labels)
+        for left, top, width, height, cell in labels:
+            shape = self.sheet.Shapes.AddLabel(
+                msoTextOrientationHorizontal, left, top, width, height)
+            shape.DrawingObject.Formula = '=' + cell
+            names.append(shape.Name)
+        timing.count('com_calls', 3 * len(names))
+        if not names:
+            return
+        # Format all labels in one go
+        text = self.sheet.Shapes.Range(names).TextFrame2
         text.TextRange.ParagraphFormat.Alignment = msoAlignCenter
         text.VerticalAnchor = msoAnchorMiddle
         text.WordWrap = msoFalse
@@ -274,157 +304,207 @@ def draw(sheet, topo, row):
         text.MarginRight = 0
         text.MarginTop = 0
         text.MarginBottom = 0
+        timing.count('com_calls', 9)
+
+    def cells(self, row, col, values):
+        # Write a list of rows into the block from (row, col) with one Range assignment
+        if not values:
+            return
+        for y, items in enumerate(values):
+            for x, value in enumerate(items):
+                self.values[row + y, col + x] = value
+        width = max(len(items) for items in values)
+        values = [list(items) + [None] * (width - len(items)) for items in values]
+        sheet = self.sheet
+        sheet.Range(sheet.Cells(row, col),
+                    sheet.Cells(row + len(values) - 1, col + width - 1)).Value = values
+        timing.count('com_calls', 4)
+
+    def color(self, row, col, color):
+        self.sheet.Cells(row, col).Interior.Color = color
+
+    def table(self, name, top, left, bottom, right, style):
+        sheet = self.sheet
+        sheet.Range(sheet.Cells(top, left), sheet.Cells(bottom, right)).Select()
+        table = sheet.ListObjects.Add(XlListObjectHasHeaders=xlYes)
+        table.Name = name
+        table.ShowAutoFilterDropDown = msoFalse
+        table.TableStyle = style
+        # Do not auto-fit. Data may be too long
+        # table.Range.Columns.AutoFit()
+        # De-select the current table range
+        sheet.Range('A1').Select()
+
+    def button(self, left, top, width, height, text, action):
+        # Add a form button that runs the macro action
+        button = self.sheet.Buttons().Add(left, top, width, height)
+        button.OnAction = action
+        button.Characters.Text = text
+
+    def screenshot(self, img_file, box):
+        # Render the shapes drawn so far, without Excel, into the (left, top, width, height) box
+        for left, top, width, height, cell in self.label_boxes:
+            text = self.values.get(xlsx.parse_ref(cell))
+            self.picture.text(left + width / 2.0, top + height / 2.0, '' if text is None else text)
+        self.picture.save(img_file, *box)
+        self.picture.texts = []
+
+    def fill(self, color):
+        self.sheet.Shapes.SelectAll()
+        self.xl.Selection.ShapeRange.Fill.ForeColor.RGB = color
+
+    def vba(self, source):
+        # Add visual basic code. http://www.cpearson.com/excel/vbe.aspx
+        # Requires Excel modification: http://support.microsoft.com/kb/282830
+        # to fix error 'Programmatic Access to Visual Basic Project is not trusted'
+        vbsheet = 'Sheet1'
+        codemod = self.workbook.VBProject.VBComponents(vbsheet).CodeModule
+        for line, row in enumerate(source.split('\n')):
+            codemod.InsertLines(line + 1, row)
+        timing.count('com_calls', line + 3)
 
+    def save(self, filename, sheet_name):
+        # Note: workbook.VBProject.VBComponents('Sheet1') works. But after renaming
+        # the sheet, it still stays Sheet1. So rename sheet AFTER updating VBScript.
+        self.sheet.Name = sheet_name
+        self.workbook.SaveAs(filename, xlOpenXMLWorkbookMacroEnabled)
+        self.workbook.Close()
 
-def screenshot(sheet, img_file):
-    '''Export all shapes on this sheet as an image'''
-    xl = sheet.Application
-    # Resize chart to picture size
-    sheet.Shapes.SelectAll()
-    xl.Selection.Copy()
-
-    # Create chart as a canvas for saving this picture
-    chart = xl.Charts.Add()
-    chart = chart.Location(Where=xlLocationAsObject, Name=sheet.Name)
-    chart_padding = {'width': 10, 'height': 30}     # Padding added by Excel charts
-    chart.ChartArea.Width = WIDTH + chart_padding['width']
-    chart.ChartArea.Height = HEIGHT + chart_padding['height']
-    chart.Parent.Border.LineStyle = 0
-    chart.ChartArea.ClearContents()
-    chart.ChartArea.Select()
-    chart.Paste()
-    # Center the image
-    xl.Selection.ShapeRange.IncrementLeft((WIDTH - SIZE['width']) / 2)
-    xl.Selection.ShapeRange.IncrementTop((HEIGHT - SIZE['height']) / 2)
-
-    # Save chart as image and delete it
-    chart.Export(Filename=img_file)
-    sheet.ChartObjects(1).Delete()
-
-
-def main(xl, args):
-    # Open the template file if it exists. Else create a new one
-    if os.path.exists(template_file):
-        workbook = xl.Workbooks.Open(template_file)
-    else:
-        workbook = xl.Workbooks.Add()
-    sheet = workbook.Sheets[0]
+    def quit(self):
+        self.xl.Quit()
+
+
+backends = {
+    'excel': ExcelBackend,
+    'xlsx': xlsx.XLSXBackend,
+}
+
+
+def main(backend, args):
+    with timing.span('open'):
+        backend.open(template_file)
     # output file defaults to the base name of the TopoJSON file
     if not args.out:
         args.out = os.path.splitext(args.topo)[0]
 
-    propcol = {}
-
-    data = load_topojson(args.topo, args.enc)
-    apply_filters(data, args.filters)
-    add_cols(data, args.col.split(','))
+    with timing.span('load'):
+        data = load_topojson(args.topo, args.enc)
+    with timing.span('filter'):
+        apply_filters(data, args.filters)
+        # Keep only the arcs and properties of the filtered geometries
+        if len(data) < len(data.types):
+            data = topology.subset(data, data.selected)
+    if args.cartogram:
+        with timing.span('cartogram'):
+            distort(data, args.cartogram)
+    add_cols(data, args.col.split(','), args.key)
 
     # Properties table data
-    row = start_row = 4
-    props = []
-    for prop, shapename in draw(sheet, data, row):
-        sheet.Cells(row, 1).Value = 0
-        sheet.Cells(row, 2).Value = shapename
-        for attr, val in prop.items():
-            if attr == 'ID':
-                continue
-            if attr not in propcol:
-                propcol[attr] = len(propcol)
-            sheet.Cells(row, propcol[attr] + 3).Value = val
+    start_row = 4
+    props, shapenames = [], []
+    with timing.span('draw'):
+        for prop, shapename in draw(backend, data, start_row, args.simplify):
             props.append(prop)
-        row += 1
-
-    # Properties table header
-    sheet.Cells(start_row - 1, 1).Value = 'Value'
-    sheet.Cells(start_row - 1, 2).Value = 'ID'
-    for attr, column in propcol.items():
-        sheet.Cells(start_row - 1, column + 3).Value = attr
-
-    # Set the default gradient
-    sheet.Cells(1, 1).Value = 'Colors'
-    sheet.Cells(1, 2).Value = 0.0
-    sheet.Cells(1, 3).Value = 0.5
-    sheet.Cells(1, 4).Value = 1.0
-    sheet.Cells(1, 2).Interior.Color = 255      # Red
-    sheet.Cells(1, 3).Interior.Color = 65535    # Yellow
-    sheet.Cells(1, 4).Interior.Color = 5296274  # Green
-
-    # Format properties table as a table
-    sheet.Range(sheet.Cells(start_row - 1, 1), sheet.Cells(row - 1, len(propcol) + 2)).Select()
-    table = sheet.ListObjects.Add(XlListObjectHasHeaders=xlYes)
-    table.Name = 'Properties'
-    table.ShowAutoFilterDropDown = msoFalse
-    table.TableStyle = 'TableStyleLight9'
-    # Do not auto-fit. Data may be too long
-    # table.Range.Columns.AutoFit()
-    # De-select the current table range
-    sheet.Range('A1').Select()
-
-    # Take a screenshot
-    filename = os.path.abspath(args.out + '.png')
-    delete(filename)
-    screenshot(sheet, filename)
-
-    # Save CSV data
-    if args.csv:
-        info = {
-            'Handle': os.path.split(args.out)[-1],
-            'Title': args.out,
-        }
-        if args.attr:
-            info.update(parse_filters(args.attr) if isinstance(args.attr, string_types)
-                        else args.attr)
-        buf = StringIO()
-        pd.DataFrame(props).drop('ID', axis=1).to_html(buf, index=False, classes=None)
-        table = re.sub(r'\s+', ' ', buf.getvalue())
-        info['Body (HTML)'] = (info['Body (HTML)'] or '{table}').format(table=table, **info)
-        # Keys starting with _ are ignored. These are just meant as formatting variables
-        info = {key: val for key, val in info.items() if not key.startswith('_')}
-
-        if os.path.exists(args.csv):
-            # Load data, match columns and update / add record
-            data = pd.read_csv(args.csv, encoding='utf-8').set_index('Handle')
-            handle = info.pop('Handle')
-            info.update({col: '' for col in data.columns if col not in info})
-            data.loc[handle] = {key: val for key, val in info.items() if key in data.columns}
-        else:
-            data = pd.DataFrame([info]).set_index('Handle')
-        data.to_csv(args.csv, encoding='utf-8')
+            shapenames.append(shapename)
+    row = start_row + len(props)
+
+    with timing.span('cells'):
+        # Write the properties table (with header) in one go. Columns in order of appearance
+        attrs = list(OrderedDict(
+            (attr, None) for prop in props for attr in prop if attr != 'ID'))
+        table = [['Value', 'ID'] + attrs]
+        for prop, shapename in zip(props, shapenames):
+            table.append([0, shapename] + [prop.get(attr) for attr in attrs])
+        backend.cells(start_row - 1, 1, table)
+        timing.count('cells', sum(len(items) for items in table))
+
+        # Set the default gradient
+        backend.cells(1, 1, [['Colors', 0.0, 0.5, 1.0]])
+        backend.color(1, 2, 255)        # Red
+        backend.color(1, 3, 65535)      # Yellow
+        backend.color(1, 4, 5296274)    # Green
+
+        # Format properties table as a table
+        backend.table('Properties', start_row - 1, 1, row - 1, len(attrs) + 2,
+                      'TableStyleLight9')
+
+    # Take a screenshot: the map centered in a WIDTH x HEIGHT box
+    box = (LEFT - (WIDTH - SIZE['width']) / 2, TOP - (HEIGHT - SIZE['height']) / 2,
+           WIDTH, HEIGHT)
+    for ext in ('.png', '.svg'):
+        with timing.span('screenshot'):
+            filename = os.path.abspath(args.out + ext)
+            delete(filename)
+            backend.screenshot(filename, box)
+
+    # Summary CSV data
+    with timing.span('summary'):
+        info = csv_info(args, props) if args.csv else None
 
     # Color all shapes in grey
-    sheet.Shapes.SelectAll()
-    xl.Selection.ShapeRange.Fill.ForeColor.RGB = rgb(r=224, g=224, b=224)
-
-    # Add visual basic code. http://www.cpearson.com/excel/vbe.aspx
-    # Requires Excel modification: http://support.microsoft.com/kb/282830
-    # to fix error 'Programmatic Access to Visual Basic Project is not trusted'
-    vbscript = os.path.join(folder, 'shape.bas')
-    vbsheet = 'Sheet1'
-    with io.open(vbscript, encoding='utf-8') as handle:
-        source = tornado.template.Template(handle.read()).generate(license=args.license)
-        codemod = workbook.VBProject.VBComponents(vbsheet).CodeModule
-        for line, row in enumerate(source.decode('utf-8').split('\n')):
-            codemod.InsertLines(line + 1, row)
-    # Note: workbook.VBProject.VBComponents('Sheet1') works. But after renaming
-    # the sheet, it still stays Sheet1. So rename sheet AFTER updating VBScript.
-    sheet.Name = os.path.split(args.out)[-1]
+    with timing.span('fill'):
+        backend.fill(rgb(r=224, g=224, b=224))
+
+    with timing.span('vba'):
+        with io.open(vbscript_file, encoding='utf-8') as handle:
+            source = tornado.template.Template(handle.read()).generate(license=args.license)
+            backend.vba(source.decode('utf-8'))
     filename = os.path.abspath(args.out + '.xlsm')
     delete(filename)
     print('Saving as', filename)
-    workbook.SaveAs(filename, xlOpenXMLWorkbookMacroEnabled)
-    workbook.Close()
+    with timing.span('save'):
+        backend.save(filename, os.path.split(args.out)[-1])
+    return info
+
+
+def csv_info(args, props):
+    '''Return the summary CSV row for a map, given its properties'''
+    info = {
+        'Handle': os.path.split(args.out)[-1],
+        'Title': args.out,
+    }
+    if args.attr:
+        info.update(parse_filters(args.attr) if isinstance(args.attr, string_types)
+                    else args.attr)
+    buf = StringIO()
+    pd.DataFrame(props).drop('ID', axis=1).to_html(buf, index=False, classes=None)
+    table = re.sub(r'\s+', ' ', buf.getvalue())
+    info['Body (HTML)'] = (info.get('Body (HTML)') or '{table}').format(table=table, **info)
+    # Keys starting with _ are ignored. These are just meant as formatting variables
+    return {key: val for key, val in info.items() if not key.startswith('_')}
+
+
+def save_csv(path, infos):
+    '''
+    Add or update summary rows (by Handle) in the CSV file at path. Other rows
+    are copied as-is, without parsing their values.
+    '''
+    columns, rows = None, OrderedDict()
+    if os.path.exists(path):
+        with io.open(path, encoding='utf-8', newline='') as handle:
+            reader = csv.reader(handle)
+            columns = next(reader, None)
+            for record in reader:
+                rows[record[0]] = record
+    for info in infos:
+        # The first map sets the columns. Later maps fill them, ignoring other keys
+        if columns is None:
+            columns = ['Handle'] + [key for key in info if key != 'Handle']
+        rows[info['Handle']] = ['' if info.get(col) is None else info[col] for col in columns]
+    if columns is not None:
+        with io.open(path, 'w', encoding='utf-8', newline='') as handle:
+            writer = csv.writer(handle)
+            writer.writerow(columns)
+            writer.writerows(rows.values())
 
 
 def prop(args):
-    data = load_topojson(args.topo, args.enc)
+    # Only properties are needed. Skip the arcs
+    data = topology.load_properties(args.topo, args.enc)
     apply_filters(data, args.filters)
-    add_cols(data, args.col.split(','))
+    add_cols(data, args.col.split(','), args.key)
 
-    values = []
-    for shape in data['objects'].values():
-        for geom in shape['geometries']:
-            values.append(geom.get('properties', {}))
-    properties = pd.DataFrame(values)
+    properties = data.frame()
     for col in properties.columns:
         top = properties[col].value_counts().head(5)
         print('%-16s %s' % (col, ', '.join(top.index.astype(str))[:60]))
@@ -436,12 +516,103 @@ def prop(args):
         print('Saved properties into', args.prop)
 
 
+# Each batch worker process renders with its own backend instances: {name: backend}.
+# worker['backend'] is the one it started with
+worker = {'backends': {}, 'quit': {}, 'visible': False}
+
+
+def init_worker(name, visible):
+    '''Start a backend in a pool worker process, for render_map to use'''
+    worker['visible'] = visible
+    worker['backend'] = worker_backend(name)
+
+
+def worker_backend(name):
+    '''Return this process's backend called name, starting it on first use'''
+    if name not in worker['backends']:
+        backend = worker['backends'][name] = backends[name](visible=worker['visible'])
+        # Pool workers that exit normally run this. Quit Excel instead of leaking it
+        worker['quit'][name] = multiprocessing.util.Finalize(
+            backend, backend.quit, exitpriority=10)
+    return worker['backends'][name]
+
+
+def quit_backends():
+    '''Quit the backends this process started'''
+    worker.pop('backend', None)
+    for name in list(worker['backends']):
+        del worker['backends'][name]
+        worker['quit'].pop(name)()
+
+
+def render_map(arg):
+    # Time each map on its own, even if maps share a process
+    with timing.collect() as stats:
+        info = main(worker_backend(arg.backend), arg)
+    return arg.csv, info, stats.report()
+
+
+def file_hash(path, files):
+    '''
+    Return the SHA-1 of the file at path. files caches {path: [size, mtime, hash]},
+    so unchanged files are not read again.
+    '''
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    if files.get(key, [])[:2] == [stat.st_size, stat.st_mtime]:
+        return files[key][2]
+    digest = hashlib.sha1()
+    with io.open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(chunk)
+    files[key] = [stat.st_size, stat.st_mtime, digest.hexdigest()]
+    return files[key][2]
+
+
+# main() options that change a map's output. Others, like --csv, --attr and --jobs, do not
+RENDER_OPTIONS = ('topo', 'out', 'key', 'col', 'filters', 'license', 'enc', 'simplify',
+                  'cartogram')
+
+
+def build_hash(arg, backend, files):
+    '''
+    Return a hash of everything a map's output depends on: its RENDER_OPTIONS,
+    the backend, and the contents of its TopoJSON, the template and the VBA code
+    '''
+    options = {key: getattr(arg, key, None) for key in RENDER_OPTIONS}
+    digest = hashlib.sha1(json.dumps([backend, options], sort_keys=True, default=repr).encode())
+    for path in (arg.topo, template_file, vbscript_file):
+        digest.update(file_hash(path, files).encode())
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    '''Return the batch build manifest at path: file hashes and build hashes of maps'''
+    if os.path.exists(path):
+        with io.open(path, encoding='utf-8') as handle:
+            return json.load(handle)
+    return {'files': {}, 'maps': {}}
+
+
+def save_manifest(path, manifest):
+    # Write atomically, so that an interrupted save does not lose the manifest
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with io.open(temp, 'w', encoding='utf-8') as handle:
+        handle.write(json.dumps(manifest, indent=0, sort_keys=True))
+    os.replace(temp, path)
+
+
 def batch(args):
     with io.open(args.yaml, encoding='utf-8') as handle:
-        config = yaml.load(handle)
+        config = yaml.safe_load(handle)
     common = config.get('common', {})
-    for row in tqdm(config.get('maps', [])):
+    # The manifest holds the build hash of each output, to rebuild only maps that changed
+    manifest_file = os.path.splitext(args.yaml)[0] + '.manifest.json'
+    manifest = load_manifest(manifest_file)
+    todo, hashes = [], []
+    for row in config.get('maps', []):
         arg = parser.parse_args([])
+        arg.backend = args.backend
         for props in [common, row]:
             for key, val in props.items():
                 if isinstance(val, dict):
@@ -449,43 +620,116 @@ def batch(args):
                     original.update(val)
                     val = original
                 setattr(arg, key, val)
-        # If the generated file is newer than the topoJSON
-        if os.path.exists(arg.out + '.xlsm'):
-            if os.stat(arg.out + '.xlsm').st_mtime > os.stat(arg.topo).st_mtime:
+        arg.out = arg.out or os.path.splitext(arg.topo)[0]
+        # Skip the map if it exists and nothing it depends on has changed
+        key = build_hash(arg, arg.backend, manifest['files'])
+        if not args.force and os.path.exists(arg.out + '.xlsm'):
+            if manifest['maps'].get(os.path.abspath(arg.out)) == key:
                 continue
-        main(xl, arg)
+        todo.append(arg)
+        hashes.append(key)
+    # Do not start a backend (e.g. Excel) if every map is up to date
+    if not todo:
+        save_manifest(manifest_file, manifest)
+        return
+
+    # Render maps in order, in-process or across a pool of --jobs workers
+    pool = None
+    if args.jobs > 1 and len(todo) > 1:
+        # Workers start the backend most maps use. render_map starts others if required
+        name = Counter(arg.backend for arg in todo).most_common(1)[0][0]
+        pool = multiprocessing.Pool(min(args.jobs, len(todo)), initializer=init_worker,
+                                    initargs=(name, args.view))
+        results = pool.imap(render_map, todo)
+    else:
+        worker['visible'] = args.view
+        results = (render_map(arg) for arg in todo)
+    # Write each summary CSV file once, after all maps are rendered
+    summary, reports = OrderedDict(), OrderedDict()
+    try:
+        for arg, key, (path, info, report) in zip(todo, hashes,
+                                                  tqdm(results, total=len(todo))):
+            if path:
+                summary.setdefault(path, []).append(info)
+            manifest['maps'][os.path.abspath(arg.out)] = key
+            reports[arg.out] = report
+    except BaseException:
+        # Stop rendering the remaining maps
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is None:
+            quit_backends()
+        else:
+            pool.close()
+            pool.join()
+        # Save progress, even if a map failed
+        for path, infos in summary.items():
+            save_csv(path, infos)
+        save_manifest(manifest_file, manifest)
+        if args.timing:
+            timing.save(args.timing, reports)
+
+
+# Command line options. parser.parse_args([]) gives the defaults that main() expects
+parser = argparse.ArgumentParser(
+    description=__doc__.strip(),
+    formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument('-y', '--yaml', help='Load configuration from a YAML file')
+parser.add_argument('-t', '--topo', help='TopoJSON file')
+parser.add_argument('-o', '--out', help='Output .xlsm and .png name. Default: Same as --topo')
+parser.add_argument('-k', '--key', help='Columns to use as keys (comma-separated)', default='')
+parser.add_argument('-c', '--col', help='Columns to include (comma-separated)', default='')
+parser.add_argument('-f', '--filters', help='Filters (col=VAL,col=VAL,...)', default='')
+parser.add_argument('-l', '--license', help='License key for Excel')
+parser.add_argument('-v', '--view', help='View Excel while rendering', action='store_true')
+parser.add_argument('-p', '--prop', help='Save properties as CSV file (or "-" to print )')
+parser.add_argument('-e', '--enc', help='Topojson encoding', default='utf-8')
+parser.add_argument('--csv', help='Generate summary CSV file')
+parser.add_argument('-a', '--attr', help='CSV file attrs (col=VAL,col=VAL,...)', default='')
+parser.add_argument('-b', '--backend', help='excel (default) or xlsx (write .xlsm directly)',
+                    choices=sorted(backends), default='excel')
+parser.add_argument('-s', '--simplify', help='Pixels between simplified nodes (0: off)',
+                    type=float, default=1)
+parser.add_argument('-j', '--jobs', help='Number of maps to render in parallel (with --yaml)',
+                    type=int, default=1)
+parser.add_argument('--cartogram', help='Resize shapes in proportion to this column')
+parser.add_argument('--force', help='Rebuild all maps (with --yaml), even if unchanged',
+                    action='store_true')
+parser.add_argument('--timing', help='Save time taken by each stage of each map, '
+                    'and work done, as a .json or .csv file')
+parser.add_argument('--profile', help='Save cProfile stats into this file, and print '
+                    'the slowest calls. Does not profile --jobs workers')
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description=__doc__.strip(),
-        formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('-y', '--yaml', help='Load configuration from a YAML file')
-    parser.add_argument('-t', '--topo', help='TopoJSON file')
-    parser.add_argument('-o', '--out', help='Output .xlsm and .png name. Default: Same as --topo')
-    parser.add_argument('-k', '--key', help='Columns to use as keys (comma-separated)', default='')
-    parser.add_argument('-c', '--col', help='Columns to include (comma-separated)', default='')
-    parser.add_argument('-f', '--filters', help='Filters (col=VAL,col=VAL,...)', default='')
-    parser.add_argument('-l', '--license', help='License key for Excel')
-    parser.add_argument('-v', '--view', help='View Excel while rendering', action='store_true')
-    parser.add_argument('-p', '--prop', help='Save properties as CSV file (or "-" to print )')
-    parser.add_argument('-e', '--enc', help='Topojson encoding', default='utf-8')
-    parser.add_argument('--csv', help='Generate summary CSV file')
-    parser.add_argument('-a', '--attr', help='CSV file attrs (col=VAL,col=VAL,...)', default='')
     args = parser.parse_args()
 
     if not args.topo and not args.yaml:
         parser.exit(status=2, message='One of --topo or --yaml is required\n')
 
-    if args.prop:
-        prop(args)
-    else:
-        xl = win32com.client.Dispatch('Excel.Application')
-        xl.Visible = msoTrue if args.view else msoFalse
-        try:
-            if args.yaml:
-                batch(args)
-            else:
-                main(xl, args)
-        finally:
-            xl.Quit()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if args.prop:
+            prop(args)
+        elif args.yaml:
+            batch(args)
+        else:
+            backend = backends[args.backend](visible=args.view)
+            with timing.collect() as stats:
+                try:
+                    info = main(backend, args)
+                finally:
+                    backend.quit()
+            if args.csv:
+                save_csv(args.csv, [info])
+            if args.timing:
+                timing.save(args.timing, OrderedDict([(args.out, stats.report())]))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
@@ -1,22 +1,23 @@
 '''
-Extracts properties from a TopoJSON file into a Shopify CSV file
+Extracts properties from TopoJSON files into a Shopify CSV file
 '''
 
-import io
-import json
+import multiprocessing
+import topology
 import pandas as pd
 from tqdm import tqdm
 from six import StringIO
 
 
 def properties(path, encoding='utf-8'):
-    with io.open(path, encoding=encoding) as handle:
-        topo = json.load(handle)
-    data = []
-    for shape in topo['objects'].values():
-        for geom in shape['geometries']:
-            data.append(geom.get('properties', {}))
-    return pd.DataFrame(data)
+    return topology.load_properties(path, encoding).frame()
+
+
+def body(path):
+    '''Return the properties of a TopoJSON file as an HTML table'''
+    buf = StringIO()
+    properties(path).to_html(buf, index=False, classes=None)
+    return buf.getvalue()
 
 
 if __name__ == '__main__':
@@ -27,24 +28,23 @@ if __name__ == '__main__':
         formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-o', '--output', help='Output CSV file', default='product-template.csv')
     parser.add_argument('file', help='TopoJSON file', nargs='+')
+    parser.add_argument('-j', '--jobs', help='Number of files to read in parallel',
+                        type=int, default=multiprocessing.cpu_count())
     args = parser.parse_args()
 
-    result = []
-    for path in tqdm(args.file):
-        data = properties(path)
-
-        buf = StringIO()
-        data.to_html(buf, index=False, classes=None)
-
-        title = path
-        unique_id = path
-        info = {
-            'Handle': unique_id,
-            'Title': title,
-            'Body (HTML)': buf.getvalue(),
-            'Variant Price': 25000
-        }
-        result.append(info)
-
-    result = pd.DataFrame(result)
+    # Read files across a pool of processes, in order
+    if args.jobs > 1 and len(args.file) > 1:
+        pool = multiprocessing.Pool(min(args.jobs, len(args.file)))
+        bodies = list(tqdm(pool.imap(body, args.file), total=len(args.file)))
+        pool.close()
+        pool.join()
+    else:
+        bodies = [body(path) for path in tqdm(args.file)]
+
+    result = pd.DataFrame({
+        'Handle': args.file,
+        'Title': args.file,
+        'Body (HTML)': bodies,
+        'Variant Price': 25000,
+    }, columns=['Handle', 'Title', 'Body (HTML)', 'Variant Price'])
     result.to_csv(args.output, index=False, encoding='utf-8')
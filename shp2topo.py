@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+'''
+Convert ESRI Shapefiles (.shp with .dbf attributes) into TopoJSON, without node.js.
+
+Shapes and attributes are read a record at a time. Co-ordinates are quantized,
+then every ring and line is cut into arcs at its junctions: points where lines
+meet or part ways. An arc shared by neighbouring features, in either direction,
+is stored once. This is the same topology that mbostock/topojson builds.
+'''
+from __future__ import division, print_function, unicode_literals
+
+import io
+import os
+import json
+import codecs
+import struct
+import argparse
+import numpy as np
+import simplify
+from topology import Buffer
+from collections import OrderedDict
+
+QUANTIZATION = 10000    # Quantize co-ordinates into a grid of this size (each way)
+CHUNK_POINTS = 1 << 16  # Number of arc points to convert to JSON at a time
+SEPARATORS = (',', ':')
+NULL, POINT, POLYLINE, POLYGON, MULTIPOINT = 0, 1, 3, 5, 8
+# Shape types with Z or M values store x, y in the same layout as their 2D type
+SHAPE_TYPES = {0: NULL, 1: POINT, 3: POLYLINE, 5: POLYGON, 8: MULTIPOINT,
+               11: POINT, 13: POLYLINE, 15: POLYGON, 18: MULTIPOINT,
+               21: POINT, 23: POLYLINE, 25: POLYGON, 28: MULTIPOINT}
+
+
+def read_shp(path):
+    '''
+    Yield (shape_type, parts) for each record of a .shp file. shape_type is NULL,
+    POINT, POLYLINE, POLYGON or MULTIPOINT. parts is a list of (n, 2) arrays of
+    x, y. Z and M values are ignored.
+    '''
+    with io.open(path, 'rb') as handle:
+        handle.seek(100)
+        while True:
+            header = handle.read(8)
+            if len(header) < 8:
+                return
+            number, length = struct.unpack('>ii', header)
+            content = handle.read(length * 2)
+            kind = SHAPE_TYPES.get(struct.unpack('<i', content[:4])[0] if len(content) >= 4
+                                   else NULL, NULL)
+            if kind == POINT:
+                yield kind, [np.frombuffer(content, '<f8', 2, 4).reshape(1, 2)]
+            elif kind == MULTIPOINT:
+                count = struct.unpack('<i', content[36:40])[0]
+                yield kind, [np.frombuffer(content, '<f8', 2 * count, 40).reshape(-1, 2)]
+            elif kind in (POLYLINE, POLYGON):
+                num_parts, num_points = struct.unpack('<ii', content[36:44])
+                starts = np.frombuffer(content, '<i4', num_parts, 44).tolist()
+                xy = np.frombuffer(content, '<f8', 2 * num_points, 44 + 4 * num_parts)
+                xy = xy.reshape(-1, 2)
+                ends = starts[1:] + [num_points]
+                yield kind, [xy[start:end] for start, end in zip(starts, ends)]
+            else:
+                yield NULL, []
+
+
+def read_dbf(path, encoding='utf-8'):
+    '''
+    Yield an OrderedDict of the attributes of each record of a .dbf file, or
+    None for deleted records. Blank values are None.
+    '''
+    with io.open(path, 'rb') as handle:
+        count, header_size, record_size = struct.unpack('<4xIHH20x', handle.read(32))
+        fields = []
+        for index in range((header_size - 33) // 32):
+            field = handle.read(32)
+            if field[:1] == b'\r':
+                break
+            name, kind, size, decimals = struct.unpack('<11sc4xBB14x', field)
+            fields.append((name.split(b'\0')[0].decode(encoding, 'replace'),
+                           kind.decode('ascii', 'replace').upper(), size, decimals))
+        handle.seek(header_size)
+        for index in range(count):
+            record = handle.read(record_size)
+            if len(record) < record_size:
+                return
+            if record[:1] == b'*':
+                yield None
+                continue
+            values, pos = OrderedDict(), 1
+            for name, kind, size, decimals in fields:
+                values[name] = parse_value(record[pos:pos + size], kind, decimals, encoding)
+                pos += size
+            yield values
+
+
+def parse_value(text, kind, decimals, encoding):
+    '''Convert the bytes of a .dbf field of type kind into a Python value'''
+    text = text.decode(encoding, 'replace').strip().strip('\0')
+    if not text:
+        return None
+    if kind in ('N', 'F'):
+        try:
+            return int(text) if decimals == 0 else float(text)
+        except ValueError:
+            try:
+                return float(text)
+            except ValueError:
+                # Numbers too large for the field are filled with *
+                return None
+    if kind == 'L':
+        return True if text in 'YyTt' else False if text in 'NnFf' else None
+    return text
+
+
+def dbf_encoding(path, default='utf-8'):
+    '''Return the encoding in the .cpg file next to path, if any, else default'''
+    cpg = os.path.splitext(path)[0] + '.cpg'
+    if os.path.exists(cpg):
+        with io.open(cpg, 'rb') as handle:
+            name = handle.read().decode('ascii', 'replace').strip()
+        name = 'cp' + name if name.isdigit() else name
+        try:
+            return codecs.lookup(name).name
+        except LookupError:
+            pass
+    return default
+
+
+def read(path, properties=None, encoding=None):
+    '''
+    Yield (shape_type, parts, attributes) for each record of a Shapefile. Only
+    the attributes named in properties are kept, or all if it is None.
+    '''
+    shapes = read_shp(path)
+    dbf = os.path.splitext(path)[0] + '.dbf'
+    if os.path.exists(dbf):
+        records = read_dbf(dbf, encoding or dbf_encoding(path))
+    else:
+        records = iter(lambda: OrderedDict(), None)
+    for (kind, parts), attrs in zip(shapes, records):
+        if attrs is None:
+            continue
+        if properties is not None:
+            attrs = OrderedDict((key, attrs[key]) for key in properties if key in attrs)
+        yield kind, parts, attrs
+
+
+def topology(features, name, quantization=QUANTIZATION, tolerance=0, retain=None):
+    '''
+    Return a TopoJSON dict with one GeometryCollection object called name, made
+    of features: (shape_type, parts, attributes) tuples, as yielded by read().
+    Its ``arcs`` are ``(delta, arc_offsets)``: the delta-encoded points of all
+    arcs as one array, and where each arc starts. Save it with write().
+
+    Co-ordinates are quantized into a quantization x quantization grid. If
+    tolerance is given, arcs are simplified so that no removed point is more
+    than tolerance grid units from the simplified arc. If retain is given, only
+    that fraction of the arcs' interior points are kept, those with the highest
+    Douglas-Peucker weight (see simplify.proportion).
+    '''
+    # Read co-ordinates into one growing array, and keep just the structure per feature
+    values, sizes = Buffer(np.float64), Buffer(np.intp)
+    kinds, counts, attributes = [], [], []
+    for kind, feature_parts, attrs in features:
+        for part in feature_parts:
+            values.extend(part.ravel())
+        sizes.extend([len(part) for part in feature_parts])
+        kinds.append(kind)
+        counts.append(len(feature_parts))
+        attributes.append(attrs)
+    xy = values.array().reshape(-1, 2)
+    x0, y0 = xy.min(axis=0) if len(xy) else (0, 0)
+    x1, y1 = xy.max(axis=0) if len(xy) else (0, 0)
+    kx = (x1 - x0) / (quantization - 1) if x1 > x0 else 1
+    ky = (y1 - y0) / (quantization - 1) if y1 > y0 else 1
+    grid = np.round((xy - (x0, y0)) / (kx, ky)).astype(np.int64)
+    del xy, values
+
+    # Lines and rings are sequences of quantized points. Rings are closed
+    sizes = sizes.array()
+    offsets = np.zeros(len(sizes) + 1, dtype=np.intp)
+    np.cumsum(sizes, out=offsets[1:])
+    part_kind = np.repeat(np.array(kinds, dtype=np.intp), counts)
+    closed = part_kind == POLYGON
+    sequences = (part_kind == POLYLINE) | closed
+    points, seq_offsets = sequence_points(grid, offsets, closed, sequences)
+    seq_arcs, coords, arc_offsets = cut_arcs(points, seq_offsets, closed, quantization)
+
+    if retain is not None and len(arc_offsets) > 1:
+        coords, arc_offsets, removed = simplify.proportion(coords, arc_offsets, retain)
+    if tolerance and len(arc_offsets) > 1:
+        coords, arc_offsets, removed = simplify.simplify(
+            coords.astype(float), arc_offsets, tolerance)
+        coords = np.round(coords).astype(np.int64)
+
+    # Delta-encode arcs: each point after the first is relative to the previous one
+    delta = coords.copy()
+    delta[1:] -= coords[:-1]
+    delta[arc_offsets[:-1]] = coords[arc_offsets[:-1]]
+
+    geometries, part = [], 0
+    for kind, count, attrs in zip(kinds, counts, attributes):
+        geometry = geometry_json(kind, seq_arcs[part:part + count],
+                                 grid[offsets[part]:offsets[part + count]],
+                                 points, seq_offsets[part:part + count + 1])
+        geometry['properties'] = attrs
+        geometries.append(geometry)
+        part += count
+
+    return OrderedDict([
+        ('type', 'Topology'),
+        ('transform', OrderedDict([('scale', [kx, ky]), ('translate', [x0, y0])])),
+        ('bbox', [x0, y0, x1, y1]),
+        ('objects', {name: OrderedDict([
+            ('type', 'GeometryCollection'), ('geometries', geometries)])}),
+        ('arcs', (delta, arc_offsets)),
+    ])
+
+
+def write(handle, topo, chunk=CHUNK_POINTS):
+    '''
+    Write a TopoJSON dict from topology() to a text handle, one geometry at a
+    time, and arcs chunk points at a time
+    '''
+    handle.write('{')
+    for index, (key, value) in enumerate(topo.items()):
+        handle.write('%s%s:' % (',' if index else '', json.dumps(key)))
+        if key == 'objects':
+            handle.write('{')
+            for number, (name, collection) in enumerate(value.items()):
+                handle.write('%s%s:{"type":%s,"geometries":[' % (
+                    ',' if number else '', json.dumps(name), json.dumps(collection['type'])))
+                for pos, geometry in enumerate(collection['geometries']):
+                    if pos:
+                        handle.write(',')
+                    handle.write(json.dumps(geometry, separators=SEPARATORS))
+                handle.write(']}')
+            handle.write('}')
+        elif key == 'arcs':
+            write_arcs(handle, value[0], value[1], chunk)
+        else:
+            handle.write(json.dumps(value, separators=SEPARATORS))
+    handle.write('}')
+
+
+def write_arcs(handle, delta, arc_offsets, chunk=CHUNK_POINTS):
+    '''Write arcs as a JSON array, converting about chunk points at a time to lists'''
+    handle.write('[')
+    arc, count = 0, len(arc_offsets) - 1
+    while arc < count:
+        # Take whole arcs up to chunk points, but at least one arc
+        end = max(int(np.searchsorted(arc_offsets, arc_offsets[arc] + chunk, 'right')) - 1,
+                  arc + 1)
+        base = arc_offsets[arc]
+        points = delta[base:arc_offsets[end]].tolist()
+        arcs = [points[start - base:stop - base]
+                for start, stop in zip(arc_offsets[arc:end], arc_offsets[arc + 1:end + 1])]
+        if arc:
+            handle.write(',')
+        handle.write(json.dumps(arcs, separators=SEPARATORS)[1:-1])
+        arc = end
+    handle.write(']')
+
+
+def sequence_points(grid, offsets, closed, sequences):
+    '''
+    Return (points, seq_offsets): the quantized points of each part that is a
+    line or ring, without consecutive duplicates, or the closing point of rings.
+    Parts that are not sequences, and lines or rings too short to have a length
+    or area, have no points.
+    '''
+    part = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    keep = sequences[part]
+    keep[1:] &= ~((grid[1:] == grid[:-1]).all(axis=1) & (part[1:] == part[:-1]))
+    # Drop the last point of a ring if it repeats the first
+    sizes = np.bincount(part[keep], minlength=len(offsets) - 1)
+    seq_offsets = np.zeros(len(offsets), dtype=np.intp)
+    np.cumsum(sizes, out=seq_offsets[1:])
+    points = grid[keep]
+    last = seq_offsets[1:] - 1
+    repeat = closed & (sizes > 1)
+    repeat[repeat] = (points[last[repeat]] == points[seq_offsets[:-1][repeat]]).all(axis=1)
+    short = sizes - repeat < np.where(closed, 3, 2)
+    drop = np.zeros(len(points), dtype=bool)
+    drop[last[repeat]] = True
+    drop[np.repeat(short, sizes)] = True
+    sizes = np.where(short, 0, sizes - repeat)
+    np.cumsum(sizes, out=seq_offsets[1:])
+    return points[~drop], seq_offsets
+
+
+def cut_arcs(points, seq_offsets, closed, quantization):
+    '''
+    Cut lines and rings into arcs at junctions, storing each distinct arc once.
+    Return (seq_arcs, coords, arc_offsets): the arc indices of each sequence
+    (~i for arc i reversed, None if it has no points), and the arcs' points.
+    '''
+    count = len(seq_offsets) - 1
+    sizes = np.diff(seq_offsets)
+    key = points[:, 0] * quantization + points[:, 1]
+    # Find each point's neighbours. Rings wrap around. Line ends have none (-1)
+    index = np.arange(len(points))
+    starts, ends = seq_offsets[:-1][sizes > 0], seq_offsets[1:][sizes > 0] - 1
+    ring = closed[sizes > 0]
+    prev, nxt = index - 1, index + 1
+    prev[starts] = np.where(ring, ends, -1)
+    nxt[ends] = np.where(ring, starts, -1)
+    prev_key = np.where(prev >= 0, key[np.maximum(prev, 0)], -1)
+    next_key = np.where(nxt >= 0, key[np.maximum(nxt, 0)], -1)
+    low, high = np.minimum(prev_key, next_key), np.maximum(prev_key, next_key)
+
+    # A junction is a point reached from more than one distinct pair of neighbours
+    order = np.lexsort((high, low, key))
+    k, lo, hi = key[order], low[order], high[order]
+    distinct = np.ones(len(k), dtype=bool)
+    distinct[1:] = (k[1:] != k[:-1]) | (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+    k = k[distinct]
+    junction = np.isin(key, k[1:][k[1:] == k[:-1]])
+    # Line ends are always junctions
+    junction[starts[~ring]] = junction[ends[~ring]] = True
+
+    arcs, lookup, seq_arcs = [], {}, []
+    for index in range(count):
+        start, end = seq_offsets[index], seq_offsets[index + 1]
+        if start == end:
+            seq_arcs.append(None)
+            continue
+        pts = points[start:end]
+        cuts = np.flatnonzero(junction[start:end])
+        if closed[index]:
+            # Start rings at a junction, or else at their smallest point, so that
+            # the same ring in two features gives the same arc
+            first = cuts[0] if len(cuts) else key[start:end].argmin()
+            pts = np.roll(pts, -first, axis=0)
+            pts = np.concatenate([pts, pts[:1]])
+            cuts = np.append((cuts - first) % (end - start), end - start)
+            cuts.sort()
+            if cuts[0] != 0:
+                cuts = np.insert(cuts, 0, 0)
+        seq_arcs.append([
+            arc_index(pts[a:b + 1], arcs, lookup) for a, b in zip(cuts[:-1], cuts[1:])])
+
+    arc_offsets = np.zeros(len(arcs) + 1, dtype=np.intp)
+    np.cumsum([len(arc) for arc in arcs], out=arc_offsets[1:])
+    coords = np.concatenate(arcs) if arcs else np.zeros((0, 2), dtype=np.int64)
+    return seq_arcs, coords, arc_offsets
+
+
+def arc_index(arc, arcs, lookup):
+    '''Return the index of arc in arcs (or ~index if reversed), adding it if new'''
+    arc = np.ascontiguousarray(arc)
+    key = arc.tobytes()
+    if key in lookup:
+        return lookup[key]
+    reverse = np.ascontiguousarray(arc[::-1]).tobytes()
+    if reverse in lookup:
+        return ~lookup[reverse]
+    lookup[key] = len(arcs)
+    arcs.append(arc)
+    return lookup[key]
+
+
+def geometry_json(kind, part_arcs, grid, points, seq_offsets):
+    '''
+    Return the TopoJSON geometry of a feature, given the arcs of each part, its
+    quantized points (for Point and MultiPoint), and its sequence points
+    '''
+    part_arcs = [arcs for arcs in part_arcs if arcs is not None]
+    if kind == POINT and len(grid):
+        return OrderedDict([('type', 'Point'), ('coordinates', grid[0].tolist())])
+    if kind == MULTIPOINT and len(grid):
+        return OrderedDict([('type', 'MultiPoint'), ('coordinates', grid.tolist())])
+    if kind == POLYLINE and part_arcs:
+        if len(part_arcs) == 1:
+            return OrderedDict([('type', 'LineString'), ('arcs', part_arcs[0])])
+        return OrderedDict([('type', 'MultiLineString'), ('arcs', part_arcs)])
+    if kind == POLYGON and part_arcs:
+        rings = [points[start:end] for start, end in zip(seq_offsets[:-1], seq_offsets[1:])
+                 if end > start]
+        polygons = polygon_arcs(rings, part_arcs)
+        if len(polygons) == 1:
+            return OrderedDict([('type', 'Polygon'), ('arcs', polygons[0])])
+        return OrderedDict([('type', 'MultiPolygon'), ('arcs', polygons)])
+    return OrderedDict([('type', None)])
+
+
+def polygon_arcs(rings, ring_arcs):
+    '''
+    Group rings into polygons: an outer ring followed by its holes. Shapefile
+    outer rings run clockwise and holes anti-clockwise. Each hole goes into the
+    first outer ring that contains it.
+    '''
+    area = [signed_area(ring) for ring in rings]
+    outers = [index for index, value in enumerate(area) if value < 0]
+    # Rings that all run anti-clockwise are outer rings
+    if not outers:
+        outers = list(range(len(rings)))
+    polygons = OrderedDict((index, [ring_arcs[index]]) for index in outers)
+    for index in range(len(rings)):
+        if index in polygons:
+            continue
+        point = rings[index][0]
+        parent = next((outer for outer in outers if contains(rings[outer], point)), None)
+        if parent is None:
+            polygons[index] = [ring_arcs[index]]
+        else:
+            polygons[parent].append(ring_arcs[index])
+    return list(polygons.values())
+
+
+def signed_area(ring):
+    '''Twice the signed area of a ring. Negative if it runs clockwise'''
+    x, y = ring[:, 0].astype(float), ring[:, 1].astype(float)
+    return (x * np.roll(y, -1) - np.roll(x, -1) * y).sum()
+
+
+def contains(ring, point):
+    '''Return True if point lies inside ring, by the even-odd rule'''
+    x0, y0 = ring[:, 0].astype(float), ring[:, 1].astype(float)
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    x, y = point
+    straddle = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cross = x0 + (y - y0) / (y1 - y0) * (x1 - x0)
+    return bool((straddle & (x < cross)).sum() % 2)
+
+
+def convert(path, out=None, properties=None, quantization=QUANTIZATION, tolerance=0,
+            encoding=None, retain=None):
+    '''
+    Convert the Shapefile at path into a TopoJSON file at out (default: path
+    with a .json extension). The object is named after the Shapefile. Returns out.
+    '''
+    out = out or os.path.splitext(path)[0] + '.json'
+    name = os.path.splitext(os.path.basename(path))[0]
+    topo = topology(read(path, properties, encoding), name, quantization, tolerance, retain)
+    # Write atomically, so that an interrupted conversion does not leave a partial file
+    temp = '%s.%d.tmp' % (out, os.getpid())
+    with io.open(temp, 'w', encoding='utf-8') as handle:
+        write(handle, topo)
+    os.replace(temp, out)
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('shp', help='Shapefile (.shp) to convert', nargs='+')
+    parser.add_argument('-o', '--out', help='TopoJSON file. Default: Same as the .shp')
+    parser.add_argument('-p', '--prop', help='Attributes to keep (default: all)',
+                        action='append')
+    parser.add_argument('-q', '--quantization', help='Grid size to quantize co-ordinates to',
+                        type=int, default=QUANTIZATION)
+    parser.add_argument('-s', '--simplify', help='Simplify arcs to within this many grid units',
+                        type=float, default=0)
+    parser.add_argument('--simplify-proportion', help='Keep this fraction of arc points '
+                        '(0 to 1), those that matter most to their shape', type=float)
+    parser.add_argument('-e', '--enc', help='.dbf encoding. Default: from the .cpg, else utf-8')
+    args = parser.parse_args()
+    if args.out and len(args.shp) > 1:
+        parser.exit(status=2, message='--out needs a single Shapefile\n')
+    for path in args.shp:
+        print('Saved', convert(path, args.out, args.prop, args.quantization, args.simplify,
+                               args.enc, args.simplify_proportion))
@@ -0,0 +1,139 @@
+'''
+Simplifies TopoJSON arcs with the Douglas-Peucker algorithm.
+
+Each arc is simplified on its own and keeps its end points. Since neighbouring
+features share arcs, they stay gap-free after simplification.
+'''
+from __future__ import unicode_literals
+
+import numpy as np
+
+
+def simplify(coords, offsets, tolerance, arcs=None):
+    '''
+    Simplify arcs so that no removed point is farther than tolerance from the
+    simplified line, and no kept point is within tolerance of the previous one.
+
+    ``coords`` and ``offsets`` are decoded arcs (see topology.decode_arcs).
+    ``arcs`` optionally restricts simplification to these arc indices. Returns
+    ``(coords, offsets, removed)``: the simplified arcs and the number of points
+    removed.
+    '''
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    keep = np.ones(len(coords), dtype=bool)
+    if arcs is None:
+        arcs = np.arange(len(starts))
+    arcs = arcs[ends[arcs] - starts[arcs] > 1]
+    # Only the end points of the arcs being simplified are kept to begin with
+    keep[np.repeat(np.isin(np.arange(len(starts)), arcs), np.diff(offsets))] = False
+    keep[starts[arcs]] = keep[ends[arcs]] = True
+
+    # Closed arcs (rings) also keep 2 interior points, so they never collapse to a line
+    seg_start, seg_end = starts[arcs], ends[arcs]
+    closed = (coords[seg_start] == coords[seg_end]).all(axis=1) & (seg_end - seg_start > 3)
+    thirds = [seg_start[closed] + (seg_end[closed] - seg_start[closed]) * i // 3 for i in (1, 2)]
+    keep[thirds[0]] = keep[thirds[1]] = True
+    seg_start = np.concatenate([seg_start[~closed], seg_start[closed]] + thirds)
+    seg_end = np.concatenate([seg_end[~closed]] + thirds + [seg_end[closed]])
+
+    # Split all segments at their farthest point until every point is within tolerance
+    while len(seg_start):
+        count = seg_end - seg_start - 1
+        seg_start, seg_end, count = seg_start[count > 0], seg_end[count > 0], count[count > 0]
+        if not len(seg_start):
+            break
+        seg = np.repeat(np.arange(len(seg_start)), count)
+        first = np.cumsum(count) - count
+        points = np.arange(count.sum()) - first[seg] + seg_start[seg] + 1
+        dist = segment_distance(coords[points], coords[seg_start[seg]], coords[seg_end[seg]])
+        # Farthest point in each segment: sort by segment, then by descending distance
+        order = np.lexsort((-dist, seg))[first]
+        split = dist[order] > tolerance
+        far = points[order][split]
+        keep[far] = True
+        seg_start, seg_end = (np.concatenate([seg_start[split], far]),
+                              np.concatenate([far, seg_end[split]]))
+
+    # Drop interior points within tolerance of the previous kept point
+    kept = np.flatnonzero(keep)
+    if len(kept) > 1:
+        gap = np.hypot(*(coords[kept[1:]] - coords[kept[:-1]]).T)
+        interior = np.ones(len(coords), dtype=bool)
+        interior[starts] = interior[ends] = interior[thirds[0]] = interior[thirds[1]] = False
+        arc_used = np.zeros(len(starts), dtype=bool)
+        arc_used[arcs] = True
+        interior &= np.repeat(arc_used, np.diff(offsets))
+        close = kept[1:][(gap < tolerance) & interior[kept[1:]]]
+        keep[close] = False
+
+    total = np.concatenate([[0], np.cumsum(keep)])
+    return coords[keep], total[offsets], len(coords) - int(total[-1])
+
+
+def weights(coords, offsets):
+    '''
+    Return the Douglas-Peucker weight of each point of the arcs: the largest
+    tolerance at which simplify() keeps it (before dropping close points). End
+    points, and the 2 interior points kept on closed arcs, weigh infinity.
+    '''
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    weight = np.full(len(coords), np.inf)
+    arcs = np.flatnonzero(ends - starts > 1)
+    seg_start, seg_end = starts[arcs], ends[arcs]
+    closed = (coords[seg_start] == coords[seg_end]).all(axis=1) & (seg_end - seg_start > 3)
+    thirds = [seg_start[closed] + (seg_end[closed] - seg_start[closed]) * i // 3 for i in (1, 2)]
+    seg_start = np.concatenate([seg_start[~closed], seg_start[closed]] + thirds)
+    seg_end = np.concatenate([seg_end[~closed]] + thirds + [seg_end[closed]])
+    # A point split off a segment weighs no more than the point that made the segment
+    seg_cap = np.full(len(seg_start), np.inf)
+
+    # Split every segment at its farthest point, until no segment has interior points
+    while len(seg_start):
+        count = seg_end - seg_start - 1
+        more = count > 0
+        seg_start, seg_end, seg_cap, count = (
+            seg_start[more], seg_end[more], seg_cap[more], count[more])
+        if not len(seg_start):
+            break
+        seg = np.repeat(np.arange(len(seg_start)), count)
+        first = np.cumsum(count) - count
+        points = np.arange(count.sum()) - first[seg] + seg_start[seg] + 1
+        dist = segment_distance(coords[points], coords[seg_start[seg]], coords[seg_end[seg]])
+        order = np.lexsort((-dist, seg))[first]
+        far = points[order]
+        weight[far] = np.minimum(dist[order], seg_cap)
+        seg_start, seg_end = (np.concatenate([seg_start, far]),
+                              np.concatenate([far, seg_end]))
+        seg_cap = np.concatenate([weight[far], weight[far]])
+    return weight
+
+
+def proportion(coords, offsets, retain):
+    '''
+    Simplify arcs by keeping only the retain fraction (0 to 1) of their interior
+    points with the highest Douglas-Peucker weight (see weights), like
+    topojson's --simplify-proportion. End points are always kept. Returns
+    ``(coords, offsets, removed)``, as simplify() does.
+    '''
+    weight = weights(coords, offsets)
+    interior = weight[np.isfinite(weight)]
+    count = int(round(len(interior) * min(max(retain, 0), 1)))
+    keep = np.isinf(weight)
+    if count >= len(interior):
+        keep[:] = True
+    elif count > 0:
+        threshold = np.partition(interior, len(interior) - count)[len(interior) - count]
+        keep |= weight >= threshold
+    total = np.concatenate([[0], np.cumsum(keep)])
+    return coords[keep], total[offsets], len(coords) - int(total[-1])
+
+
+def segment_distance(points, start, end):
+    '''Distance of each point from the line segment (start, end), row by row'''
+    delta = end - start
+    length = (delta ** 2).sum(axis=1)
+    safe = np.where(length > 0, length, 1)
+    t = np.clip(((points - start) * delta).sum(axis=1) / safe, 0, 1)
+    t[length == 0] = 0
+    nearest = start + t[:, None] * delta
+    return np.hypot(*(points - nearest).T)
@@ -1,77 +1,92 @@
 """
 Creates an Excel map application given an SVG map.
 """
+from __future__ import print_function, unicode_literals
 
+import io
+import os
 import argparse
-import color as _color
-import win32com.client
-from MSO import *
-from svg2mso import svg2mso
+import numpy as np
+import shape
+import svgparse
 
-parser = argparse.ArgumentParser(description=__doc__.strip())
-parser.add_argument('svgfile')
-parser.add_argument('-l', '--license', help='motherboard id')
-parser.add_argument('-e', '--expiry', help='mm/dd/yyyy')
-parser.add_argument('-a', '--attr', help='attribute to take ID from', default='title')
-args = parser.parse_args()
+folder = os.path.dirname(os.path.abspath(__file__))
+vbscript_file = os.path.join(folder, 'svgmap.bas')
+GREY = shape.rgb(r=204, g=204, b=204)
 
-Application = win32com.client.Dispatch("Excel.Application")
-Application.Visible = msoTrue
-Workbook = Application.Workbooks.Add()
-Workbook.Sheets('Sheet1').Name = 'Map'
-#Workbook.Sheets('Sheet2').Delete()
-#Workbook.Sheets('Sheet3').Delete()
 
-Base = Workbook.Sheets('Map')
+def draw(backend, path, attr='title'):
+    '''
+    Draw the shapes of an SVG file into a backend's sheet, scaled into the same
+    box as shape.draw. Each shape is named by the attr chain of its element (see
+    svgparse), or Shape0001, Shape0002, ... Returns the names.
+    '''
+    coords, ring_offsets, ring_geom, names = svgparse.read(path, attr)
+    if len(coords):
+        low, high = coords.min(axis=0), coords.max(axis=0)
+        scale = min(shape.WIDTH / max(high[0] - low[0], 1e-9),
+                    shape.HEIGHT / max(high[1] - low[1], 1e-9))
+        coords = (coords - low) * scale + (shape.LEFT, shape.TOP)
+    xy = coords.tolist()
+    ring_offsets = ring_offsets.tolist()
+    geom_rings = np.searchsorted(ring_geom, np.arange(len(names) + 1)).tolist()
 
-def titles(e):
-    while True:
-        title = e.get(args.attr)
-        if title is not None:
-            yield title
-            e = e.getparent()
-        else:
-            break
+    result = []
+    for index, name in enumerate(names):
+        first, last = geom_rings[index], geom_rings[index + 1]
+        if first == last:
+            continue
+        rings = [xy[ring_offsets[i]:ring_offsets[i + 1]] for i in range(first, last)]
+        name = name or 'Shape%04d' % (len(result) + 1)
+        result.append(backend.freeform(rings, GREY, name))
+    return result
 
-shapes = []
-def callback(e, shape):
-    shape.Fill.ForeColor.RGB = _color.msrgb('#ccc')
-    shape.Fill.Visible = msoTrue
-    shapes.append(shape)
-    name = ':'.join(reversed(list(titles(e))))
-    n = len(shapes)
-    if not name:
-        name = 'Shape%04d' % n
-    Base.Cells(2 + n, 1).Value = 0
-    Base.Cells(2 + n, 2).Value = shape.Name = name
 
-svg = open(args.svgfile).read()
-svg2mso(Base, svg, callback=callback)
+def main(backend, args):
+    backend.open(shape.template_file)
+    names = draw(backend, args.svgfile, args.attr)
 
-# Set the gradient
-Base.Cells(1, 1).Value = 'Colors'
-Base.Cells(1, 2).Value = 0.0
-Base.Cells(1, 3).Value = 0.5
-Base.Cells(1, 4).Value = 1.0
-Base.Cells(1, 2).Interior.Color = 255      # Red
-Base.Cells(1, 3).Interior.Color = 65535    # Yellow
-Base.Cells(1, 4).Interior.Color = 5296274  # Green
+    # Write the shape names from row 3 in one go
+    backend.cells(3, 1, [[0, name] for name in names])
 
-button = Base.Buttons().Add(332, 0, 48, 14.4)
-button.OnAction = "Sheet1.Filter"
-button.Characters.Text = "Filter"
+    # Set the gradient
+    backend.cells(1, 1, [['Colors', 0.0, 0.5, 1.0]])
+    backend.color(1, 2, 255)        # Red
+    backend.color(1, 3, 65535)      # Yellow
+    backend.color(1, 4, 5296274)    # Green
 
-button = Base.Buttons().Add(384, 0, 48, 14.4)
-button.OnAction = "Sheet1.Refresh"
-button.Characters.Text = "Refresh"
+    backend.button(332, 0, 48, 14.4, 'Filter', 'Sheet1.Filter')
+    backend.button(384, 0, 48, 14.4, 'Refresh', 'Sheet1.Refresh')
 
-vbproj = Workbook.VBProject
-codemod = vbproj.VBComponents('Sheet1').CodeModule
-source = open('svgmap.bas').read()
-if args.license:
-    source = source.replace('LICENSEKEY', args.license)
-if args.expiry:
-    source = source.replace('01/01/2013', args.expiry)
+    with io.open(vbscript_file, encoding='utf-8') as handle:
+        source = handle.read()
+    if args.license:
+        source = source.replace('LICENSEKEY', args.license)
+    if args.expiry:
+        source = source.replace('01/01/2013', args.expiry)
+    backend.vba(source)
 
-for line, row in enumerate(source.split('\n')):
-    codemod.InsertLines(line + 1, row)
+    filename = os.path.abspath(args.out + '.xlsm')
+    shape.delete(filename)
+    print('Saving as', filename)
+    backend.save(filename, 'Map')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('svgfile')
+    parser.add_argument('-o', '--out', help='Output .xlsm name. Default: Same as svgfile')
+    parser.add_argument('-l', '--license', help='motherboard id')
+    parser.add_argument('-e', '--expiry', help='mm/dd/yyyy')
+    parser.add_argument('-a', '--attr', help='attribute to take ID from', default='title')
+    parser.add_argument('-b', '--backend', help='excel (default) or xlsx (write .xlsm directly)',
+                        choices=sorted(shape.backends), default='excel')
+    parser.add_argument('-v', '--view', help='View Excel while rendering', action='store_true')
+    args = parser.parse_args()
+    args.out = args.out or os.path.splitext(args.svgfile)[0]
+
+    backend = shape.backends[args.backend](visible=args.view)
+    try:
+        main(backend, args)
+    finally:
+        backend.quit()
@@ -0,0 +1,339 @@
+'''
+Reads the shapes in an SVG file as rings of points, like topology.rings.
+
+The SVG is parsed a node at a time with lxml's iterparse, keeping only the
+ancestors of the current node. Each path, polygon, polyline, rect, circle and
+ellipse becomes a geometry. Its sub-paths become rings. Lines, Béziers and arcs
+are collected as cubic Bézier control points (lines are straight cubics) with
+all transforms applied. Once the whole file is read, every curve is flattened
+in one batch, each into just enough segments to be within a tolerance of it.
+
+Each geometry is named by the attr (e.g. title) of the element and its
+ancestors, joined by ":" from the outermost down. The chain stops at the first
+ancestor without attr, and is empty if the element has none.
+'''
+from __future__ import division, unicode_literals
+
+import re
+import math
+import numpy as np
+from lxml import etree
+import topology
+
+TOLERANCE = 0.001       # Flatten curves to within this fraction of the drawing's size
+MAX_STEPS = 64          # Maximum number of segments to flatten a curve into
+SHAPES = {'path', 'polygon', 'polyline', 'rect', 'circle', 'ellipse'}
+# Elements whose children are not drawn where they are defined
+HIDDEN = {'defs', 'clipPath', 'mask', 'marker', 'pattern', 'symbol', 'metadata'}
+# Number of arguments each path command takes
+ARGS = {'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4, 'Q': 4, 'T': 2, 'A': 7, 'Z': 0}
+
+_command = re.compile(r'[\s,]*([MmZzLlHhVvCcSsQqTtAa])')
+_number = re.compile(r'[\s,]*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+_flag = re.compile(r'[\s,]*([01])')
+_display_none = re.compile(r'(?:^|;)\s*display\s*:\s*none\s*(?:;|$)')
+_transform = re.compile(r'(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)')
+
+
+def read(path, attr='title', tolerance=None):
+    '''
+    Return the shapes of an SVG file as ``(coords, ring_offsets, ring_geom, names)``.
+    Ring i is ``coords[ring_offsets[i]:ring_offsets[i + 1]]`` and belongs to
+    geometry ``ring_geom[i]``, whose name is ``names[ring_geom[i]]``. Curves are
+    flattened to within tolerance (default: TOLERANCE times the drawing's size).
+    '''
+    # Control points of each segment, the ring it is in, whether it is curved, and
+    # the geometry of each ring
+    controls, seg_ring, curved, ring_geom, names = [], [], [], [], []
+    rings = 0
+    # Transform matrix, name chain and hidden state of each ancestor
+    stack = [(np.eye(3), [], False)]
+    # Do not expand entities or fetch anything over the network: SVG files may be untrusted
+    events = etree.iterparse(path, events=('start', 'end'), huge_tree=True,
+                             resolve_entities=False, no_network=True)
+    for event, element in events:
+        if not isinstance(element.tag, str):
+            continue
+        if event == 'end':
+            stack.pop()
+            # Free elements already read. The stack holds all we need of them
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            continue
+        matrix, chain, hidden = stack[-1]
+        tag = etree.QName(element).localname
+        if element.get('transform'):
+            matrix = matrix.dot(parse_transform(element.get('transform')))
+        title = element.get(attr)
+        chain = chain + [title] if title is not None else []
+        hidden = hidden or tag in HIDDEN or element.get('display') == 'none' or bool(
+            _display_none.search(element.get('style', '')))
+        stack.append((matrix, chain, hidden))
+        if hidden or tag not in SHAPES:
+            continue
+        segments = list(shape_segments(tag, element))
+        if not segments:
+            continue
+        xy = np.array([points for ring, points, curve in segments], dtype=float).reshape(-1, 2)
+        controls.append((xy.dot(matrix[:2, :2].T) + matrix[:2, 2]).reshape(-1, 8))
+        seg_ring.extend(rings + ring for ring, points, curve in segments)
+        curved.extend(curve for ring, points, curve in segments)
+        count = segments[-1][0] + 1
+        ring_geom.extend([len(names)] * count)
+        rings += count
+        names.append(':'.join(chain))
+
+    if not controls:
+        return np.zeros((0, 2)), np.zeros(1, dtype=np.intp), np.zeros(0, dtype=np.intp), []
+    controls = np.concatenate(controls)
+    if tolerance is None:
+        xy = controls.reshape(-1, 2)
+        tolerance = TOLERANCE * (xy.max(axis=0) - xy.min(axis=0)).max() or TOLERANCE
+    coords, point_ring = flatten(controls, np.array(seg_ring), np.array(curved), tolerance)
+    ring_offsets = np.zeros(rings + 1, dtype=np.intp)
+    np.cumsum(np.bincount(point_ring, minlength=rings), out=ring_offsets[1:])
+    ring_geom = np.array(ring_geom, dtype=np.intp)
+    # Drop rings too small to enclose anything
+    keep = np.diff(ring_offsets) >= 3
+    if not keep.all():
+        coords = coords[np.repeat(keep, np.diff(ring_offsets))]
+        ring_offsets = np.concatenate([[0], np.cumsum(np.diff(ring_offsets)[keep])])
+        ring_geom = ring_geom[keep]
+    return coords, ring_offsets, ring_geom, names
+
+
+def flatten(controls, seg_ring, curved, tolerance, max_steps=MAX_STEPS):
+    '''
+    Flatten cubic Béziers with (n, 8) control points into points, all at once.
+    Consecutive segments with the same seg_ring form a ring. Returns
+    ``(coords, point_ring)``: every ring's start, then each segment's points.
+    Straight segments (not curved) add just their end point.
+    '''
+    p0, p1, p2, p3 = controls[:, 0:2], controls[:, 2:4], controls[:, 4:6], controls[:, 6:8]
+    # A cubic is within tolerance of n segments if 3/4 * max |2nd difference| / n^2 <= tolerance
+    bend = np.maximum(np.hypot(*(p0 - 2 * p1 + p2).T), np.hypot(*(p1 - 2 * p2 + p3).T))
+    steps = np.clip(np.ceil(np.sqrt(0.75 * bend / tolerance)), 1, max_steps).astype(np.intp)
+    steps[~curved] = 1
+    # The first segment of each ring also adds its start point, at t = 0
+    first = np.ones(len(controls), dtype=bool)
+    first[1:] = seg_ring[1:] != seg_ring[:-1]
+    step, owner = topology.ranges(1 - first.astype(np.intp), steps + 1)
+    t = (step / steps[owner])[:, None]
+    u = 1 - t
+    terms = (u ** 3 * p0[owner], 3 * u * u * t * p1[owner], 3 * u * t * t * p2[owner],
+             t ** 3 * p3[owner])
+    return sum(terms), seg_ring[owner]
+
+
+def shape_segments(tag, element):
+    '''
+    Yield (ring, control points, curved) for each segment of an SVG shape
+    element. ring counts the element's rings from 0. Control points are
+    (x0, y0, x1, y1, x2, y2, x3, y3) of a cubic Bézier.
+    '''
+    def number(key):
+        return parse_number(element.get(key))
+
+    if tag == 'path':
+        for segment in path_segments(element.get('d', '')):
+            yield segment
+    elif tag in ('polygon', 'polyline'):
+        values = [float(v) for v in _number.findall(element.get('points', ''))]
+        points = list(zip(values[0:-1:2], values[1::2]))
+        # Close the ring, as a fill would
+        if points and points[0] != points[-1]:
+            points.append(points[0])
+        for start, end in zip(points, points[1:]):
+            yield 0, line(start, end), False
+    elif tag == 'rect':
+        x, y, width, height = number('x'), number('y'), number('width'), number('height')
+        if width > 0 and height > 0:
+            corners = [(x, y), (x + width, y), (x + width, y + height), (x, y + height), (x, y)]
+            for start, end in zip(corners, corners[1:]):
+                yield 0, line(start, end), False
+    elif tag in ('circle', 'ellipse'):
+        rx = number('r' if tag == 'circle' else 'rx')
+        ry = number('r' if tag == 'circle' else 'ry')
+        cx, cy = number('cx'), number('cy')
+        if rx > 0 and ry > 0:
+            for quarter in range(4):
+                start, end = quarter * math.pi / 2, (quarter + 1) * math.pi / 2
+                yield 0, arc_cubic(cx, cy, rx, ry, 0, start, end), True
+
+
+def parse_number(text):
+    '''Return the number at the start of text (ignoring units), or 0'''
+    match = _number.match(text or '')
+    return float(match.group(1)) if match else 0.0
+
+
+def line(start, end):
+    '''Return the control points of a straight line as a cubic Bézier'''
+    return start + start + end + end
+
+
+def path_segments(d):
+    '''
+    Yield (ring, control points, curved) for each segment of SVG path data d,
+    like shape_segments. Each sub-path is a ring. Parsing stops at an error.
+    '''
+    ring = -1
+    x = y = start_x = start_y = 0.0
+    last, control = None, None
+    pos = 0
+    while True:
+        match = _command.match(d, pos)
+        if not match:
+            return
+        pos, command = match.end(), match.group(1)
+        kind, relative = command.upper(), command.islower()
+        if kind == 'Z':
+            if (x, y) != (start_x, start_y):
+                yield ring, line((x, y), (start_x, start_y)), False
+            x, y, last = start_x, start_y, 'Z'
+            continue
+        first = True
+        while True:
+            args, pos = path_args(d, pos, kind)
+            if args is None:
+                if first:
+                    return
+                break
+            dx, dy = (x, y) if relative else (0.0, 0.0)
+            # Drawing after Z (without M) starts a new ring from the same point
+            if kind != 'M' and last in (None, 'Z'):
+                ring, last = ring + 1, kind
+            if kind == 'M':
+                if first:
+                    x, y = args[0] + dx, args[1] + dy
+                    start_x, start_y, ring, last = x, y, ring + 1, 'M'
+                    first = False
+                    continue
+                kind = 'L'
+            if kind in ('L', 'H', 'V'):
+                end = ((args[0] + dx, args[1] + dy) if kind == 'L' else
+                       (args[0] + dx, y) if kind == 'H' else (x, args[0] + dy))
+                yield ring, line((x, y), end), False
+                control = None
+            elif kind in ('C', 'S'):
+                if kind == 'C':
+                    c1 = (args[0] + dx, args[1] + dy)
+                    args = args[2:]
+                else:
+                    c1 = reflect(x, y, control if last in ('C', 'S') else None)
+                c2, end = (args[0] + dx, args[1] + dy), (args[2] + dx, args[3] + dy)
+                yield ring, (x, y) + c1 + c2 + end, True
+                control = c2
+            elif kind in ('Q', 'T'):
+                if kind == 'Q':
+                    q = (args[0] + dx, args[1] + dy)
+                    end = (args[2] + dx, args[3] + dy)
+                else:
+                    q = reflect(x, y, control if last in ('Q', 'T') else None)
+                    end = (args[0] + dx, args[1] + dy)
+                # Raise the quadratic to a cubic
+                c1 = (x + 2 * (q[0] - x) / 3, y + 2 * (q[1] - y) / 3)
+                c2 = (end[0] + 2 * (q[0] - end[0]) / 3, end[1] + 2 * (q[1] - end[1]) / 3)
+                yield ring, (x, y) + c1 + c2 + end, True
+                control = q
+            elif kind == 'A':
+                end = (args[5] + dx, args[6] + dy)
+                for points in arc_cubics((x, y), end, *args[:5]):
+                    yield ring, points, True
+                control = None
+            x, y = end
+            last = kind
+            first = False
+
+
+def path_args(d, pos, kind):
+    '''Return (arguments, position after them) for a path command, or (None, pos)'''
+    args = []
+    for index in range(ARGS[kind]):
+        match = (_flag if kind == 'A' and index in (3, 4) else _number).match(d, pos)
+        if not match:
+            return None, pos
+        args.append(float(match.group(1)))
+        pos = match.end()
+    return args, pos
+
+
+def reflect(x, y, control):
+    '''Return the reflection of the previous control point about (x, y)'''
+    return (x, y) if control is None else (2 * x - control[0], 2 * y - control[1])
+
+
+def arc_cubic(cx, cy, rx, ry, phi, start, end):
+    '''Return cubic control points for an elliptical arc of at most 90 degrees'''
+    k = 4 / 3 * math.tan((end - start) / 4)
+    cos, sin = math.cos(phi), math.sin(phi)
+
+    def point(angle, scale):
+        # Point at angle, offset along the tangent by scale
+        ex = rx * (math.cos(angle) - scale * math.sin(angle))
+        ey = ry * (math.sin(angle) + scale * math.cos(angle))
+        return (cx + cos * ex - sin * ey, cy + sin * ex + cos * ey)
+
+    return point(start, 0) + point(start, k) + point(end, -k) + point(end, 0)
+
+
+def arc_cubics(start, end, rx, ry, angle, large, sweep):
+    '''
+    Return cubic control points approximating an SVG elliptical arc from start
+    to end. See https://www.w3.org/TR/SVG/implnote.html#ArcImplementationNotes
+    '''
+    rx, ry = abs(rx), abs(ry)
+    if start == end:
+        return []
+    if not rx or not ry:
+        return [line(start, end)]
+    phi = math.radians(angle)
+    cos, sin = math.cos(phi), math.sin(phi)
+    hx, hy = (start[0] - end[0]) / 2, (start[1] - end[1]) / 2
+    x1, y1 = cos * hx + sin * hy, -sin * hx + cos * hy
+    # Scale up radii that are too small to reach the end point
+    scale = (x1 / rx) ** 2 + (y1 / ry) ** 2
+    if scale > 1:
+        rx, ry = rx * math.sqrt(scale), ry * math.sqrt(scale)
+    num = rx * rx * ry * ry - rx * rx * y1 * y1 - ry * ry * x1 * x1
+    den = rx * rx * y1 * y1 + ry * ry * x1 * x1
+    root = math.sqrt(max(num, 0) / den) * (-1 if large == sweep else 1)
+    cx1, cy1 = root * rx * y1 / ry, -root * ry * x1 / rx
+    cx = cos * cx1 - sin * cy1 + (start[0] + end[0]) / 2
+    cy = sin * cx1 + cos * cy1 + (start[1] + end[1]) / 2
+    theta = math.atan2((y1 - cy1) / ry, (x1 - cx1) / rx)
+    delta = math.atan2((-y1 - cy1) / ry, (-x1 - cx1) / rx) - theta
+    if sweep and delta < 0:
+        delta += 2 * math.pi
+    elif not sweep and delta > 0:
+        delta -= 2 * math.pi
+    count = max(int(math.ceil(abs(delta) / (math.pi / 2) - 1e-9)), 1)
+    return [arc_cubic(cx, cy, rx, ry, phi, theta + delta * i / count,
+                      theta + delta * (i + 1) / count) for i in range(count)]
+
+
+def parse_transform(text):
+    '''Return the 3x3 matrix of an SVG transform attribute'''
+    result = np.eye(3)
+    for name, values in _transform.findall(text):
+        v = [float(value) for value in _number.findall(values)]
+        if name == 'matrix' and len(v) == 6:
+            matrix = [[v[0], v[2], v[4]], [v[1], v[3], v[5]]]
+        elif name == 'translate' and v:
+            matrix = [[1, 0, v[0]], [0, 1, v[1] if len(v) > 1 else 0]]
+        elif name == 'scale' and v:
+            matrix = [[v[0], 0, 0], [0, v[1] if len(v) > 1 else v[0], 0]]
+        elif name == 'rotate' and v:
+            a = math.radians(v[0])
+            cx, cy = (v[1], v[2]) if len(v) == 3 else (0, 0)
+            cos, sin = math.cos(a), math.sin(a)
+            matrix = [[cos, -sin, cx - cos * cx + sin * cy], [sin, cos, cy - sin * cx - cos * cy]]
+        elif name == 'skewX' and v:
+            matrix = [[1, math.tan(math.radians(v[0])), 0], [0, 1, 0]]
+        elif name == 'skewY' and v:
+            matrix = [[1, 0, 0], [math.tan(math.radians(v[0])), 1, 0]]
+        else:
+            continue
+        result = result.dot(np.array(matrix + [[0, 0, 1]], dtype=float))
+    return result
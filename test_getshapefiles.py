@@ -0,0 +1,117 @@
+'''
+Tests for getshapefiles.py's resumable downloads, against a local HTTP server. Run with pytest.
+'''
+from __future__ import unicode_literals
+
+import io
+import os
+import pytest
+import threading
+import getshapefiles
+from zipfile import ZipFile
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+def make_zip(name):
+    '''Return the bytes of a ZIP file with one member called name'''
+    handle = io.BytesIO()
+    with ZipFile(handle, 'w') as zip_file:
+        zip_file.writestr(name, os.urandom(1000))
+    return handle.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Serve self.server.files ({path: bytes}), honouring "Range: bytes=N-" like GADM'''
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data = self.server.files[self.path]
+        start = int(self.headers['Range'][6:-1]) if self.headers.get('Range') else 0
+        if start >= len(data):
+            self.send_error(416)
+            return
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(getshapefiles.time, 'sleep', lambda seconds: None)
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    httpd.files, httpd.requests = {}, []
+    httpd.url = 'http://127.0.0.1:%d' % httpd.server_port
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+
+
+def test_resume_truncated_file(server, tmp_path):
+    data = server.files['/a.zip'] = make_zip('a.shp')
+    path = str(tmp_path / 'a.zip')
+    with open(path, 'wb') as handle:
+        handle.write(data[:len(data) // 2])
+    session = getshapefiles.http_session()
+    assert getshapefiles.fetch((session, server.url + '/a.zip', path)) == path
+    assert server.requests == [('/a.zip', 'bytes=%d-' % (len(data) // 2))]
+    with open(path, 'rb') as handle:
+        assert handle.read() == data
+    assert not os.path.exists(path + '.part')
+
+
+def test_complete_part_file(server, tmp_path):
+    # The server answers 416 when the .part file already has every byte
+    data = server.files['/a.zip'] = make_zip('a.shp')
+    path = str(tmp_path / 'a.zip')
+    with open(path + '.part', 'wb') as handle:
+        handle.write(data)
+    session = getshapefiles.http_session()
+    assert getshapefiles.download(session, server.url + '/a.zip', path) == path
+    assert server.requests == [('/a.zip', 'bytes=%d-' % len(data))]
+    assert getshapefiles.valid_zip(path)
+
+
+def test_corrupt_file_fetched_again(server, tmp_path):
+    data = server.files['/a.zip'] = make_zip('a.shp')
+    path = str(tmp_path / 'a.zip')
+    with open(path, 'wb') as handle:
+        handle.write(b'x' * len(data))
+    assert not getshapefiles.valid_zip(path)
+    session = getshapefiles.http_session()
+    assert getshapefiles.fetch((session, server.url + '/a.zip', path)) == path
+    # The corrupt file is complete, so the resume gets a 416. It is then deleted and refetched
+    assert server.requests == [('/a.zip', 'bytes=%d-' % len(data)), ('/a.zip', None)]
+    with open(path, 'rb') as handle:
+        assert handle.read() == data
+
+
+def test_download_files_yields_every_file(server, tmp_path):
+    codes = ['AFG', 'IND', 'LKA', 'NPL', 'BTN']
+    server.files['/country'] = (
+        '<select name="cnt">%s<option>none</option></select>' % ''.join(
+            '<option value="%s_x">%s</option>' % (code, code) for code in codes)).encode()
+    for code in codes:
+        server.files['/shp/%s_adm_shp.zip' % code] = make_zip(code + '.shp')
+    # One file fails on every attempt, and is skipped
+    del server.files['/shp/NPL_adm_shp.zip']
+    paths = getshapefiles.gadm_download_files(
+        str(tmp_path), jobs=3, page_url=server.url + '/country', shp_url=server.url + '/shp/')
+    folder = os.path.join(str(tmp_path), 'gadmzips', 'zipfiles')
+    assert sorted(paths) == [os.path.join(folder, '%s_adm_shp.zip' % code)
+                             for code in sorted(codes) if code != 'NPL']
+    # Every file present and valid is not downloaded again
+    server.requests[:] = []
+    paths = getshapefiles.gadm_download_files(
+        str(tmp_path), jobs=3, page_url=server.url + '/country', shp_url=server.url + '/shp/')
+    assert len(list(paths)) == 4
+    assert server.requests == [('/country', None), ('/shp/NPL_adm_shp.zip', None)] + [
+        ('/shp/NPL_adm_shp.zip', None)] * getshapefiles.RETRIES
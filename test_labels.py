@@ -0,0 +1,43 @@
+'''
+Tests for labels.py's label placement. Run with pytest.
+'''
+from __future__ import unicode_literals
+
+import numpy as np
+import labels
+
+
+def edges(*rings):
+    '''Return the edges of rings given as lists of (x, y) points'''
+    xy = np.concatenate([np.array(ring, dtype=float) for ring in rings])
+    ring_offsets = np.concatenate([[0], np.cumsum([len(ring) for ring in rings])])
+    return labels.ring_edges(xy, ring_offsets, np.zeros(len(rings), dtype=np.intp))[0]
+
+
+def test_polylabel_square():
+    square = edges([[0, 0], [10, 0], [10, 10], [0, 10]])
+    assert np.hypot(*(labels.polylabel(square, 0.1) - (5, 5))) <= 0.1
+    assert labels.distance(np.array([[5, 5], [20, 5]]), square).tolist() == [5, -10]
+
+
+def test_polylabel_concave():
+    # A U shape, whose centroid (and bounding box centre) is in the gap
+    shape = edges([[0, 0], [30, 0], [30, 30], [20, 30], [20, 10], [10, 10], [10, 30], [0, 30]])
+    best = labels.polylabel(shape, 0.01)
+    dist = labels.distance(best[None], shape)[0]
+    assert dist > 0
+    # No point on a fine grid is farther from the edges
+    grid = np.stack(np.mgrid[0:30:0.25, 0:30:0.25], axis=-1).reshape(-1, 2)
+    assert labels.distance(grid, shape).max() <= dist + 0.01
+
+
+def test_polylabel_hole():
+    # The pole of a square with a hole at its centre is between the hole and the outside
+    shape = edges([[0, 0], [40, 0], [40, 40], [0, 40]], [[15, 15], [15, 25], [25, 25], [25, 15]])
+    best = labels.polylabel(shape, 0.01)
+    assert labels.distance(best[None], shape)[0] >= 7.5 - 0.01
+
+
+def test_polylabel_degenerate():
+    line = edges([[0, 0], [10, 0], [5, 0]])
+    assert labels.polylabel(line).tolist() == [0, 0]
@@ -0,0 +1,58 @@
+'''
+Tests for lookup.py's point-in-feature search. Run with pytest.
+'''
+from __future__ import unicode_literals
+
+import io
+import os
+import json
+import numpy as np
+import labels
+import lookup
+import topology
+
+folder = os.path.dirname(os.path.abspath(__file__))
+
+
+def square(x, y, size):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+
+def test_find(tmp_path):
+    # Two squares side by side in Telangana, and one with a hole
+    path = str(tmp_path / 'squares.json')
+    ring = square(80, 17, 1)
+    hole = square(80.25, 17.25, 0.5)[::-1]
+    topo = {
+        'type': 'Topology',
+        'arcs': [square(78, 17, 1), square(79, 17, 1), ring, hole],
+        'objects': {'squares': {'type': 'GeometryCollection', 'geometries': [
+            {'type': 'Polygon', 'arcs': [[0]], 'properties': {'n': 'a', 's': 'x'}},
+            {'type': 'Polygon', 'arcs': [[1]], 'properties': {'n': 'b', 's': 'y'}},
+            {'type': 'Polygon', 'arcs': [[2], [3]], 'properties': {'n': 'c', 's': 'x'}},
+        ]}},
+    }
+    with io.open(path, 'w', encoding='utf-8') as handle:
+        handle.write(json.dumps(topo))
+
+    index = lookup.Lookup(path, key='n', band_edges=2)
+    assert index.ids == ['a', 'b', 'c']
+    lon = [78.5, 79.5, 80.1, 80.5, 81.5, 78.5, float('nan')]
+    lat = [17.5, 17.2, 17.9, 17.5, 17.5, 16.5, 17.5]
+    assert index.find(lon, lat).tolist() == [0, 1, 2, -1, -1, -1, -1]
+    assert index.lookup(lon, lat, default='-') == ['a', 'b', 'c', '-', '-', '-', '-']
+    # Filters restrict the features searched
+    index = lookup.Lookup(path, key='n', filters='s=x')
+    assert index.lookup(lon[:3], lat[:3]) == ['a', '', 'c']
+
+
+def test_find_in_map():
+    # The pole of inaccessibility of each feature, in lon/lat, lies in that feature
+    path = os.path.join(folder, 'maps', 'S01_PC.json')
+    index = lookup.Lookup(path)
+    topo = topology.load(path)
+    points, ring_offsets, ring_geom, _ = topology.rings(topo, topo.selected)
+    edges, edge_geom = labels.ring_edges(topo.points[points], ring_offsets, ring_geom)
+    lon, lat = np.array([labels.polylabel(edges[edge_geom == geom], 1e-3)
+                         for geom in range(len(topo))]).T
+    assert index.find(lon, lat).tolist() == list(range(len(topo)))
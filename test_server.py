@@ -0,0 +1,82 @@
+'''
+Tests for server.py's map handlers, rendering in this process with the xlsx backend.
+Run with pytest.
+'''
+from __future__ import unicode_literals
+
+import os
+import time
+import shutil
+import tempfile
+import tornado.gen
+import tornado.testing
+from concurrent.futures import ThreadPoolExecutor
+import shape
+import server
+
+QUERY = '/map.%s?topo=S01_AC.json&filters=AC_NAME=Adilabad'
+
+
+class TestServer(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.renders = []
+        super(TestServer, self).setUp()
+
+    def tearDown(self):
+        super(TestServer, self).tearDown()
+        self.renderer.pool.shutdown()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def get_app(self):
+        cache = server.Cache(os.path.join(self.folder, 'cache'), 2 ** 30)
+        self.renderer = server.Renderer(os.path.join(server.folder, 'maps'), cache, 'xlsx')
+        # Render in a thread of this process, counting renders
+        self.renderer.pool.shutdown()
+        shape.init_worker('xlsx', False)
+        self.renderer.pool = ThreadPoolExecutor(1)
+
+        def render(arg, target):
+            # Render slowly enough for concurrent requests to arrive while it runs
+            self.renders.append(target)
+            time.sleep(0.2)
+            return original(arg, target)
+
+        original, server.render = server.render, render
+        self.addCleanup(setattr, server, 'render', original)
+        return server.application(self.renderer)
+
+    def test_png_and_svg(self):
+        response = self.fetch(QUERY % 'png')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'image/png')
+        self.assertTrue(response.body.startswith(b'\x89PNG'))
+        response = self.fetch(QUERY % 'svg')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'<svg', response.body)
+        # Both formats come from one render
+        self.assertEqual(len(self.renders), 1)
+
+    def test_outside_maps(self):
+        for topo in ('../server.py', '..%2Fserver.py', 'missing.json'):
+            self.assertEqual(self.fetch('/map.svg?topo=' + topo).code, 404)
+        self.assertEqual(self.renders, [])
+
+    def test_bad_options(self):
+        response = self.fetch('/map.svg?topo=S01_AC.json&filters=AC_NAME=Nowhere')
+        self.assertEqual(response.code, 400)
+        for value in ('nan', 'inf', '-1', 'x'):
+            response = self.fetch('/map.svg?topo=S01_AC.json&simplify=' + value)
+            self.assertEqual(response.code, 400)
+        self.assertEqual(self.renders, [])
+
+    @tornado.testing.gen_test(timeout=60)
+    def test_concurrent_requests_render_once(self):
+        client = self.http_client
+        responses = yield tornado.gen.multi([
+            client.fetch(self.get_url(QUERY % 'svg')), client.fetch(self.get_url(QUERY % 'svg'))])
+        self.assertEqual([response.code for response in responses], [200, 200])
+        self.assertEqual(responses[0].body, responses[1].body)
+        self.assertEqual(len(self.renders), 1)
+        self.assertEqual(self.renderer.pending, {})
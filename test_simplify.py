@@ -0,0 +1,69 @@
+'''
+Tests for simplify.py's Douglas-Peucker simplification. Run with pytest.
+'''
+from __future__ import unicode_literals
+
+import numpy as np
+import simplify
+
+
+def arcs():
+    '''Return a random walk split into 3 arcs sharing end points, and a closed ring'''
+    random = np.random.RandomState(0)
+    walk = np.cumsum(random.normal(size=(300, 2)), axis=0)
+    angle = np.linspace(0, 2 * np.pi, 101)
+    ring = np.column_stack([np.cos(angle), np.sin(angle)]) * 50 + random.normal(size=(101, 2))
+    ring[-1] = ring[0]
+    coords = np.concatenate([walk[:100], walk[99:200], walk[199:], ring])
+    offsets = np.array([0, 100, 201, 302, 403])
+    return coords, offsets
+
+
+def max_error(coords, offsets, result, result_offsets):
+    '''Return the distance of the farthest original point from its simplified arc'''
+    error = 0
+    for arc in range(len(offsets) - 1):
+        points = coords[offsets[arc]:offsets[arc + 1]]
+        kept = result[result_offsets[arc]:result_offsets[arc + 1]]
+        dist = np.min([
+            simplify.segment_distance(points, np.tile(start, (len(points), 1)),
+                                      np.tile(end, (len(points), 1)))
+            for start, end in zip(kept[:-1], kept[1:])], axis=0)
+        error = max(error, dist.max())
+    return error
+
+
+def test_tolerance():
+    coords, offsets = arcs()
+    for tolerance in (0.5, 2, 10):
+        result, result_offsets, removed = simplify.simplify(coords, offsets, tolerance)
+        assert removed == len(coords) - len(result) > 0
+        assert max_error(coords, offsets, result, result_offsets) <= tolerance
+    result, result_offsets, removed = simplify.simplify(coords, offsets, 0)
+    assert removed == 0 and np.array_equal(result, coords)
+
+
+def test_end_points_kept():
+    coords, offsets = arcs()
+    result, result_offsets, removed = simplify.simplify(coords, offsets, 1000)
+    assert len(result_offsets) == len(offsets)
+    # Arcs keep their end points, so arcs that shared them still meet
+    assert np.array_equal(result[result_offsets[:-1]], coords[offsets[:-1]])
+    assert np.array_equal(result[result_offsets[1:] - 1], coords[offsets[1:] - 1])
+    # The ring keeps 2 interior points, so it does not collapse into a line
+    assert np.diff(result_offsets).tolist() == [2, 2, 2, 4]
+    # Arcs not listed are not simplified
+    result, result_offsets, removed = simplify.simplify(coords, offsets, 1000, np.array([1]))
+    assert np.diff(result_offsets).tolist() == [100, 2, 101, 101]
+
+
+def test_proportion():
+    coords, offsets = arcs()
+    interior = len(coords) - 2 * (len(offsets) - 1) - 2
+    result, result_offsets, removed = simplify.proportion(coords, offsets, 0.25)
+    assert len(result) - (len(coords) - interior) == round(interior * 0.25)
+    assert np.array_equal(result[result_offsets[:-1]], coords[offsets[:-1]])
+    # Points are no farther from the arcs than the heaviest point dropped
+    weights = simplify.weights(coords, offsets)
+    tolerance = np.sort(weights[np.isfinite(weights)])[-round(interior * 0.25) - 1]
+    assert max_error(coords, offsets, result, result_offsets) <= tolerance
@@ -0,0 +1,144 @@
+'''
+Tests for topology.py: its streaming TopoJSON reader, binary format, subsets and adjacency.
+'''
+from __future__ import unicode_literals
+
+import io
+import os
+import json
+import numpy as np
+import topology
+
+folder = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_properties_after_arcs(tmp_path):
+    # Non-ASCII properties after the arcs array, as mapshaper writes them
+    path = str(tmp_path / 'unicode.json')
+    with io.open(path, 'w', encoding='utf-8') as handle:
+        handle.write(
+            '{"type":"Topology","arcs":[[[0,0],[1,0],[0,1]]],"objects":{"a":'
+            '{"type":"GeometryCollection","geometries":[{"type":"Polygon",'
+            '"arcs":[[0]],"properties":{"n":"Çé"}}]}}}')
+    topo = topology.read(path)
+    assert topo.strings('n') == ['Çé']
+    assert topo.points.tolist() == [[0, 0], [1, 0], [0, 1]]
+    assert topology.read(path, arcs=False).strings('n') == ['Çé']
+    assert topology.load_properties(path).strings('n') == ['Çé']
+
+
+def test_chunk_ends_after_last_position():
+    # Every chunk size, including those that leave just the closing brackets for a chunk
+    text = '[[[0,0],[1,0]],[[2,3]]] ,"objects":"é"'
+    for size in range(1, len(text) + 1):
+        reader = topology.Reader(io.StringIO(text), chunk_size=size)
+        points, lengths = topology.read_arcs(reader)
+        assert points.tolist() == [[0, 0], [1, 0], [2, 3]]
+        assert lengths.tolist() == [2, 1]
+        assert reader.next(',') == ','
+        reader = topology.Reader(io.StringIO(text), chunk_size=size)
+        topology.skip_arcs(reader)
+        assert reader.next(',') == ','
+
+
+def test_padded_map():
+    # Pad S01_PC.json so that a chunk ends right after the last position
+    with io.open(os.path.join(folder, 'maps', 'S01_PC.json'), encoding='utf-8') as handle:
+        text = handle.read()
+    data = json.loads(text)
+    arcs = json.dumps(data.pop('arcs'), separators=(',', ':'))
+    last = arcs.rfind(']', 0, len(arcs) - 2) + 1
+    padding = ' ' * (topology.CHUNK_SIZE - len('{"arcs":') - last)
+    text = '{"arcs":' + padding + arcs + ',' + json.dumps(data)[1:]
+    reader = topology.Reader(io.StringIO(text))
+    reader.next('{')
+    assert reader.value() == 'arcs'
+    reader.next(':')
+    points, lengths = topology.read_arcs(reader)
+    assert len(lengths) == len(json.loads(arcs))
+    assert np.array_equal(points, np.concatenate(json.loads(arcs))[:, :2])
+
+
+def load_map(name):
+    return topology.read(os.path.join(folder, 'maps', name))
+
+
+def assert_same_geometries(a, a_geoms, b, b_geoms):
+    # Same types and properties, and the same points in each ring
+    assert a.types[a_geoms].tolist() == b.types[b_geoms].tolist()
+    assert a.rows(a_geoms) == b.rows(b_geoms)
+    a_points, a_offsets, a_ring_geom, a_hole = topology.rings(a, a_geoms)
+    b_points, b_offsets, b_ring_geom, b_hole = topology.rings(b, b_geoms)
+    assert a_offsets.tolist() == b_offsets.tolist()
+    assert a_ring_geom.tolist() == b_ring_geom.tolist()
+    assert np.allclose(a.points[a_points], b.points[b_points])
+
+
+def test_binary_round_trip(tmp_path):
+    topo = load_map('S01_AC.json')
+    path = str(tmp_path / 'S01_AC.topo')
+    topology.save_binary(path, topo, source='S01_AC')
+    back = topology.load_binary(path, source='S01_AC')
+    assert back.names == topo.names
+    for key in topology.ARRAYS:
+        assert getattr(back, key).tolist() == getattr(topo, key).tolist()
+    assert np.allclose(back.points, topo.points)
+    assert_same_geometries(back, back.selected, topo, topo.selected)
+    # A stale file, and the properties alone
+    assert topology.load_binary(path, source='other') is None
+    assert topology.load_binary(path, arcs=False).rows() == topo.rows()
+
+
+def test_subset_and_partition():
+    topo = load_map('S01_AC.json')
+    geoms = np.flatnonzero(topo.columns['PC_NO'].values == 35)
+    part = topology.subset(topo, geoms)
+    assert len(part) == len(geoms)
+    assert_same_geometries(part, part.selected, topo, geoms)
+    # Only the arcs the subset uses are kept
+    assert len(part.offsets) - 1 == len(np.unique(part.used_arcs))
+    assert len(part.offsets) - 1 < len(topo.offsets) - 1
+
+    parts = topology.partition(topo, 'PC_NO')
+    assert list(parts) == sorted(parts)
+    assert sum(len(part) for part in parts.values()) == len(topo)
+    for value, part in parts.items():
+        rows = np.sort(topo.index.values(topo, 'PC_NO')[value])
+        assert_same_geometries(part, part.selected, topo, rows)
+
+
+def test_select():
+    topo = load_map('S01_AC.json')
+    names = topo.strings('AC_NAME')
+    topology.select(topo, {'AC_NAME': {'Adilabad'}})
+    assert topo.strings('AC_NAME') == ['Adilabad']
+    # Values of a key are OR-ed, keys are AND-ed, and select narrows the selection
+    topo = load_map('S01_AC.json')
+    topology.select(topo, {'AC_NAME': {'Adilabad', names[1], 'Nowhere'}})
+    assert sorted(topo.strings('AC_NAME')) == sorted(['Adilabad', names[1]])
+    topology.select(topo, {'AC_TYPE': {'GEN'}})
+    assert topo.strings('AC_NAME') == ['Adilabad']
+    arcs = topo.geom_arcs(topo.selected)
+    assert topo.used_arcs.tolist() == np.unique(np.where(arcs < 0, ~arcs, arcs)).tolist()
+    # Missing properties match ''
+    topo = load_map('S01_AC.json')
+    topology.select(topo, {'MISSING': {''}})
+    assert len(topo) == len(topo.types)
+    topology.select(topo, {'AC_NAME': {'Nowhere'}})
+    assert len(topo) == 0
+
+
+def test_colors_differ_between_neighbours():
+    topo = load_map('IND_adm2.json')
+    offsets, neighbours = topo.adjacency.graph(topo)
+    assert len(neighbours)
+    colors = topo.adjacency.colors(topo, topo.selected, 6)
+    assert colors.min() >= 0 and colors.max() < 6
+    geom = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    assert not (colors[geom] == colors[neighbours]).any()
+    # A subset has the same neighbours, and so the same colours, as in its parent
+    geoms = topo.index.values(topo, 'NAME_1')['Bihar']
+    geoms = np.sort(geoms)
+    part = topology.subset(topo, geoms)
+    expected = topo.adjacency.colors(topo, geoms, 6)
+    assert part.adjacency.colors(part, part.selected, 6).tolist() == expected.tolist()
@@ -0,0 +1,89 @@
+'''
+Times the stages of rendering maps, and counts the work done in them.
+
+Wrap a stage in ``with timing.span('draw'):``. Spans nest, and are reported by
+their path, e.g. ``draw/freeform``. Count work with ``timing.count('points', n)``.
+Both go into the current Stats. ``with timing.collect() as stats:`` starts a
+new one, e.g. per map, and ``stats.report()`` returns its totals.
+``save(path, reports)`` writes reports of several maps as JSON or CSV.
+'''
+from __future__ import unicode_literals
+
+import io
+import csv
+import json
+import timeit
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+class Stats(object):
+    '''Total time and calls of each span (by path), and counters'''
+    def __init__(self):
+        self.spans = OrderedDict()
+        self.counters = OrderedDict()
+        self.stack = []
+
+    def report(self):
+        '''Return the spans as [path, calls, seconds] and the counters, for JSON'''
+        return OrderedDict([
+            ('spans', [[path, calls, round(seconds, 6)]
+                       for path, (calls, seconds) in self.spans.items()]),
+            ('counters', OrderedDict(self.counters)),
+        ])
+
+
+# Spans and counters go into the last Stats in this stack
+_stats = [Stats()]
+
+
+@contextmanager
+def collect():
+    '''Collect spans and counters into a new Stats within this context'''
+    stats = Stats()
+    _stats.append(stats)
+    try:
+        yield stats
+    finally:
+        _stats.remove(stats)
+
+
+@contextmanager
+def span(name):
+    '''Time the code in this context as a stage called name'''
+    stats = _stats[-1]
+    stats.stack.append(name)
+    path = '/'.join(stats.stack)
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        total = stats.spans.setdefault(path, [0, 0.0])
+        total[0] += 1
+        total[1] += timeit.default_timer() - start
+        stats.stack.pop()
+
+
+def count(name, value=1):
+    '''Add value to the counter called name'''
+    counters = _stats[-1].counters
+    counters[name] = counters.get(name, 0) + value
+
+
+def save(path, reports):
+    '''
+    Save reports, a dict of {map name: Stats.report()}, as JSON. If path ends
+    with .csv, save a row per span and counter instead.
+    '''
+    if not path.lower().endswith('.csv'):
+        with io.open(path, 'w', encoding='utf-8') as handle:
+            handle.write(json.dumps(reports, indent=2))
+        return
+    with io.open(path, 'w', encoding='utf-8', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['map', 'type', 'name', 'calls', 'value'])
+        for name, report in reports.items():
+            for path, calls, seconds in report['spans']:
+                writer.writerow([name, 'span', path, calls, seconds])
+            for counter, value in report['counters'].items():
+                writer.writerow([name, 'counter', counter, '', value])
@@ -0,0 +1,1088 @@
+'''
+Loads TopoJSON files once per process into compact Topology objects.
+
+A Topology holds decoded arcs as one contiguous co-ordinate array, the
+geometry > part > ring > arc structure as offset arrays, and properties as a
+columnar table. Geometries are records over these arrays, built on demand.
+
+Files are parsed with a streaming reader that puts arcs straight into NumPy
+arrays, so memory use is proportional to the arrays, not to the JSON text.
+Parsed topologies are kept in a small LRU cache keyed by path and modification
+time. ``load()`` returns a copy whose selection and columns can be changed
+freely, while the arrays are shared.
+
+The first load also saves these arrays as a binary topology file (see
+save_binary) next to it: ``<file>.json.topo``. Later processes memory-map that
+instead of parsing the JSON, as long as the JSON file has not changed since.
+``.topo`` files can also be loaded directly. Run this module to convert
+TopoJSON files into ``.topo`` files, or back.
+'''
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+import re
+import mmap
+import json
+import heapq
+import struct
+import argparse
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+# Number of parsed topologies to keep in memory
+cache_size = 8
+_cache = OrderedDict()
+
+# Number of characters to read at a time when streaming a TopoJSON file
+CHUNK_SIZE = 1 << 16
+# Characters that cannot be in a TopoJSON arcs array
+_not_arcs = re.compile(r'[^\[\],0-9eE.+\- \t\r\n]')
+# Geometry types, stored as their index in this tuple
+TYPES = (None, 'Point', 'MultiPoint', 'LineString', 'MultiLineString', 'Polygon',
+         'MultiPolygon', 'GeometryCollection')
+POLYGON, MULTIPOLYGON = TYPES.index('Polygon'), TYPES.index('MultiPolygon')
+# Nesting depth of arc indices for each geometry type
+ARC_DEPTH = {'LineString': 1, 'MultiLineString': 2, 'Polygon': 2, 'MultiPolygon': 3}
+
+
+def load_json(path, encoding='utf-8'):
+    '''Parse a TopoJSON file, preserving key order'''
+    with io.open(path, encoding=encoding) as handle:
+        return json.load(handle, object_hook=OrderedDict)
+
+
+def decode_arcs(topo):
+    '''
+    Convert all TopoJSON arcs into absolute (lon, lat) co-ordinates. Returns
+    ``(points, offsets)`` where points is an (n, 2) array of every arc's points
+    concatenated, and arc ``i`` is ``points[offsets[i]:offsets[i + 1]]``.
+    '''
+    arcs = topo['arcs']
+    lengths = np.fromiter((len(arc) for arc in arcs), dtype=np.intp, count=len(arcs))
+    points = np.fromiter(
+        (val for arc in arcs for point in arc for val in point[:2]),
+        dtype=np.float64, count=2 * lengths.sum()).reshape(-1, 2)
+    return delta_decode(points, lengths, topo.get('transform'))
+
+
+def delta_decode(points, lengths, transform=None):
+    '''
+    Convert raw arc positions (as stored in the file) into absolute co-ordinates,
+    in place. ``lengths`` has the number of points in each arc. Returns
+    ``(points, offsets)`` like decode_arcs.
+    '''
+    offsets = np.zeros(len(lengths) + 1, dtype=np.intp)
+    np.cumsum(lengths, out=offsets[1:])
+    if transform is None:
+        return points, offsets
+
+    # Quantized arcs are delta-encoded: the first point of each arc is absolute
+    # and the rest are relative. Cumulative sum across all arcs, then subtract
+    # the running total just before each arc starts.
+    total = np.cumsum(points, axis=0, out=points)
+    before = np.zeros((len(lengths), 2))
+    starts = offsets[:-1]
+    before[starts > 0] = total[starts[starts > 0] - 1]
+    total -= np.repeat(before, lengths, axis=0)
+    sx, sy = transform['scale']
+    tx, ty = transform['translate']
+    total *= (sx, sy)
+    total += (tx, ty)
+    return total, offsets
+
+
+def arc_points(coords, offsets, arc):
+    '''Return the points of an arc index. Negative (~) indices are reversed'''
+    if arc >= 0:
+        return coords[offsets[arc]:offsets[arc + 1]]
+    return coords[offsets[~arc]:offsets[~arc + 1]][::-1]
+
+
+def ranges(starts, ends):
+    '''
+    Concatenate ``range(start, end)`` for each pair of starts and ends. Returns
+    ``(indices, owner)``, where owner is the pair that each index came from.
+    '''
+    counts = ends - starts
+    owner = np.repeat(np.arange(len(counts)), counts)
+    first = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - first[owner] + starts[owner], owner
+
+
+class Column(object):
+    '''
+    A property across all geometries of a topology. ``values`` is a typed array
+    (object dtype if JSON types are mixed), valid where ``present``. In columns
+    mixing ints and floats, ``integral`` marks the ints.
+    '''
+    __slots__ = ('values', 'present', 'integral')
+
+    def __init__(self, values, present, integral=None):
+        self.values, self.present, self.integral = values, present, integral
+
+    def get(self, rows, default=None):
+        '''Return the values at rows as Python objects, with default where absent'''
+        values = self.values[rows].tolist()
+        if self.integral is not None:
+            values = [int(value) if integral else value
+                      for value, integral in zip(values, self.integral[rows].tolist())]
+        return [value if present else default
+                for value, present in zip(values, self.present[rows].tolist())]
+
+
+def column(rows, values, count):
+    '''
+    Return a Column of ``count`` geometries with values at the indices rows.
+    Values that NumPy cannot hold in one typed array are stored as objects.
+    '''
+    present = np.zeros(count, dtype=bool)
+    present[rows] = True
+    kinds = set(type(value) for value in values)
+    integral, dtype = None, object
+    if kinds <= {bool}:
+        dtype = bool
+    elif kinds <= {int}:
+        if not values or -2 ** 63 <= min(values) and max(values) < 2 ** 63:
+            dtype = np.int64
+    elif kinds <= {int, float}:
+        if not any(abs(value) > 2 ** 53 for value in values if type(value) is int):
+            dtype = np.float64
+            integral = np.zeros(count, dtype=bool)
+            integral[rows] = [type(value) is int for value in values]
+    elif kinds <= {type('')}:
+        dtype = np.str_
+    if dtype is object:
+        result = np.empty(count, dtype=object)
+        for row, value in zip(rows, values):
+            result[row] = value
+    else:
+        typed = np.array(values, dtype=dtype)
+        result = np.zeros(count, dtype=typed.dtype)
+        result[rows] = typed
+    return Column(result, present, integral)
+
+
+class Topology(object):
+    '''
+    A TopoJSON topology held in flat arrays:
+
+    - ``points``, ``offsets``: decoded arcs. Arc i is ``points[offsets[i]:offsets[i + 1]]``
+    - ``names``, ``object_geoms``: object i is called ``names[i]`` and has the
+      geometries ``object_geoms[i]`` to ``object_geoms[i + 1]``
+    - ``types``: index of each geometry's type in TYPES
+    - ``geom_parts``, ``part_rings``, ``ring_arcs``, ``arcs``: geometry i has
+      parts ``geom_parts[i]`` to ``geom_parts[i + 1]``, and so on. Ring r is made
+      of the arc indices ``arcs[ring_arcs[r]:ring_arcs[r + 1]]``. Polygons have 1
+      part, LineStrings 1 part with 1 ring
+    - ``columns``: OrderedDict of property name to Column
+    - ``selected``: indices of the geometries in use, in order (see select)
+    - ``used_arcs``: arcs that the selected geometries use (see select)
+    - ``projected``: ``(coords, offsets)`` of projected (e.g. distorted) arcs, or None
+    - ``index``: Index of property values, shared by all copies
+    - ``adjacency``: Adjacency of geometries via shared arcs, shared by all copies
+    '''
+    __slots__ = ('transform', 'bbox', 'points', 'offsets', 'names', 'object_geoms', 'types',
+                 'geom_parts', 'part_rings', 'ring_arcs', 'arcs', 'columns', 'selected',
+                 'used_arcs', 'projected', 'index', 'adjacency')
+
+    def __init__(self, **kwargs):
+        for slot in self.__slots__:
+            setattr(self, slot, kwargs.get(slot))
+        if self.columns is None:
+            self.columns = OrderedDict()
+        if self.selected is None:
+            self.selected = np.arange(len(self.types))
+        if self.index is None:
+            self.index = Index()
+        if self.adjacency is None:
+            self.adjacency = Adjacency()
+
+    def copy(self):
+        '''Return a copy that shares arrays, but not the selection or columns'''
+        result = Topology(**{slot: getattr(self, slot) for slot in self.__slots__})
+        result.columns = OrderedDict(self.columns)
+        return result
+
+    def __len__(self):
+        return len(self.selected)
+
+    def geometries(self):
+        '''Return the selected geometries'''
+        return [Geometry(self, index) for index in self.selected.tolist()]
+
+    def rows(self, geoms=None):
+        '''Return the properties of geometries (default: selected) as OrderedDicts'''
+        geoms = self.selected if geoms is None else geoms
+        result = [OrderedDict() for geom in geoms]
+        for name, col in self.columns.items():
+            for row, value, present in zip(result, col.get(geoms), col.present[geoms]):
+                if present:
+                    row[name] = value
+        return result
+
+    def strings(self, name, geoms=None):
+        '''Return property name of geometries (default: selected) as str, '' if absent'''
+        geoms = self.selected if geoms is None else geoms
+        if name not in self.columns:
+            return [''] * len(geoms)
+        return [str(value) for value in self.columns[name].get(geoms, '')]   # noqa: E911
+
+    def frame(self):
+        '''Return the properties of the selected geometries as a DataFrame'''
+        data = OrderedDict()
+        for name, col in self.columns.items():
+            if col.present[self.selected].any():
+                data[name] = col.get(self.selected)
+        return pd.DataFrame(data, index=range(len(self.selected)), columns=list(data))
+
+    def set_column(self, name, values):
+        '''Set property name of the selected geometries to values. Others lack it'''
+        self.columns[name] = column(self.selected, list(values), len(self.types))
+
+    def geom_arcs(self, geoms):
+        '''Return the arc indices (signed) used by geoms, including all rings and parts'''
+        starts = self.ring_arcs[self.part_rings[self.geom_parts[geoms]]]
+        ends = self.ring_arcs[self.part_rings[self.geom_parts[geoms + 1]]]
+        return self.arcs[ranges(starts, ends)[0]]
+
+
+class Geometry(object):
+    '''A geometry of a Topology, read from its arrays on demand'''
+    __slots__ = ('topo', 'index')
+
+    def __init__(self, topo, index):
+        self.topo, self.index = topo, index
+
+    @property
+    def type(self):
+        return TYPES[self.topo.types[self.index]]
+
+    @property
+    def arcs(self):
+        '''Arc indices, nested as in TopoJSON. [] for geometries without arcs'''
+        topo, depth = self.topo, ARC_DEPTH.get(self.type)
+        parts = [
+            [topo.arcs[topo.ring_arcs[ring]:topo.ring_arcs[ring + 1]].tolist()
+             for ring in range(topo.part_rings[part], topo.part_rings[part + 1])]
+            for part in range(topo.geom_parts[self.index], topo.geom_parts[self.index + 1])
+        ]
+        if depth == 3:
+            return parts
+        elif depth == 2:
+            return parts[0]
+        elif depth == 1:
+            return parts[0][0]
+        return []
+
+    @property
+    def properties(self):
+        return self.topo.rows([self.index])[0]
+
+
+class Index(object):
+    '''
+    Inverted index of property values, over all geometries of a topology.
+    ``values(topo, key)`` returns ``{str(value): geometry indices}``, built once
+    per column and shared by every copy that ``load()`` returns.
+    '''
+    def __init__(self):
+        self._values = {}
+
+    def values(self, topo, key):
+        col = topo.columns.get(key)
+        if key not in self._values or self._values[key][0] is not col:
+            strings = np.array(topo.strings(key, np.arange(len(topo.types))), dtype=object)
+            order = np.argsort(strings, kind='stable')
+            keys, starts = np.unique(strings[order], return_index=True)
+            self._values[key] = col, {
+                val: rows for val, rows in zip(keys.tolist(), np.split(order, starts[1:]))}
+        return self._values[key][1]
+
+
+class Adjacency(object):
+    '''
+    Which geometries of a topology share arcs, i.e. border each other. Built on
+    first use from all geometries, and shared by every copy that ``load()``
+    returns. Both tables are in CSR form:
+
+    - ``arcs(topo)`` returns ``(arc_offsets, arc_geoms)``. Arc i is used by the
+      geometries ``arc_geoms[arc_offsets[i]:arc_offsets[i + 1]]``
+    - ``graph(topo)`` returns ``(offsets, neighbours)``. Geometry i shares an arc
+      with ``neighbours[offsets[i]:offsets[i + 1]]``
+
+    Geometries that only touch at a point share no arc, and are not neighbours.
+
+    The Adjacency of a subset takes its graph from the ``parent`` topology's
+    (whose geometries ``geoms`` it has), so maps filtered from one file build it once.
+    '''
+    def __init__(self, parent=None, geoms=None):
+        self._arcs = self._graph = None
+        self._parent, self._geoms = parent, geoms
+
+    def arcs(self, topo):
+        if self._arcs is None:
+            geoms = np.arange(len(topo.types))
+            starts = topo.ring_arcs[topo.part_rings[topo.geom_parts[geoms]]]
+            ends = topo.ring_arcs[topo.part_rings[topo.geom_parts[geoms + 1]]]
+            arcs, geom = ranges(starts, ends)
+            arcs = topo.arcs[arcs]
+            # Sort unique (arc, geometry) pairs by arc, then geometry
+            pairs = np.unique(np.column_stack([np.where(arcs < 0, ~arcs, arcs), geom]), axis=0)
+            arc_offsets = np.zeros(len(topo.offsets), dtype=np.intp)
+            np.cumsum(np.bincount(pairs[:, 0], minlength=len(topo.offsets) - 1),
+                      out=arc_offsets[1:])
+            self._arcs = arc_offsets, pairs[:, 1].astype(np.intp)
+        return self._arcs
+
+    def graph(self, topo):
+        if self._graph is None and self._parent is not None:
+            # Keep the parent's edges between geoms, numbering geoms from 0
+            offsets, neighbours = self._parent.adjacency.graph(self._parent)
+            local = np.full(len(self._parent.types), -1, dtype=np.intp)
+            local[self._geoms] = np.arange(len(self._geoms))
+            rows, owner = ranges(offsets[self._geoms], offsets[self._geoms + 1])
+            near = local[neighbours[rows]]
+            keep = near >= 0
+            result = np.zeros(len(self._geoms) + 1, dtype=np.intp)
+            np.cumsum(np.bincount(owner[keep], minlength=len(self._geoms)), out=result[1:])
+            self._graph = result, near[keep]
+            self._parent = self._geoms = None
+        if self._graph is None:
+            arc_offsets, arc_geoms = self.arcs(topo)
+            # Pair each geometry with those after it on the same arc. Most arcs have 1 or 2
+            arc = np.repeat(np.arange(len(arc_offsets) - 1), np.diff(arc_offsets))
+            edges = []
+            for step in range(1, int(np.diff(arc_offsets).max(initial=0))):
+                same = np.flatnonzero(arc[step:] == arc[:-step])
+                edges.append(np.column_stack([arc_geoms[same], arc_geoms[same + step]]))
+            edges = np.concatenate(edges + [np.zeros((0, 2), dtype=np.intp)])
+            edges = np.unique(np.concatenate([edges, edges[:, ::-1]]), axis=0)
+            offsets = np.zeros(len(topo.types) + 1, dtype=np.intp)
+            np.cumsum(np.bincount(edges[:, 0], minlength=len(topo.types)), out=offsets[1:])
+            self._graph = offsets, edges[:, 1].astype(np.intp)
+        return self._graph
+
+    def neighbours(self, topo, geom):
+        '''Return the indices of geometries that share an arc with geometry geom'''
+        offsets, neighbours = self.graph(topo)
+        return neighbours[offsets[geom]:offsets[geom + 1]]
+
+    def colors(self, topo, geoms, count):
+        '''
+        Return a colour from 0 to count - 1 for each of the geometry indices geoms,
+        so that neighbours among geoms differ. This uses DSATUR: it colours the
+        geometry whose neighbours have the most distinct colours next (then the one
+        with most neighbours). It picks the least used colour its neighbours lack.
+        If they have all count colours, it picks the one fewest neighbours have.
+        '''
+        offsets, neighbours = self.graph(topo)
+        geoms = np.asarray(geoms, dtype=np.intp)
+        local = np.full(len(topo.types), -1, dtype=np.intp)
+        local[geoms] = np.arange(len(geoms))
+        rows, owner = ranges(offsets[geoms], offsets[geoms + 1])
+        near = local[neighbours[rows]]
+        keep = near >= 0
+        near, owner = near[keep], owner[keep]
+        starts = np.searchsorted(owner, np.arange(len(geoms) + 1)).tolist()
+        near = near.tolist()
+        adjacent = [near[starts[i]:starts[i + 1]] for i in range(len(geoms))]
+
+        result = [-1] * len(geoms)
+        # seen[i][c] is the number of i's neighbours coloured c. saturation[i] is how many > 0
+        seen = [[0] * count for i in range(len(geoms))]
+        saturation = [0] * len(geoms)
+        used = [0] * count
+        heap = [(0, -len(adjacent[i]), i) for i in range(len(geoms))]
+        heapq.heapify(heap)
+        while heap:
+            sat, degree, i = heapq.heappop(heap)
+            # Skip coloured geometries, and entries whose saturation has since grown
+            if result[i] >= 0 or -sat != saturation[i]:
+                continue
+            free = [c for c in range(count) if not seen[i][c]]
+            color = min(free or range(count), key=lambda c: (seen[i][c], used[c], c))
+            result[i] = color
+            used[color] += 1
+            for j in adjacent[i]:
+                seen[j][color] += 1
+                if seen[j][color] == 1 and result[j] < 0:
+                    saturation[j] += 1
+                    heapq.heappush(heap, (-saturation[j], -len(adjacent[j]), j))
+        return np.array(result, dtype=np.intp)
+
+
+class Builder(object):
+    '''Collects TopoJSON objects and geometries, one at a time, into a Topology'''
+    def __init__(self):
+        self.names, self.object_geoms, self.types = [], [0], []
+        self.geom_parts, self.part_rings, self.ring_arcs, self.arcs = [0], [0], [0], []
+        self.columns = OrderedDict()
+
+    def add(self, geom):
+        '''Add a geometry (dict) to the current object'''
+        kind = geom.get('type')
+        if kind not in TYPES:
+            raise ValueError('Unknown geometry type %r' % kind)
+        # Nest all geometries as parts > rings > arcs
+        parts, depth = geom.get('arcs', []), ARC_DEPTH.get(kind, 0)
+        for level in range(depth, 3) if depth else ():
+            parts = [parts]
+        for part in parts if depth else ():
+            for ring in part:
+                self.arcs.extend(ring)
+                self.ring_arcs.append(len(self.arcs))
+            self.part_rings.append(len(self.ring_arcs) - 1)
+        self.geom_parts.append(len(self.part_rings) - 1)
+        row = len(self.types)
+        self.types.append(TYPES.index(kind))
+        for key, value in (geom.get('properties') or {}).items():
+            rows, values = self.columns.setdefault(key, ([], []))
+            rows.append(row)
+            values.append(value)
+
+    def end(self, name):
+        '''End the current object, calling it name'''
+        self.names.append(name)
+        self.object_geoms.append(len(self.types))
+
+    def build(self, **kwargs):
+        '''Return the Topology. kwargs has the decoded points, offsets, etc.'''
+        count = len(self.types)
+        columns = OrderedDict()
+        for key, (rows, values) in self.columns.items():
+            columns[key] = column(np.array(rows, dtype=np.intp), values, count)
+        return Topology(
+            names=self.names,
+            object_geoms=np.array(self.object_geoms, dtype=np.intp),
+            types=np.array(self.types, dtype=np.int8),
+            geom_parts=np.array(self.geom_parts, dtype=np.intp),
+            part_rings=np.array(self.part_rings, dtype=np.intp),
+            ring_arcs=np.array(self.ring_arcs, dtype=np.intp),
+            arcs=np.array(self.arcs, dtype=np.intp),
+            columns=columns, **kwargs)
+
+
+def from_json(topo):
+    '''Return a Topology from a parsed TopoJSON dict (e.g. from load_json)'''
+    builder = Builder()
+    for name, shape in topo['objects'].items():
+        for geom in shape['geometries'] if 'geometries' in shape else [shape]:
+            builder.add(geom)
+        builder.end(name)
+    points, offsets = decode_arcs(topo)
+    return builder.build(points=points, offsets=offsets, transform=topo.get('transform'),
+                         bbox=topo.get('bbox'))
+
+
+def select(topo, filters):
+    '''
+    Keep only selected geometries whose properties match filters, e.g.
+    ``{'X': {'a'}, 'Y': {'b', 'c'}}`` (X is a, and Y is b or c). Missing
+    properties match ''. Sets ``topo.used_arcs`` to an array of the arcs the
+    remaining geometries use.
+    '''
+    mask = np.zeros(len(topo.types), dtype=bool)
+    mask[topo.selected] = True
+    for key, vals in filters.items():
+        values = topo.index.values(topo, key)
+        match = np.zeros(len(topo.types), dtype=bool)
+        for val in vals:
+            if val in values:
+                match[values[val]] = True
+        mask &= match
+    topo.selected = np.flatnonzero(mask)
+    arcs = topo.geom_arcs(topo.selected)
+    topo.used_arcs = np.unique(np.where(arcs < 0, ~arcs, arcs))
+
+
+def subset(topo, geoms):
+    '''
+    Return a compact Topology of just the geometry indices geoms, in ascending
+    order (as select leaves them): with only the arcs they use, re-indexed, and
+    their properties. Objects without these geometries are dropped.
+    ``projected`` arcs are not kept. Its adjacency comes from topo's.
+    '''
+    geoms = np.asarray(geoms, dtype=np.intp)
+    parts, _ = ranges(topo.geom_parts[geoms], topo.geom_parts[geoms + 1])
+    ring_list, _ = ranges(topo.part_rings[parts], topo.part_rings[parts + 1])
+    arc_list, _ = ranges(topo.ring_arcs[ring_list], topo.ring_arcs[ring_list + 1])
+    # Number the arcs used in the order of their original index, keeping reversals
+    arcs = topo.arcs[arc_list]
+    used, index = np.unique(np.where(arcs < 0, ~arcs, arcs), return_inverse=True)
+    points, _ = ranges(topo.offsets[used], topo.offsets[used + 1])
+    points = topo.points[points]
+
+    def counts(offsets, rows):
+        # Offsets of the rows' items, once the items of other rows are removed
+        result = np.zeros(len(rows) + 1, dtype=np.intp)
+        np.cumsum(offsets[rows + 1] - offsets[rows], out=result[1:])
+        return result
+
+    objects, sizes = np.unique(np.searchsorted(topo.object_geoms, geoms, side='right') - 1,
+                               return_counts=True)
+    columns = OrderedDict(
+        (name, Column(col.values[geoms], col.present[geoms],
+                      None if col.integral is None else col.integral[geoms]))
+        for name, col in topo.columns.items())
+    return Topology(
+        transform=topo.transform,
+        bbox=points.min(axis=0).tolist() + points.max(axis=0).tolist() if len(points) else None,
+        points=points, offsets=counts(topo.offsets, used),
+        names=[topo.names[obj] for obj in objects.tolist()],
+        object_geoms=np.concatenate([[0], np.cumsum(sizes)]).astype(np.intp),
+        types=topo.types[geoms], geom_parts=counts(topo.geom_parts, geoms),
+        part_rings=counts(topo.part_rings, parts), ring_arcs=counts(topo.ring_arcs, ring_list),
+        arcs=np.where(arcs < 0, ~index, index).astype(np.intp), columns=columns,
+        used_arcs=np.arange(len(used)), adjacency=Adjacency(topo, geoms))
+
+
+def partition(topo, key):
+    '''
+    Split the selected geometries of a Topology by their key property, in one
+    pass. Returns ``{value: subset}``, sorted by value (as a string), where each
+    subset (see subset) has only the geometries, arcs and properties of that
+    value. Geometries without the key are under ''.
+    '''
+    selected = np.zeros(len(topo.types), dtype=bool)
+    selected[topo.selected] = True
+    result = OrderedDict()
+    for value, rows in topo.index.values(topo, key).items():
+        rows = np.sort(rows[selected[rows]])
+        if len(rows):
+            result[value] = subset(topo, rows)
+    return result
+
+
+def point_mask(offsets, arcs):
+    '''Return a boolean mask of the decoded points that belong to the given arcs'''
+    used = np.zeros(len(offsets) - 1, dtype=bool)
+    used[arcs] = True
+    return np.repeat(used, np.diff(offsets))
+
+
+def rings(topo, geoms, offsets=None):
+    '''
+    Return the rings of the Polygon and MultiPolygon geometries at indices geoms
+    as point indices into the decoded arcs (or arcs with these ``offsets``).
+    Returns ``(points, ring_offsets, ring_geom, ring_hole)``: ring ``i`` is
+    ``points[ring_offsets[i]:ring_offsets[i + 1]]``, belongs to
+    ``geoms[ring_geom[i]]`` and is a hole if ``ring_hole[i]``.
+    '''
+    offsets = topo.offsets if offsets is None else offsets
+    geoms = np.asarray(geoms, dtype=np.intp)
+    pos = np.flatnonzero(np.isin(topo.types[geoms], (POLYGON, MULTIPOLYGON)))
+    parts, part_geom = ranges(topo.geom_parts[geoms[pos]], topo.geom_parts[geoms[pos] + 1])
+    ring_starts = topo.part_rings[parts]
+    ring_list, ring_part = ranges(ring_starts, topo.part_rings[parts + 1])
+    arc_list, arc_ring = ranges(topo.ring_arcs[ring_list], topo.ring_arcs[ring_list + 1])
+    arcs = topo.arcs[arc_list]
+    forward = np.where(arcs < 0, ~arcs, arcs)
+    lengths = np.diff(offsets)[forward]
+    # Position of each point within its arc, counting backwards for reversed arcs
+    pos_in_arc = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    pos_in_arc = np.where(np.repeat(arcs < 0, lengths),
+                          np.repeat(lengths - 1, lengths) - pos_in_arc, pos_in_arc)
+    points = np.repeat(offsets[forward], lengths) + pos_in_arc
+    ring_offsets = np.zeros(len(ring_list) + 1, dtype=np.intp)
+    np.cumsum(np.bincount(arc_ring, weights=lengths, minlength=len(ring_list)).astype(np.intp),
+              out=ring_offsets[1:])
+    return points, ring_offsets, pos[part_geom[ring_part]], ring_list != ring_starts[ring_part]
+
+
+class Reader(object):
+    '''
+    Reads a JSON document a chunk at a time. Callers walk the structure with
+    ``members()`` and ``items()``, and parse the parts they need in full with
+    ``value()``. Only the current chunk (and the value being parsed) is held.
+    '''
+    space = re.compile(r'\s*')
+
+    def __init__(self, handle, chunk_size=None):
+        self.handle, self.chunk_size = handle, chunk_size or CHUNK_SIZE
+        self.buf, self.pos, self.eof = '', 0, False
+        self.decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+
+    def fill(self):
+        '''Append the next chunk to the unread buffer. Returns False at the end'''
+        chunk = '' if self.eof else self.handle.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf, self.pos = self.buf[self.pos:] + chunk, 0
+        return True
+
+    def peek(self):
+        '''Return the next non-space character without consuming it'''
+        while True:
+            self.pos = self.space.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON')
+
+    def next(self, chars):
+        '''Consume the next non-space character, which must be one of chars'''
+        char = self.peek()
+        if char not in chars:
+            raise ValueError('Expected %s, got %r' % (' or '.join(chars), char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        '''Parse the next JSON value in full'''
+        self.peek()
+        while True:
+            try:
+                result, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next chunk
+            if end < len(self.buf) or not self.fill():
+                self.pos = end
+                return result
+
+    def members(self):
+        '''Yield each key of the next JSON object. Consume its value before the next'''
+        self.next('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.next(':')
+            yield key
+            if self.next(',}') == '}':
+                return
+
+    def items(self):
+        '''Yield for each item of the next JSON array. Consume it before the next'''
+        self.next('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.next(',]') == ']':
+                return
+
+
+class Buffer(object):
+    '''A growable 1D array. ``array()`` returns the values added so far'''
+    def __init__(self, dtype, capacity=1024):
+        self.data, self.size = np.empty(max(capacity, 1), dtype=dtype), 0
+
+    def extend(self, values):
+        end = self.size + len(values)
+        if end > len(self.data):
+            data = np.empty(max(end, 2 * len(self.data)), dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:end] = values
+        self.size = end
+
+    def array(self):
+        self.data.resize(self.size, refcheck=False)
+        return self.data
+
+
+def arcs_end(reader):
+    '''
+    Return where the reader's buffer stops holding characters that can be in an
+    arcs array: the first one after the array ends, or the end of the buffer
+    '''
+    match = _not_arcs.search(reader.buf, reader.pos)
+    return match.start() if match else len(reader.buf)
+
+
+def read_arcs(reader, capacity=1024):
+    '''
+    Parse the TopoJSON arcs array at the reader's position a chunk at a time,
+    straight into arrays. Returns ``(points, lengths)``: the raw (x, y) of each
+    position as an (n, 2) float array, and the number of points in each arc.
+    Positions may have more than 2 values. Only the first 2 are kept.
+    '''
+    values, ends = Buffer(np.float64, capacity), Buffer(np.intp, capacity // 16)
+    reader.next('[')
+    # State carried across chunks: bracket depth, number of points closed so
+    # far, and the point and index within it of the last number
+    depth, points, last, rank = 1, 0, -1, 0
+    separators = dict.fromkeys(map(ord, '[],'), ' ')
+    while depth > 0:
+        # Parse up to the last separator, so that no number is split across chunks,
+        # and not past the first character that cannot be in the arcs array
+        end = arcs_end(reader)
+        cut = max(reader.buf.rfind(',', reader.pos, end),
+                  reader.buf.rfind(']', reader.pos, end)) + 1
+        if cut <= reader.pos:
+            if end < len(reader.buf):
+                raise ValueError('Invalid character %r in JSON arcs' % reader.buf[end])
+            if not reader.fill():
+                raise ValueError('Unexpected end of JSON arcs')
+            continue
+        text = reader.buf[reader.pos:cut].encode('ascii')
+        chars = np.frombuffer(text, dtype=np.uint8)
+        opens, closes = chars == ord('['), chars == ord(']')
+        level = depth + np.cumsum(opens.astype(np.int8) - closes)
+        done = np.flatnonzero(level == 0)
+        if len(done):
+            # The arcs array ends here. Leave the rest for the reader
+            text, chars, level = text[:done[0]], chars[:done[0]], level[:done[0]]
+            opens, closes = opens[:done[0]], closes[:done[0]]
+            reader.pos += done[0] + 1
+            depth = 0
+        else:
+            reader.pos = cut
+            depth = level[-1] if len(level) else depth
+        point_ends = np.cumsum(closes & (level == 2)) + points
+        ends.extend(point_ends[closes & (level == 1)])
+
+        # Start of each number, and the index of its point
+        number = ~(opens | closes | (chars == ord(',')) | (chars <= ord(' ')))
+        starts = np.flatnonzero(number & ~np.concatenate([[False], number[:-1]]))
+        # np.fromstring returns [-1] for text without numbers, so skip it
+        if len(starts):
+            nums = np.fromstring(text.decode('ascii').translate(separators), sep=' ')
+            if len(nums) != len(starts):
+                raise ValueError('Invalid number in JSON arcs')
+            point = point_ends[starts]
+            # Rank of each number within its point. The first may continue the last chunk
+            new = point != np.concatenate([[last], point[:-1]])
+            first = np.maximum.accumulate(np.where(new, np.arange(len(point)), -1))
+            ranks = np.where(first < 0, rank + 1 + np.arange(len(point)),
+                             np.arange(len(point)) - first)
+            values.extend(nums[ranks < 2])
+            last, rank = point[-1], ranks[-1]
+        points = point_ends[-1] if len(point_ends) else points
+    ends = ends.array()
+    values = values.array()
+    if len(values) != 2 * (ends[-1] if len(ends) else 0):
+        raise ValueError('Arcs positions need 2 values')
+    return values.reshape(-1, 2), np.diff(np.concatenate([[0], ends]))
+
+
+def skip_arcs(reader):
+    '''Skip the TopoJSON arcs array at the reader's position, without parsing numbers'''
+    reader.next('[')
+    depth = 1
+    while True:
+        end = arcs_end(reader)
+        chars = np.frombuffer(reader.buf[reader.pos:end].encode('ascii'), dtype=np.uint8)
+        level = depth + np.cumsum((chars == ord('[')).astype(np.int8) - (chars == ord(']')))
+        done = np.flatnonzero(level == 0)
+        if len(done):
+            reader.pos += done[0] + 1
+            return
+        depth = level[-1] if len(level) else depth
+        reader.pos = end
+        if end < len(reader.buf):
+            raise ValueError('Invalid character %r in JSON arcs' % reader.buf[end])
+        if not reader.fill():
+            raise ValueError('Unexpected end of JSON arcs')
+
+
+def read_objects(reader, builder):
+    '''Parse the TopoJSON objects at the reader's position one geometry at a time'''
+    for name in reader.members():
+        shape, collection = OrderedDict(), False
+        for key in reader.members():
+            if key == 'geometries':
+                collection = True
+                for item in reader.items():
+                    builder.add(reader.value())
+            else:
+                shape[key] = reader.value()
+        # An object may also be a single geometry
+        if not collection:
+            builder.add(shape)
+        builder.end(name)
+
+
+def read(path, encoding='utf-8', arcs=True):
+    '''
+    Parse a TopoJSON file into a Topology, streaming the arcs straight into
+    arrays and the geometries into a Builder. If arcs is False, the arcs are
+    skipped: the Topology has no points, only geometries and properties.
+    '''
+    topo, builder, positions = OrderedDict(), Builder(), None
+    with io.open(path, encoding=encoding) as handle:
+        reader = Reader(handle)
+        for key in reader.members():
+            if key == 'arcs' and not arcs:
+                skip_arcs(reader)
+            elif key == 'arcs':
+                # The file size is a rough upper bound on the number of values
+                positions = read_arcs(reader, os.fstat(handle.fileno()).st_size // 4)
+            elif key == 'objects':
+                read_objects(reader, builder)
+            else:
+                topo[key] = reader.value()
+    if positions is None:
+        positions = np.zeros((0, 2)), np.zeros(0, dtype=np.intp)
+    points, offsets = delta_decode(positions[0], positions[1], topo.get('transform'))
+    return builder.build(points=points, offsets=offsets, transform=topo.get('transform'),
+                         bbox=topo.get('bbox'))
+
+
+def load(path, encoding='utf-8'):
+    '''
+    Return a TopoJSON file as a Topology. This is a copy of a cached topology:
+    its selection and columns may be changed freely. Do not modify the arrays.
+    '''
+    stat = os.stat(path)
+    key = (os.path.abspath(path), encoding)
+    entry = _cache.pop(key, None)
+    if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+        if path.lower().endswith(BINARY_EXT):
+            topo = load_binary(path)
+        else:
+            sidecar = path + BINARY_EXT
+            topo = load_sidecar(sidecar, stat, encoding)
+            if topo is None:
+                topo = read(path, encoding)
+                save_sidecar(sidecar, topo, stat, encoding)
+        entry = {'topo': topo, 'mtime': stat.st_mtime, 'size': stat.st_size}
+    # Re-insert as the most recently used entry, and drop the least recently used
+    _cache[key] = entry
+    while len(_cache) > cache_size:
+        _cache.popitem(last=False)
+    return entry['topo'].copy()
+
+
+def load_properties(path, encoding='utf-8'):
+    '''
+    Return a TopoJSON (or .topo) file as a Topology, to read its geometries and
+    properties only. Its arcs may be empty. Uses the cached topology or sidecar
+    if they are fresh. Else it parses the file, skipping the arcs.
+    '''
+    stat = os.stat(path)
+    entry = _cache.get((os.path.abspath(path), encoding))
+    if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+        return entry['topo'].copy()
+    if path.lower().endswith(BINARY_EXT):
+        return load_binary(path, arcs=False)
+    topo = load_sidecar(path + BINARY_EXT, stat, encoding, arcs=False)
+    return read(path, encoding, arcs=False) if topo is None else topo
+
+
+# Binary topology files
+# ---------------------
+# A .topo file has MAGIC, the header length (uint64), a JSON header, and then
+# raw arrays, each aligned to ALIGN bytes. The header lists each array's
+# dtype, shape and offset (from the end of the header, padded to ALIGN).
+MAGIC = b'TOPOBIN\0'
+ALIGN = 64
+BINARY_EXT = '.topo'
+# Topology structure arrays, stored as int32 where they fit
+ARRAYS = ('offsets', 'object_geoms', 'types', 'geom_parts', 'part_rings', 'ring_arcs', 'arcs')
+
+
+def compact(values, dtypes=(np.int32, )):
+    '''Return integer values in the first (smallest) of dtypes that holds them'''
+    values = np.asarray(values)
+    if values.dtype.kind != 'i':
+        return values
+    for dtype in dtypes:
+        info = np.iinfo(dtype)
+        if info.bits >= values.dtype.itemsize * 8:
+            break
+        if not len(values) or info.min <= values.min() and values.max() <= info.max:
+            return values.astype(dtype)
+    return values
+
+
+def delta_encode(points, offsets, transform):
+    '''
+    Return the quantized, delta-encoded TopoJSON positions of decoded arcs as
+    int16 or int32 (the reverse of delta_decode)
+    '''
+    quantized = np.round((points - transform['translate']) / transform['scale'])
+    quantized = quantized.astype(np.int64)
+    delta = quantized.copy()
+    delta[1:] -= quantized[:-1]
+    starts = offsets[:-1][np.diff(offsets) > 0]
+    delta[starts] = quantized[starts]
+    return compact(delta, (np.int16, np.int32))
+
+
+def save_binary(path, topo, source=None):
+    '''
+    Save a Topology as a binary topology file at path. Quantized arcs are saved
+    as int16 or int32 deltas, like TopoJSON. Properties are saved a column at a
+    time. ``source`` is saved in the header, to check if the file is stale.
+    '''
+    arrays = OrderedDict()
+    if topo.transform is None:
+        arrays['points'] = np.asarray(topo.points, dtype=np.float64)
+    else:
+        arrays['deltas'] = delta_encode(topo.points, topo.offsets, topo.transform)
+    for key in ARRAYS:
+        arrays[key] = compact(getattr(topo, key))
+    columns = []
+    for index, (name, col) in enumerate(topo.columns.items()):
+        # Values NumPy cannot hold in one typed array are saved as JSON text
+        kind, values = 'array', col.values
+        if values.dtype == object:
+            kind = 'json'
+            values = np.array([json.dumps(value) for value in values.tolist()], dtype=np.str_)
+        columns.append([name, kind])
+        arrays['col%d' % index], arrays['has%d' % index] = values, col.present
+        if col.integral is not None:
+            arrays['int%d' % index] = col.integral
+
+    layout, offset = [], 0
+    for key, values in arrays.items():
+        layout.append([key, values.dtype.str, list(values.shape), offset])
+        offset += -(-values.nbytes // ALIGN) * ALIGN
+    header = json.dumps(OrderedDict([
+        ('transform', topo.transform), ('bbox', topo.bbox), ('names', topo.names),
+        ('source', source), ('columns', columns), ('arrays', layout),
+    ])).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % ALIGN)
+
+    # Write atomically: other processes may be reading the same file
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temp, 'wb') as handle:
+            handle.write(MAGIC + struct.pack('<Q', len(header)) + header)
+            for values in arrays.values():
+                data = np.ascontiguousarray(values).tobytes()
+                handle.write(data + b'\0' * (-len(data) % ALIGN))
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.unlink(temp)
+
+
+def load_binary(path, source=None, arcs=True):
+    '''
+    Return the Topology in a binary topology file. Arrays are memory-mapped,
+    not copied, so processes that load the same file share its pages. Only
+    quantized arcs are decoded into memory, unless arcs is False: then the
+    Topology has no points. If source is given and does not match the one
+    saved, returns None.
+    '''
+    with io.open(path, 'rb') as handle:
+        buf = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:len(MAGIC)] != MAGIC:
+        raise ValueError('%s is not a binary topology file' % path)
+    size = struct.unpack('<Q', buf[len(MAGIC):len(MAGIC) + 8])[0]
+    start = len(MAGIC) + 8 + size
+    header = json.loads(buf[len(MAGIC) + 8:start].decode('utf-8'),
+                        object_pairs_hook=OrderedDict)
+    if source is not None and header['source'] != source:
+        return None
+    arrays = {}
+    for key, dtype, shape, offset in header['arrays']:
+        count = int(np.prod(shape))
+        arrays[key] = np.frombuffer(buf, dtype, count, start + offset).reshape(shape)
+
+    kwargs = {key: arrays[key] for key in ARRAYS}
+    kwargs.update(transform=header['transform'], bbox=header['bbox'], names=header['names'])
+    if 'points' in arrays:
+        kwargs['points'] = arrays['points']
+    elif not arcs:
+        kwargs['points'] = np.zeros((0, 2))
+    else:
+        kwargs['points'] = delta_decode(arrays['deltas'].astype(np.float64),
+                                        np.diff(arrays['offsets']), header['transform'])[0]
+    kwargs['columns'] = OrderedDict()
+    for index, (name, kind) in enumerate(header['columns']):
+        values = arrays['col%d' % index]
+        if kind == 'json':
+            values = np.array([None] + [json.loads(value, object_pairs_hook=OrderedDict)
+                                        for value in values.tolist()], dtype=object)[1:]
+        kwargs['columns'][name] = Column(values, arrays['has%d' % index],
+                                         arrays.get('int%d' % index))
+    return Topology(**kwargs)
+
+
+def to_json(topo):
+    '''
+    Return a Topology as a TopoJSON dict, with every object as a
+    GeometryCollection. Geometry ids and Point co-ordinates are not kept in a
+    Topology, so they are not in the result.
+    '''
+    if topo.transform is None:
+        positions = np.asarray(topo.points).tolist()
+    else:
+        positions = delta_encode(topo.points, topo.offsets, topo.transform).tolist()
+    offsets = topo.offsets.tolist()
+    geoms = np.arange(len(topo.types))
+    rows = topo.rows(geoms)
+    objects = OrderedDict()
+    for index, name in enumerate(topo.names):
+        geometries = []
+        for geom in range(topo.object_geoms[index], topo.object_geoms[index + 1]):
+            geometry = Geometry(topo, geom)
+            result = OrderedDict([('type', geometry.type)])
+            if geometry.type in ARC_DEPTH:
+                result['arcs'] = geometry.arcs
+            if rows[geom]:
+                result['properties'] = rows[geom]
+            geometries.append(result)
+        objects[name] = OrderedDict([('type', 'GeometryCollection'),
+                                     ('geometries', geometries)])
+    result = OrderedDict([('type', 'Topology')])
+    if topo.transform is not None:
+        result['transform'] = topo.transform
+    if topo.bbox is not None:
+        result['bbox'] = topo.bbox
+    result['objects'] = objects
+    result['arcs'] = [positions[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    return result
+
+
+def load_sidecar(path, stat, encoding, arcs=True):
+    '''Return the Topology saved in a sidecar, or None if it is missing or stale'''
+    try:
+        return load_binary(path, [stat.st_mtime, stat.st_size, encoding], arcs)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def save_sidecar(path, topo, stat, encoding):
+    '''Save a Topology as a binary sidecar of the file with this stat and encoding'''
+    try:
+        save_binary(path, topo, [stat.st_mtime, stat.st_size, encoding])
+    except (IOError, OSError):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert TopoJSON files into binary topology (.topo) files, or back. '
+        'Or split them by a property into smaller TopoJSON files')
+    parser.add_argument('files', nargs='+', help='.json files to convert, or .topo files')
+    parser.add_argument('-o', '--out', help='Output file. Default: same name, .topo or .json')
+    parser.add_argument('-e', '--enc', help='TopoJSON encoding', default='utf-8')
+    parser.add_argument('-p', '--partition', help='Split each file into a TopoJSON file per '
+                        'value of this property, in a folder. --out is the folder. '
+                        'Default: same name, without extension')
+    args = parser.parse_args()
+    if args.out and len(args.files) > 1:
+        parser.exit(status=2, message='--out needs a single file\n')
+    for path in args.files if args.partition else ():
+        folder = args.out or os.path.splitext(path)[0]
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for value, part in partition(load(path, args.enc), args.partition).items():
+            name = re.sub(r'[^\w\-]+', '_', value, flags=re.UNICODE) or '_'
+            with io.open(os.path.join(folder, name + '.json'), 'w', encoding='utf-8') as handle:
+                handle.write(json.dumps(to_json(part), separators=(',', ':')))
+        print('Saved', folder)
+    for path in args.files if not args.partition else ():
+        binary = path.lower().endswith(BINARY_EXT)
+        out = args.out or os.path.splitext(path)[0] + ('.json' if binary else BINARY_EXT)
+        if os.path.exists(out) and not args.out:
+            print('Skipping %s: %s exists' % (path, out))
+            continue
+        if binary:
+            with io.open(out, 'w', encoding='utf-8') as handle:
+                handle.write(json.dumps(to_json(load_binary(path)), separators=(',', ':')))
+        else:
+            save_binary(out, read(path, args.enc))
+        print('Saved', out)
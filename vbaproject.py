@@ -0,0 +1,354 @@
+'''
+Builds a vbaProject.bin (the VBA part of an .xlsm file) without Excel.
+
+The file is an OLE compound file [MS-CFB] holding the VBA storage described in
+[MS-OVBA]. Module source is stored compressed, and no compiled p-code is
+written: Excel recompiles the project from source when it opens the workbook.
+'''
+from __future__ import unicode_literals
+
+import struct
+import random
+import uuid
+
+ENDOFCHAIN = 0xFFFFFFFE
+FREESECT = 0xFFFFFFFF
+FATSECT = 0xFFFFFFFD
+NOSTREAM = 0xFFFFFFFF
+SECTOR_SIZE = 512
+MINI_SECTOR_SIZE = 64
+MINI_STREAM_CUTOFF = 4096
+CHUNK_SIZE = 4096
+
+# Document module base classes: VB_Base attribute of ThisWorkbook and Sheet modules
+WORKBOOK_BASE = '0{00020819-0000-0000-C000-000000000046}'
+WORKSHEET_BASE = '0{00020820-0000-0000-C000-000000000046}'
+STDOLE = ('*\\G{00020430-0000-0000-C000-000000000046}#2.0#0#'
+          'C:\\Windows\\System32\\stdole2.tlb#OLE Automation')
+
+
+def compress(data):
+    '''Compress bytes into an [MS-OVBA] 2.4.1 CompressedContainer'''
+    out = bytearray(b'\x01')
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        body = _compress_chunk(chunk)
+        if len(body) < CHUNK_SIZE:
+            header = 0xB000 | (len(body) + 2 - 3)
+        else:
+            # Store raw. Raw chunks are always 4096 bytes, so pad the last one
+            body = chunk + b'\x00' * (CHUNK_SIZE - len(chunk))
+            header = 0x3000 | (CHUNK_SIZE + 2 - 3)
+        out += struct.pack('<H', header) + body
+    return bytes(out)
+
+
+def _compress_chunk(chunk):
+    body = bytearray()
+    # Positions of each 3-byte prefix seen so far, for finding matches
+    seen = {}
+    pos, end = 0, len(chunk)
+    while pos < end:
+        flag_index = len(body)
+        body.append(0)
+        for bit in range(8):
+            if pos >= end:
+                break
+            # Copy tokens split 16 bits between offset and length, based on position
+            bit_count = max((pos - 1).bit_length(), 4) if pos > 1 else 4
+            max_length = (0xFFFF >> bit_count) + 3
+            best_len, best_off = 0, 0
+            for candidate in reversed(seen.get(chunk[pos:pos + 3], [])):
+                length = 0
+                limit = min(max_length, end - pos)
+                while length < limit and chunk[candidate + length] == chunk[pos + length]:
+                    length += 1
+                if length > best_len:
+                    best_len, best_off = length, pos - candidate
+                    if length == limit:
+                        break
+            step = best_len if best_len >= 3 else 1
+            for index in range(pos, pos + step):
+                seen.setdefault(chunk[index:index + 3], []).append(index)
+            if best_len >= 3:
+                token = ((best_off - 1) << (16 - bit_count)) | (best_len - 3)
+                body += struct.pack('<H', token)
+                body[flag_index] |= 1 << bit
+            else:
+                body.append(chunk[pos])
+            pos += step
+    return bytes(body)
+
+
+def _encrypt(data, project_id):
+    '''Encrypt project protection data ([MS-OVBA] 2.4.3.2) into a hex string'''
+    seed = random.randint(0, 255)
+    version = 2
+    key = sum(bytearray(project_id.encode('ascii'))) & 0xFF
+    out = bytearray([seed, seed ^ version, seed ^ key])
+    unencrypted, enc1, enc2 = key, seed ^ key, seed ^ version
+    ignored = bytearray(random.randint(0, 255) for index in range((seed & 6) // 2))
+    for byte in bytes(ignored) + struct.pack('<I', len(data)) + data:
+        byte_enc = byte ^ ((enc2 + unencrypted) & 0xFF)
+        out.append(byte_enc)
+        enc2, enc1, unencrypted = enc1, byte_enc, byte
+    return ''.join('%02X' % byte for byte in out)
+
+
+def _record(rid, data):
+    return struct.pack('<HI', rid, len(data)) + data
+
+
+def _dir_stream(modules, codepage):
+    '''The uncompressed VBA/dir stream ([MS-OVBA] 2.3.4.2)'''
+    enc = 'cp%d' % codepage
+    name = 'VBAProject'.encode(enc)
+    out = bytearray()
+    # PROJECTINFORMATION
+    out += _record(0x01, struct.pack('<I', 1))              # SysKind: 32-bit Windows
+    out += _record(0x02, struct.pack('<I', 0x409))          # LCID
+    out += _record(0x14, struct.pack('<I', 0x409))          # LCIDINVOKE
+    out += _record(0x03, struct.pack('<H', codepage))       # CODEPAGE
+    out += _record(0x04, name)                              # NAME
+    out += _record(0x05, b'') + _record(0x40, b'')          # DOCSTRING
+    out += _record(0x06, b'') + _record(0x3D, b'')          # HELPFILEPATH
+    out += _record(0x07, struct.pack('<I', 0))              # HELPCONTEXT
+    out += _record(0x08, struct.pack('<I', 0))              # LIBFLAGS
+    out += struct.pack('<HIIH', 0x09, 4, 1, 0)              # VERSION
+    out += _record(0x0C, b'') + _record(0x3C, b'')          # CONSTANTS
+    # PROJECTREFERENCES: stdole
+    out += _record(0x16, b'stdole') + _record(0x3E, 'stdole'.encode('utf-16-le'))
+    libid = STDOLE.encode(enc)
+    out += _record(0x0D, struct.pack('<I', len(libid)) + libid + struct.pack('<IH', 0, 0))
+    # PROJECTMODULES
+    out += _record(0x0F, struct.pack('<H', len(modules)))
+    out += _record(0x13, struct.pack('<H', 0xFFFF))         # PROJECTCOOKIE
+    for module in modules:
+        mname = module['name']
+        out += _record(0x19, mname.encode(enc))
+        out += _record(0x47, mname.encode('utf-16-le'))
+        out += _record(0x1A, mname.encode(enc)) + _record(0x32, mname.encode('utf-16-le'))
+        out += _record(0x1C, b'') + _record(0x48, b'')      # DOCSTRING
+        out += _record(0x31, struct.pack('<I', 0))          # OFFSET: no p-code
+        out += _record(0x1E, struct.pack('<I', 0))          # HELPCONTEXT
+        out += _record(0x2C, struct.pack('<H', 0xFFFF))     # COOKIE
+        # TYPE: 0x21 is a procedural module, 0x22 is a document or class module
+        out += _record(0x22 if module.get('base') else 0x21, b'')
+        out += _record(0x2B, b'')                           # Terminator
+    out += _record(0x10, b'')                               # Terminator
+    return bytes(out)
+
+
+def _module_source(module, codepage):
+    lines = ['Attribute VB_Name = "%s"' % module['name']]
+    if module.get('base'):
+        lines += [
+            'Attribute VB_Base = "%s"' % module['base'],
+            'Attribute VB_GlobalNameSpace = False',
+            'Attribute VB_Creatable = False',
+            'Attribute VB_PredeclaredId = True',
+            'Attribute VB_Exposed = True',
+            'Attribute VB_TemplateDerived = False',
+            'Attribute VB_Customizable = True',
+        ]
+    source = module.get('source', '').replace('\r\n', '\n').rstrip('\n')
+    if source:
+        lines += source.split('\n')
+    return ('\r\n'.join(lines) + '\r\n').encode('cp%d' % codepage, 'replace')
+
+
+def _project_stream(modules, project_id, codepage):
+    '''The PROJECT stream ([MS-OVBA] 2.3.1)'''
+    lines = ['ID="%s"' % project_id]
+    for module in modules:
+        if module.get('base'):
+            lines.append('Document=%s/&H00000000' % module['name'])
+        else:
+            lines.append('Module=%s' % module['name'])
+    lines += [
+        'Name="VBAProject"',
+        'HelpContextID="0"',
+        'VersionCompatible32="393222000"',
+        'CMG="%s"' % _encrypt(struct.pack('<I', 0), project_id),
+        'DPB="%s"' % _encrypt(b'\x00', project_id),
+        'GC="%s"' % _encrypt(b'\xFF', project_id),
+        '',
+        '[Host Extender Info]',
+        '&H00000001={3832D640-CF90-11CF-8E43-00A0C911005A};VBE;&H00000000',
+        '',
+        '[Workspace]',
+    ]
+    lines += ['%s=0, 0, 0, 0, C' % module['name'] for module in modules]
+    return ('\r\n'.join(lines) + '\r\n').encode('cp%d' % codepage)
+
+
+def _projectwm_stream(modules, codepage):
+    out = bytearray()
+    for module in modules:
+        out += module['name'].encode('cp%d' % codepage) + b'\x00'
+        out += module['name'].encode('utf-16-le') + b'\x00\x00'
+    return bytes(out + b'\x00\x00')
+
+
+def build(modules, codepage=1252):
+    '''
+    Return the bytes of a vbaProject.bin. ``modules`` is a list of dicts with:
+
+    - ``name``: module name, e.g. ``Sheet1``
+    - ``base``: VB_Base for document modules, e.g. ``WORKSHEET_BASE``. Omit for
+      standard modules
+    - ``source``: VBA source code (optional)
+    '''
+    project_id = '{%s}' % str(uuid.uuid4()).upper()
+    vba = {module['name']: compress(_module_source(module, codepage)) for module in modules}
+    vba['dir'] = compress(_dir_stream(modules, codepage))
+    # Version 0xFFFF means there is no performance cache. Excel recompiles from source
+    vba['_VBA_PROJECT'] = struct.pack('<HHBH', 0x61CC, 0xFFFF, 0, 0)
+    return compound_file({
+        'PROJECT': _project_stream(modules, project_id, codepage),
+        'PROJECTwm': _projectwm_stream(modules, codepage),
+        'VBA': vba,
+    })
+
+
+def compound_file(tree):
+    '''
+    Return the bytes of a version 3 compound file [MS-CFB]. ``tree`` maps names
+    to bytes (streams) or to dicts (storages).
+    '''
+    # Flatten the tree into directory entries. Entry 0 is the root
+    entries = [{'name': 'Root Entry', 'type': 5, 'children': []}]
+
+    def walk(node, parent):
+        for name, value in node.items():
+            entry = {'name': name, 'children': []}
+            entries.append(entry)
+            parent['children'].append(len(entries) - 1)
+            if isinstance(value, dict):
+                entry['type'] = 1
+                walk(value, entry)
+            else:
+                entry['type'], entry['data'] = 2, value
+
+    walk(tree, entries[0])
+
+    # Small streams go into the mini stream, in 64 byte mini sectors
+    mini_stream, mini_fat = bytearray(), []
+    big = []
+    for entry in entries:
+        data = entry.get('data')
+        if data is None:
+            continue
+        if len(data) >= MINI_STREAM_CUTOFF:
+            big.append(entry)
+            continue
+        count = _sectors(len(data), MINI_SECTOR_SIZE)
+        entry['start'] = len(mini_fat) if count else ENDOFCHAIN
+        mini_fat += _chain(len(mini_fat), count)
+        mini_stream += _pad(data, MINI_SECTOR_SIZE)
+    entries[0]['data'] = bytes(mini_stream)
+    big.insert(0, entries[0])
+
+    # Sector layout: FAT, directory, mini FAT, then streams (root holds the mini stream)
+    dir_sectors = _sectors(len(entries) * 128, SECTOR_SIZE)
+    minifat_sectors = _sectors(len(mini_fat) * 4, SECTOR_SIZE)
+    stream_sectors = sum(_sectors(len(entry['data']), SECTOR_SIZE) for entry in big)
+    fat_sectors = 1
+    while fat_sectors * SECTOR_SIZE // 4 < (
+            fat_sectors + dir_sectors + minifat_sectors + stream_sectors):
+        fat_sectors += 1
+    if fat_sectors > 109:
+        raise ValueError('VBA project too large')
+
+    fat = [FATSECT] * fat_sectors
+    dir_start = len(fat)
+    fat += _chain(len(fat), dir_sectors)
+    minifat_start = len(fat) if minifat_sectors else ENDOFCHAIN
+    fat += _chain(len(fat), minifat_sectors)
+    body = bytearray()
+    for entry in big:
+        count = _sectors(len(entry['data']), SECTOR_SIZE)
+        entry['start'] = len(fat) if count else ENDOFCHAIN
+        fat += _chain(len(fat), count)
+        body += _pad(entry['data'], SECTOR_SIZE)
+    fat += [FREESECT] * (fat_sectors * SECTOR_SIZE // 4 - len(fat))
+
+    directory = bytearray()
+    for entry in entries:
+        _tree(entries, entry)
+    for entry in entries:
+        directory += _dir_entry(entry)
+    directory = _pad(bytes(directory), SECTOR_SIZE, b'\x00')
+    # Unused directory entries must be marked as free (no siblings or children)
+    unused = _dir_entry({'name': '', 'type': 0, 'start': 0, 'data': b''})
+    directory = bytes(directory[:len(entries) * 128]) + unused * (
+        (len(directory) - len(entries) * 128) // 128)
+    mini_fat_bytes = _pad(struct.pack('<%dI' % len(mini_fat), *mini_fat), SECTOR_SIZE, b'\xff')
+
+    header = struct.pack(
+        '<8s16sHHHHH6sIIIIIIIII',
+        b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', b'\x00' * 16,
+        0x003E, 0x0003, 0xFFFE, 9, 6, b'\x00' * 6,
+        0, fat_sectors, dir_start, 0, MINI_STREAM_CUTOFF,
+        minifat_start, minifat_sectors, ENDOFCHAIN, 0)
+    difat = list(range(fat_sectors)) + [FREESECT] * (109 - fat_sectors)
+    header += struct.pack('<109I', *difat)
+    return b''.join([
+        header,
+        struct.pack('<%dI' % len(fat), *fat),
+        directory,
+        mini_fat_bytes if mini_fat else b'',
+        bytes(body),
+    ])
+
+
+def _sectors(size, sector_size):
+    return (size + sector_size - 1) // sector_size
+
+
+def _chain(start, count):
+    return [start + index + 1 for index in range(count - 1)] + [ENDOFCHAIN] * (count > 0)
+
+
+def _pad(data, size, fill=b'\x00'):
+    return bytes(data) + fill * (-len(data) % size)
+
+
+def _tree(entries, parent):
+    '''Arrange a storage's children as a balanced red-black tree'''
+    children = sorted(parent['children'], key=lambda index: (
+        len(entries[index]['name']), entries[index]['name'].upper()))
+    depth = [0]
+
+    def build(items, level):
+        if not items:
+            return NOSTREAM
+        mid = len(items) // 2
+        entry = entries[items[mid]]
+        entry['level'] = level
+        depth[0] = max(depth[0], level)
+        entry['left'] = build(items[:mid], level + 1)
+        entry['right'] = build(items[mid + 1:], level + 1)
+        return items[mid]
+
+    parent['child'] = build(children, 0)
+    # A balanced tree is a valid red-black tree if only the deepest level is red
+    for index in children:
+        entry = entries[index]
+        entry['color'] = 0 if depth[0] and entry['level'] == depth[0] else 1
+
+
+def _dir_entry(entry):
+    name = entry['name'].encode('utf-16-le')
+    name_size = len(name) + 2 if entry['name'] else 0
+    data = entry.get('data') or b''
+    unused = entry['type'] == 0
+    return struct.pack(
+        '<64sHBBIII16sIQQIII',
+        name, name_size, entry['type'], entry.get('color', 1),
+        NOSTREAM if unused else entry.get('left', NOSTREAM),
+        NOSTREAM if unused else entry.get('right', NOSTREAM),
+        NOSTREAM if unused else entry.get('child', NOSTREAM),
+        b'\x00' * 16, 0, 0, 0,
+        entry.get('start', ENDOFCHAIN) if entry['type'] in (2, 5) else 0,
+        len(data), 0)
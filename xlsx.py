@@ -0,0 +1,441 @@
+'''
+Writes Excel maps straight into an .xlsm (OOXML) package, without Excel.
+
+This is a drop-in for shape.ExcelBackend. Shapes, cells and the VBA module are
+collected in memory and written as DrawingML, SpreadsheetML and a
+vbaProject.bin when the workbook is saved. It runs on any OS.
+'''
+from __future__ import print_function, unicode_literals
+
+import re
+import math
+import uuid
+import zipfile
+import posixpath
+from xml.sax.saxutils import escape, quoteattr
+import vbaproject
+import render
+
+EMU = 12700     # English Metric Units per point
+# Characters XML 1.0 does not allow, and the _ of text that looks like an _xHHHH_ escape
+_xml_illegal = re.compile(
+    r'[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]|_(?=x[0-9A-Fa-f]{4}_)')
+
+NS_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+NS_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+NS_PKG_REL = 'http://schemas.openxmlformats.org/package/2006/relationships'
+NS_XDR = 'http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing'
+NS_A = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+REL_DRAWING = NS_REL + '/drawing'
+REL_TABLE = NS_REL + '/table'
+REL_VML = NS_REL + '/vmlDrawing'
+REL_VBA = 'http://schemas.microsoft.com/office/2006/relationships/vbaProject'
+CT_DRAWING = 'application/vnd.openxmlformats-officedocument.drawing+xml'
+CT_TABLE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.table+xml'
+CT_VBA = 'application/vnd.ms-office.vbaProject'
+CT_VML = 'application/vnd.openxmlformats-officedocument.vmlDrawing'
+# Default column width and row height of the template in points, to anchor form controls
+COL_WIDTH, ROW_HEIGHT = 48, 15
+
+
+def col_name(col):
+    '''Convert a 1-based column number into a column name: 1 = A, 27 = AA'''
+    name = ''
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        name = chr(65 + rem) + name
+    return name
+
+
+def parse_ref(ref):
+    '''Convert a cell reference like E4 into (row, col), e.g. (4, 5)'''
+    match = re.match(r'([A-Z]+)(\d+)$', ref)
+    col = sum((ord(c) - 64) * 26 ** i for i, c in enumerate(reversed(match.group(1))))
+    return int(match.group(2)), col
+
+
+def hex_color(color):
+    '''Convert an Excel BGR color number (see shape.rgb) into RRGGBB'''
+    return '%02X%02X%02X' % (color & 0xFF, (color >> 8) & 0xFF, (color >> 16) & 0xFF)
+
+
+class XLSXBackend(object):
+    '''
+    Writes maps into an .xlsm file using the same calls as shape.ExcelBackend.
+    '''
+    def __init__(self, visible=False):
+        pass
+
+    def open(self, template):
+        with zipfile.ZipFile(template) as handle:
+            self.parts = {name: handle.read(name) for name in handle.namelist()}
+        self.shapes = []
+        self.label_boxes = []
+        self.values = {}
+        self.colors = {}
+        self.tables = []
+        self.buttons = []
+        self.source = None
+        self.picture = render.Picture()
+
+    def freeform(self, rings, color, name):
+        self.shapes.append({'name': name, 'rings': rings, 'color': color})
+        self.picture.polygon(rings, color)
+        return name
+
+    def labels(self, labels):
+        for left, top, width, height, cell in labels:
+            self.label_boxes.append({'box': (left, top, width, height), 'cell': cell})
+
+    def cells(self, row, col, values):
+        for y, items in enumerate(values):
+            for x, value in enumerate(items):
+                if value is not None:
+                    self.values[row + y, col + x] = value
+
+    def color(self, row, col, color):
+        self.colors[row, col] = color
+
+    def table(self, name, top, left, bottom, right, style):
+        self.tables.append({'name': name, 'ref': (top, left, bottom, right), 'style': style})
+
+    def button(self, left, top, width, height, text, action):
+        # A form button that runs the macro action, like Excel's Buttons().Add
+        self.buttons.append({'box': (left, top, width, height), 'text': text, 'action': action})
+
+    def screenshot(self, img_file, box):
+        for label in self.label_boxes:
+            left, top, width, height = label['box']
+            self.picture.text(left + width / 2.0, top + height / 2.0, self._label_text(label))
+        self.picture.save(img_file, *box)
+        self.picture.texts = []
+
+    def fill(self, color):
+        for shape in self.shapes:
+            shape['color'] = color
+
+    def vba(self, source):
+        self.source = source
+
+    def save(self, filename, sheet_name):
+        parts = self.parts
+        workbook_path = self._target('', '_rels/.rels', 'officeDocument')
+        workbook_rels = _rels_path(workbook_path)
+        sheet_path = self._target(workbook_path, workbook_rels, 'worksheet')
+        sheet_rels = _rels_path(sheet_path)
+
+        # Drawing and tables are linked from the sheet
+        links = []
+        if self.shapes or self.label_boxes:
+            drawing_path = 'xl/drawings/drawing1.xml'
+            parts[drawing_path] = self._drawing_xml()
+            rid = self._add_rel(sheet_rels, REL_DRAWING, '../drawings/drawing1.xml')
+            self._add_override(drawing_path, CT_DRAWING)
+            links.append('<drawing r:id="%s"/>' % rid)
+        # Form controls are VML, in a legacy drawing
+        if self.buttons:
+            parts['xl/drawings/vmlDrawing1.vml'] = self._vml_xml()
+            rid = self._add_rel(sheet_rels, REL_VML, '../drawings/vmlDrawing1.vml')
+            self._add_default('vml', CT_VML)
+            links.append('<legacyDrawing r:id="%s"/>' % rid)
+        table_ids = []
+        for index, table in enumerate(self.tables):
+            table_path = 'xl/tables/table%d.xml' % (index + 1)
+            parts[table_path] = self._table_xml(index + 1, table)
+            rid = self._add_rel(sheet_rels, REL_TABLE, '../tables/table%d.xml' % (index + 1))
+            self._add_override(table_path, CT_TABLE)
+            table_ids.append(rid)
+        if table_ids:
+            links.append('<tableParts count="%d">%s</tableParts>' % (
+                len(table_ids), ''.join('<tablePart r:id="%s"/>' % rid for rid in table_ids)))
+        parts[sheet_path] = self._sheet_xml(parts[sheet_path].decode('utf-8'), links)
+        parts['xl/styles.xml'] = self._styles_xml(parts['xl/styles.xml'].decode('utf-8'))
+
+        if self.source is not None:
+            parts['xl/vbaProject.bin'] = vbaproject.build([
+                {'name': 'ThisWorkbook', 'base': vbaproject.WORKBOOK_BASE},
+                {'name': 'Sheet1', 'base': vbaproject.WORKSHEET_BASE, 'source': self.source},
+            ])
+            self._add_rel(workbook_rels, REL_VBA, 'vbaProject.bin')
+            self._add_default('bin', CT_VBA)
+
+        # Rename the sheet in the workbook and in the document properties
+        sheet_name = escape(sheet_name[:31], {'"': '&quot;'})
+        parts[workbook_path] = re.sub(
+            r'(<sheet [^>]*name=")[^"]*', lambda match: match.group(1) + sheet_name,
+            parts[workbook_path].decode('utf-8'), count=1).encode('utf-8')
+        if 'docProps/app.xml' in parts:
+            parts['docProps/app.xml'] = re.sub(
+                r'(<TitlesOfParts>.*?<vt:lpstr>)[^<]*', lambda match: match.group(1) + sheet_name,
+                parts['docProps/app.xml'].decode('utf-8'), count=1, flags=re.S).encode('utf-8')
+
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as handle:
+            # [Content_Types].xml must be the first part in the package
+            handle.writestr('[Content_Types].xml', parts['[Content_Types].xml'])
+            for name, data in parts.items():
+                if name != '[Content_Types].xml':
+                    handle.writestr(name, data)
+
+    def quit(self):
+        pass
+
+    # Package helpers
+    # ---------------
+    def _target(self, source, rels_path, rel_type):
+        '''Return the part path of the first relationship of rel_type in rels_path'''
+        xml = self.parts[rels_path].decode('utf-8')
+        for rel in re.findall(r'<Relationship\b[^>]*>', xml):
+            if re.search(r'Type="[^"]*/%s"' % rel_type, rel):
+                target = re.search(r'Target="([^"]*)"', rel).group(1)
+                return posixpath.normpath(posixpath.join(posixpath.dirname(source), target))
+        raise ValueError('No %s relationship in %s' % (rel_type, rels_path))
+
+    def _add_rel(self, rels_path, rel_type, target):
+        xml = self.parts.get(rels_path, (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="%s"></Relationships>' % NS_PKG_REL).encode('utf-8'))
+        xml = xml.decode('utf-8')
+        ids = [int(rid) for rid in re.findall(r'Id="rId(\d+)"', xml)]
+        rid = 'rId%d' % (max(ids + [0]) + 1)
+        rel = '<Relationship Id="%s" Type="%s" Target="%s"/>' % (rid, rel_type, target)
+        self.parts[rels_path] = xml.replace('</Relationships>', rel + '</Relationships>').encode(
+            'utf-8')
+        return rid
+
+    def _add_override(self, path, content_type):
+        xml = self.parts['[Content_Types].xml'].decode('utf-8')
+        part = '<Override PartName="/%s" ContentType="%s"/>' % (path, content_type)
+        if part not in xml:
+            xml = xml.replace('</Types>', part + '</Types>')
+        self.parts['[Content_Types].xml'] = xml.encode('utf-8')
+
+    def _add_default(self, extension, content_type):
+        xml = self.parts['[Content_Types].xml'].decode('utf-8')
+        if 'Extension="%s"' % extension not in xml:
+            xml = xml.replace('</Types>', '<Default Extension="%s" ContentType="%s"/></Types>' % (
+                extension, content_type))
+        self.parts['[Content_Types].xml'] = xml.encode('utf-8')
+
+    # SpreadsheetML
+    # -------------
+    def _sheet_xml(self, xml, links):
+        styles = self._style_index()
+        rows = {}
+        for (row, col) in set(self.values) | set(self.colors):
+            rows.setdefault(row, []).append(col)
+        data = []
+        for row in sorted(rows):
+            cells = []
+            for col in sorted(rows[row]):
+                ref = col_name(col) + str(row)
+                style = ''
+                if (row, col) in self.colors:
+                    style = ' s="%d"' % styles[self.colors[row, col]]
+                cells.append(_cell_xml(ref, style, self.values.get((row, col))))
+            data.append('<row r="%d">%s</row>' % (row, ''.join(cells)))
+        xml = re.sub(r'<sheetData\s*/>|<sheetData>.*?</sheetData>',
+                     lambda match: '<sheetData>%s</sheetData>' % ''.join(data), xml, flags=re.S)
+        if rows:
+            ref = 'A1:%s%d' % (col_name(max(max(cols) for cols in rows.values())), max(rows))
+            xml = re.sub(r'<dimension ref="[^"]*"/>', '<dimension ref="%s"/>' % ref, xml)
+        end = xml.find('<extLst')
+        end = xml.rfind('</worksheet>') if end < 0 else end
+        return (xml[:end] + ''.join(links) + xml[end:]).encode('utf-8')
+
+    def _style_index(self):
+        '''Map each cell fill color to a cellXfs index'''
+        xml = self.parts['xl/styles.xml'].decode('utf-8')
+        base = int(re.search(r'<cellXfs count="(\d+)"', xml).group(1))
+        colors = sorted(set(self.colors.values()))
+        return {color: base + index for index, color in enumerate(colors)}
+
+    def _styles_xml(self, xml):
+        colors = sorted(set(self.colors.values()))
+        if not colors:
+            return xml.encode('utf-8')
+        fill_base = int(re.search(r'<fills count="(\d+)"', xml).group(1))
+        fills = ''.join(
+            '<fill><patternFill patternType="solid"><fgColor rgb="FF%s"/>'
+            '<bgColor indexed="64"/></patternFill></fill>' % hex_color(color) for color in colors)
+        xfs = ''.join(
+            '<xf numFmtId="0" fontId="0" fillId="%d" borderId="0" xfId="0" applyFill="1"/>' % (
+                fill_base + index) for index in range(len(colors)))
+
+        def extend(tag, items, count):
+            def repl(match):
+                return '<%s count="%d"%s%s</%s>' % (
+                    tag, int(match.group(1)) + count, match.group(2), items, tag)
+            return re.sub(r'<%s count="(\d+)"(.*?)</%s>' % (tag, tag), repl, xml, flags=re.S)
+
+        xml = extend('fills', fills, len(colors))
+        xml = extend('cellXfs', xfs, len(colors))
+        return xml.encode('utf-8')
+
+    def _table_xml(self, table_id, table):
+        top, left, bottom, right = table['ref']
+        # A table needs at least one data row below the header
+        bottom = max(bottom, top + 1)
+        columns = ''.join(
+            '<tableColumn id="%d" name=%s/>' % (
+                col - left + 1, quoteattr('%s' % self.values.get((top, col), 'Column%d' % col)))
+            for col in range(left, right + 1))
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<table xmlns="%s" id="%d" name=%s displayName=%s ref="%s%d:%s%d" '
+            'totalsRowShown="0"><tableColumns count="%d">%s</tableColumns>'
+            '<tableStyleInfo name=%s showFirstColumn="0" showLastColumn="0" '
+            'showRowStripes="1" showColumnStripes="0"/></table>' % (
+                NS_MAIN, table_id, quoteattr(table['name']), quoteattr(table['name']),
+                col_name(left), top, col_name(right), bottom,
+                right - left + 1, columns, quoteattr(table['style']))).encode('utf-8')
+
+    # DrawingML
+    # ---------
+    def _drawing_xml(self):
+        ids = iter(range(2, 1 << 30))
+        anchors = []
+        for shape in self.shapes:
+            (x0, y0), (x1, y1) = _bounds(shape)
+            anchors.append(_anchor(x0, y0, x1 - x0, y1 - y0, _shape_xml(shape, ids)))
+        for label in self.label_boxes:
+            left, top, width, height = label['box']
+            anchors.append(_anchor(left, top, width, height, self._label_xml(label, next(ids))))
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<xdr:wsDr xmlns:xdr="%s" xmlns:a="%s">%s</xdr:wsDr>' % (
+                NS_XDR, NS_A, ''.join(anchors))).encode('utf-8')
+
+    def _label_text(self, label):
+        text = self.values.get(parse_ref(label['cell']))
+        return '' if text is None else '%s' % text
+
+    def _label_xml(self, label, shape_id):
+        left, top, width, height = label['box']
+        match = re.match(r'([A-Z]+)(\d+)$', label['cell'])
+        text = self._label_text(label)
+        return (
+            '<xdr:sp macro="" textlink="$%s$%s">'
+            '<xdr:nvSpPr><xdr:cNvPr id="%d" name="TextBox %d"/><xdr:cNvSpPr txBox="1"/>'
+            '</xdr:nvSpPr><xdr:spPr>%s<a:prstGeom prst="rect"><a:avLst/></a:prstGeom>'
+            '<a:noFill/></xdr:spPr><xdr:txBody><a:bodyPr wrap="none" lIns="0" tIns="0" '
+            'rIns="0" bIns="0" rtlCol="0" anchor="ctr"><a:noAutofit/></a:bodyPr><a:lstStyle/>'
+            '<a:p><a:pPr algn="ctr"/><a:fld id="{%s}" type="TxLink"><a:rPr lang="en-US"/>'
+            '<a:pPr algn="ctr"/><a:t>%s</a:t></a:fld><a:endParaRPr lang="en-US"/></a:p>'
+            '</xdr:txBody></xdr:sp>' % (
+                match.group(1), match.group(2), shape_id, shape_id - 1,
+                _xfrm(left, top, width, height), str(uuid.uuid4()).upper(), escape(text)))
+
+    # VML
+    # ---
+    def _vml_xml(self):
+        shapes = []
+        for index, button in enumerate(self.buttons):
+            left, top, width, height = button['box']
+            shapes.append(
+                '<v:shape id="_x0000_s%d" type="#_x0000_t201" style="position:absolute;'
+                'margin-left:%gpt;margin-top:%gpt;width:%gpt;height:%gpt;z-index:%d;'
+                'mso-wrap-style:tight" o:button="t" fillcolor="buttonFace [67]" '
+                'strokecolor="windowText [64]" o:insetmode="auto">'
+                '<v:fill color2="buttonFace [67]" o:detectmouseclick="t"/>'
+                '<o:lock v:ext="edit" rotation="t"/><v:textbox style="mso-direction-alt:auto" '
+                'o:singleclick="f"><div style="text-align:center"><font face="Calibri" '
+                'size="220" color="#000000">%s</font></div></v:textbox>'
+                '<x:ClientData ObjectType="Button"><x:Anchor>%s</x:Anchor>'
+                '<x:PrintObject>False</x:PrintObject><x:AutoFill>False</x:AutoFill>'
+                '<x:FmlaMacro>[0]!%s</x:FmlaMacro><x:TextHAlign>Center</x:TextHAlign>'
+                '<x:TextVAlign>Center</x:TextVAlign></x:ClientData></v:shape>' % (
+                    1025 + index, left, top, width, height, index + 1, escape(button['text']),
+                    _vml_anchor(left, top, width, height), escape(button['action'])))
+        return (
+            '<xml xmlns:v="urn:schemas-microsoft-com:vml" '
+            'xmlns:o="urn:schemas-microsoft-com:office:office" '
+            'xmlns:x="urn:schemas-microsoft-com:office:excel">'
+            '<o:shapelayout v:ext="edit"><o:idmap v:ext="edit" data="1"/></o:shapelayout>'
+            '<v:shapetype id="_x0000_t201" coordsize="21600,21600" o:spt="201" '
+            'path="m,l,21600r21600,l21600,xe"><v:stroke joinstyle="miter"/>'
+            '<v:path shadowok="f" o:extrusionok="f" strokeok="f" fillok="f" '
+            'o:connecttype="rect"/><o:lock v:ext="edit" shapetype="t"/></v:shapetype>'
+            '%s</xml>' % ''.join(shapes)).encode('utf-8')
+
+
+def _rels_path(path):
+    folder, name = posixpath.split(path)
+    return posixpath.join(folder, '_rels', name + '.rels')
+
+
+def _cell_xml(ref, style, value):
+    # Excel has no NaN or infinity. Leave those cells empty
+    if value is None or isinstance(value, float) and not math.isfinite(value):
+        return '<c r="%s"%s/>' % (ref, style)
+    if isinstance(value, bool):
+        return '<c r="%s"%s t="b"><v>%d</v></c>' % (ref, style, value)
+    if isinstance(value, (int, float)):
+        return '<c r="%s"%s><v>%r</v></c>' % (ref, style, value)
+    return '<c r="%s"%s t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (
+        ref, style, escape(_xml_text('%s' % value)))
+
+
+def _xml_text(text):
+    '''
+    Escape characters that XML cannot hold as _xHHHH_, as Excel does. A literal
+    _xHHHH_ in the text has its _ escaped, so Excel does not unescape it
+    '''
+    return _xml_illegal.sub(lambda match: '_x%04X_' % ord(match.group(0)), text)
+
+
+def _vml_anchor(left, top, width, height):
+    '''
+    Return a VML x:Anchor for a box in points: the column, pixel offset, row and
+    pixel offset of its top left and bottom right corners
+    '''
+    anchor = []
+    for x, y in ((left, top), (left + width, top + height)):
+        col, col_offset = divmod(x, COL_WIDTH)
+        row, row_offset = divmod(y, ROW_HEIGHT)
+        # 96 pixels per inch is 4 pixels per 3 points
+        anchor.extend([int(col), int(round(col_offset * 4 / 3)),
+                       int(row), int(round(row_offset * 4 / 3))])
+    return ', '.join('%d' % value for value in anchor)
+
+
+def _bounds(shape):
+    xs = [point[0] for ring in shape['rings'] for point in ring]
+    ys = [point[1] for ring in shape['rings'] for point in ring]
+    return (min(xs), min(ys)), (max(xs), max(ys))
+
+
+def _xfrm(left, top, width, height):
+    return '<a:xfrm><a:off x="%d" y="%d"/><a:ext cx="%d" cy="%d"/></a:xfrm>' % (
+        round(left * EMU), round(top * EMU), max(1, round(width * EMU)),
+        max(1, round(height * EMU)))
+
+
+def _anchor(left, top, width, height, xml):
+    return (
+        '<xdr:absoluteAnchor><xdr:pos x="%d" y="%d"/><xdr:ext cx="%d" cy="%d"/>'
+        '%s<xdr:clientData/></xdr:absoluteAnchor>' % (
+            round(left * EMU), round(top * EMU), max(1, round(width * EMU)),
+            max(1, round(height * EMU)), xml))
+
+
+def _shape_xml(shape, ids):
+    (x0, y0), (x1, y1) = _bounds(shape)
+    shape_id = next(ids)
+    width, height = max(1, round((x1 - x0) * EMU)), max(1, round((y1 - y0) * EMU))
+    # Each ring is a sub-path of one path, so holes and islands make one shape
+    path = []
+    for ring in shape['rings']:
+        points = ['<a:pt x="%d" y="%d"/>' % (round((x - x0) * EMU), round((y - y0) * EMU))
+                  for x, y in ring]
+        path.append('<a:moveTo>%s</a:moveTo>%s<a:close/>' % (
+            points[0], ''.join('<a:lnTo>%s</a:lnTo>' % point for point in points[1:])))
+    path = ''.join(path)
+    return (
+        '<xdr:sp macro="" textlink=""><xdr:nvSpPr><xdr:cNvPr id="%d" name=%s/><xdr:cNvSpPr/>'
+        '</xdr:nvSpPr><xdr:spPr>%s<a:custGeom><a:avLst/><a:gdLst/><a:ahLst/><a:cxnLst/>'
+        '<a:rect l="0" t="0" r="r" b="b"/><a:pathLst><a:path w="%d" h="%d">%s</a:path>'
+        '</a:pathLst></a:custGeom><a:solidFill><a:srgbClr val="%s"/></a:solidFill>'
+        '<a:ln w="3175"><a:solidFill><a:schemeClr val="bg1"/></a:solidFill></a:ln>'
+        '</xdr:spPr></xdr:sp>' % (
+            shape_id, quoteattr(shape['name']), _xfrm(x0, y0, x1 - x0, y1 - y0),
+            width, height, path, hex_color(shape['color'])))